@@ -0,0 +1,280 @@
+"""
+Approximate nearest-neighbour search for SnapSeek, in pure NumPy.
+
+IVFIndex clusters the embeddings around k-means centroids (an inverted file):
+a query is only scored against the images of the `nprobe` clusters whose
+centroids are closest to it, instead of against the whole collection.
+Optionally the residuals (embedding - centroid) are product-quantized into
+one byte per subspace, so candidates are scored from small lookup tables
+and only the best of them are re-ranked with the exact embeddings.
+
+Run this file on an indexed folder to compare recall@k and latency against
+the exact search for a range of probe counts:
+    python ann.py "D:/Photos" --k 10
+"""
+import time
+import argparse
+import numpy as np
+
+# Default number of clusters probed per query
+DEFAULT_NPROBE = 8
+
+# Rows processed per step while assigning vectors to centroids
+ASSIGN_CHUNK_ROWS = 65536
+
+def default_n_lists(n):
+    """A usual choice of cluster count for n vectors (about 4 * sqrt(n))."""
+    return max(1, min(n, int(4 * np.sqrt(n))))
+
+def _normalize(x):
+    norms = np.linalg.norm(x, axis=-1, keepdims=True)
+    return x / np.maximum(norms, 1e-12)
+
+def _assign(x, centroids, spherical):
+    """Returns the index of the nearest centroid for every row of x (chunked)."""
+    labels = np.empty(len(x), dtype=np.int64)
+    # argmin ||x - c||^2 == argmax (x.c - ||c||^2 / 2); spherical k-means just uses x.c
+    bias = 0.0 if spherical else 0.5 * np.einsum("ij,ij->i", centroids, centroids)
+    for start in range(0, len(x), ASSIGN_CHUNK_ROWS):
+        chunk = np.asarray(x[start:start + ASSIGN_CHUNK_ROWS], dtype=np.float32)
+        labels[start:start + len(chunk)] = np.argmax(chunk @ centroids.T - bias, axis=1)
+    return labels
+
+def kmeans(x, k, n_iter=20, spherical=False, seed=0):
+    """
+    Lloyd's k-means on the rows of x. With `spherical` the centroids are kept at
+    unit length (cosine k-means), which suits normalized CLIP embeddings.
+    Returns the (k, D) centroids.
+    """
+    rng = np.random.default_rng(seed)
+    x = np.asarray(x, dtype=np.float32)
+    k = min(k, len(x))
+    centroids = x[rng.choice(len(x), size=k, replace=False)].copy()
+    for _ in range(n_iter):
+        labels = _assign(x, centroids, spherical)
+        counts = np.bincount(labels, minlength=k)
+        # Sum the points of each cluster with one sort + reduceat
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        empty = counts == 0
+        sums = np.add.reduceat(x[np.argsort(labels, kind="stable")], starts[~empty], axis=0)
+        centroids[~empty] = sums / counts[~empty, None]
+        # Re-seed clusters that lost all their points
+        if empty.any():
+            centroids[empty] = x[rng.choice(len(x), size=int(empty.sum()), replace=False)]
+        if spherical:
+            centroids = _normalize(centroids)
+    return centroids
+
+class IVFIndex:
+    """
+    Inverted-file index over the rows of an embedding matrix, with optional
+    product quantization (PQ) of the residuals.
+
+    `list_rows` holds the matrix row numbers grouped by cluster, and the rows of
+    cluster c are list_rows[list_offsets[c]:list_offsets[c + 1]].
+    """
+
+    def __init__(self, centroids, list_offsets=None, list_rows=None, codebooks=None, codes=None):
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        self.list_offsets = list_offsets
+        self.list_rows = list_rows
+        # PQ: (M, 256, D / M) codebooks and (N, M) uint8 codes in list_rows order
+        self.codebooks = codebooks
+        self.codes = codes
+
+    @property
+    def n_lists(self):
+        return len(self.centroids)
+
+    @property
+    def pq_subspaces(self):
+        return 0 if self.codebooks is None else len(self.codebooks)
+
+    # --- Building ----------------------------------------------------------
+    @classmethod
+    def train(cls, matrix, n_lists=None, pq_subspaces=0, n_iter=10, max_train=None, seed=0):
+        """
+        Trains the coarse centroids (and PQ codebooks when pq_subspaces > 0) on a
+        sample of the matrix. Call add() afterwards to fill the inverted lists.
+        """
+        n, dim = matrix.shape
+        n_lists = n_lists or default_n_lists(n)
+        if pq_subspaces and dim % pq_subspaces:
+            raise ValueError(f"pq_subspaces ({pq_subspaces}) must divide the embedding size ({dim})")
+
+        rng = np.random.default_rng(seed)
+        max_train = max_train or 32 * n_lists
+        sample_rows = np.sort(rng.choice(n, size=min(n, max_train), replace=False))
+        sample = np.asarray(matrix[sample_rows], dtype=np.float32)
+        centroids = kmeans(sample, n_lists, n_iter=n_iter, spherical=True, seed=seed)
+
+        codebooks = None
+        if pq_subspaces:
+            residuals = sample - centroids[_assign(sample, centroids, spherical=True)]
+            sub_dim = dim // pq_subspaces
+            codebooks = np.stack([
+                kmeans(residuals[:, m * sub_dim:(m + 1) * sub_dim], 256, n_iter=n_iter, seed=seed + m)
+                for m in range(pq_subspaces)
+            ])
+            if codebooks.shape[1] < 256:
+                # Fewer training points than codes: pad so every code index is valid
+                pad = np.zeros((pq_subspaces, 256 - codebooks.shape[1], sub_dim), dtype=np.float32)
+                codebooks = np.concatenate([codebooks, pad], axis=1)
+        return cls(centroids, codebooks=codebooks)
+
+    def add(self, matrix):
+        """(Re)builds the inverted lists (and PQ codes) for all rows of the matrix."""
+        labels = _assign(matrix, self.centroids, spherical=True)
+        order = np.argsort(labels, kind="stable")
+        self.list_rows = order.astype(np.int64)
+        self.list_offsets = np.zeros(self.n_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(labels, minlength=self.n_lists), out=self.list_offsets[1:])
+
+        if self.codebooks is not None:
+            m_count, _, sub_dim = self.codebooks.shape
+            self.codes = np.empty((len(order), m_count), dtype=np.uint8)
+            for start in range(0, len(order), ASSIGN_CHUNK_ROWS):
+                rows = order[start:start + ASSIGN_CHUNK_ROWS]
+                # Read the rows in file order (friendlier to a memory-mapped matrix), then
+                # put them back in list order
+                sorted_rows = np.sort(rows)
+                residuals = np.asarray(matrix[sorted_rows], dtype=np.float32)
+                residuals = residuals[np.searchsorted(sorted_rows, rows)]
+                residuals -= self.centroids[labels[rows]]
+                for m in range(m_count):
+                    sub = residuals[:, m * sub_dim:(m + 1) * sub_dim]
+                    self.codes[start:start + len(rows), m] = _assign(sub, self.codebooks[m], spherical=False)
+        return self
+
+    # --- Searching ---------------------------------------------------------
+    def search(self, matrix, query, nprobe=DEFAULT_NPROBE, rerank=None):
+        """
+        Returns (rows, scores) for the images in the `nprobe` clusters closest to
+        the query. Without PQ the scores are exact. With PQ the scores are estimated
+        from the codes and only the `rerank` best candidates are returned, with their
+        exact score (rerank=None re-scores all candidates, 0 returns the estimates).
+        """
+        query = np.asarray(query, dtype=np.float32).reshape(-1)
+        centroid_scores = self.centroids @ query
+        nprobe = min(nprobe, self.n_lists)
+        probes = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+
+        slices = [(self.list_offsets[c], self.list_offsets[c + 1]) for c in probes]
+        positions = np.concatenate([np.arange(a, b) for a, b in slices]) if slices else np.empty(0, np.int64)
+        rows = np.asarray(self.list_rows[positions])
+        if len(rows) == 0:
+            return rows, np.empty(0, dtype=np.float32)
+
+        if self.codebooks is None:
+            return rows, np.asarray(matrix[rows], dtype=np.float32) @ query
+
+        # q.x ~= q.centroid + q.residual, with q.residual read from per-subspace tables
+        m_count, _, sub_dim = self.codebooks.shape
+        tables = np.einsum("mkd,md->mk", self.codebooks, query.reshape(m_count, sub_dim))
+        base = np.concatenate([np.full(b - a, centroid_scores[c], np.float32) for (a, b), c in zip(slices, probes)])
+        codes = np.asarray(self.codes[positions])
+        scores = base + tables[np.arange(m_count), codes].sum(axis=1)
+
+        if rerank == 0:
+            return rows, scores
+        if rerank is not None and rerank < len(rows):
+            # Keep only the shortlist; its estimated scores are replaced by exact ones below
+            shortlist = np.argpartition(-scores, rerank - 1)[:rerank]
+            rows = rows[shortlist]
+        # Read the shortlisted rows in file order (friendlier to a memory-mapped matrix)
+        order = np.argsort(rows)
+        rows = rows[order]
+        return rows, np.asarray(matrix[rows], dtype=np.float32) @ query
+
+    # --- Persistence -------------------------------------------------------
+    def params(self):
+        return {"n_lists": self.n_lists, "pq_subspaces": self.pq_subspaces}
+
+    def arrays(self):
+        arrays = {
+            "ann_centroids": self.centroids,
+            "ann_list_offsets": self.list_offsets,
+            "ann_list_rows": self.list_rows,
+        }
+        if self.codebooks is not None:
+            arrays["ann_codebooks"] = self.codebooks
+            arrays["ann_codes"] = self.codes
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(
+            np.asarray(arrays["ann_centroids"]),
+            arrays["ann_list_offsets"],
+            arrays["ann_list_rows"],
+            np.asarray(arrays["ann_codebooks"]) if "ann_codebooks" in arrays else None,
+            arrays.get("ann_codes"),
+        )
+
+# ----------------------------------------------------
+#               Recall report
+# ----------------------------------------------------
+def recall_report(embedding_store, queries, k=10, nprobes=(1, 2, 4, 8, 16, 32, 64), rerank=None):
+    """
+    Compares the store's IVF search with the exact search for each probe count.
+    Returns one dict per setting with recall@k (share of the exact top k that the
+    approximate search also returned) and the mean latency of both paths in ms.
+    """
+    queries = np.asarray(queries, dtype=np.float32)
+    exact, exact_time = [], 0.0
+    for query in queries:
+        start = time.perf_counter()
+        exact.append({path for path, _ in embedding_store.top_k(query, k, exact=True)})
+        exact_time += time.perf_counter() - start
+
+    report = []
+    for nprobe in nprobes:
+        if nprobe > embedding_store.ann.n_lists:
+            break
+        hits, ann_time = 0, 0.0
+        for query, truth in zip(queries, exact):
+            start = time.perf_counter()
+            found = embedding_store.top_k(query, k, nprobe=nprobe, rerank=rerank)
+            ann_time += time.perf_counter() - start
+            hits += len(truth & {path for path, _ in found})
+        report.append({
+            "nprobe": nprobe,
+            "recall": hits / max(1, sum(len(t) for t in exact)),
+            "exact_ms": 1000 * exact_time / len(queries),
+            "ann_ms": 1000 * ann_time / len(queries),
+        })
+    return report
+
+def sample_queries(embedding_store, count=100, noise=0.05, seed=0):
+    """Query vectors made from stored image embeddings plus a little noise (no model needed)."""
+    rng = np.random.default_rng(seed)
+    rows = np.sort(rng.choice(len(embedding_store), size=min(count, len(embedding_store)), replace=False))
+    queries = np.asarray(embedding_store.vectors[rows], dtype=np.float32)
+    queries = queries + noise * rng.standard_normal(queries.shape).astype(np.float32) / np.sqrt(queries.shape[1])
+    return _normalize(queries)
+
+if __name__ == "__main__":
+    import store
+
+    parser = argparse.ArgumentParser(description="Recall@k of the IVF index against exact search.")
+    parser.add_argument("folder", help="An indexed image folder")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--n-lists", type=int, default=None, help="Build a fresh IVF index with this many clusters")
+    parser.add_argument("--pq", type=int, default=0, help="PQ subspaces for a fresh index (0 = no PQ)")
+    parser.add_argument("--rerank", type=int, default=None)
+    args = parser.parse_args()
+
+    embedding_store = store.open_index(args.folder)
+    if embedding_store is None:
+        raise SystemExit(f"No saved index for {args.folder}")
+    if embedding_store.ann is None or args.n_lists or args.pq:
+        start = time.perf_counter()
+        embedding_store.ann = IVFIndex.train(embedding_store.vectors, args.n_lists, args.pq).add(embedding_store.vectors)
+        print(f"Built IVF index ({embedding_store.ann.n_lists} lists, PQ {args.pq}) in {time.perf_counter() - start:.1f}s")
+
+    queries = sample_queries(embedding_store, args.queries)
+    print(f"{len(embedding_store)} images, {len(queries)} queries, k={args.k}")
+    print(f"{'nprobe':>6} {'recall@k':>9} {'exact ms':>9} {'ann ms':>8}")
+    for row in recall_report(embedding_store, queries, k=args.k, rerank=args.rerank):
+        print(f"{row['nprobe']:>6} {row['recall']:>9.3f} {row['exact_ms']:>9.2f} {row['ann_ms']:>8.2f}")
@@ -0,0 +1,469 @@
+"""
+Offline benchmarks for SnapSeek.
+
+Measures the indexing pipeline stage by stage (decode, preprocess, encode) on
+synthetic JPEGs, compares the reduced-resolution decode used for indexing with a
+full decode (time, decoded pixels and how close the embeddings stay), and times
+search (scoring and top-k selection) on random normalized embeddings at several
+index sizes, together with the peak memory of every step.
+Nothing is downloaded: when the CLIP weights are not already cached, the encode
+stage is skipped and a NumPy copy of CLIP's preprocessing stands in for the real one.
+The encoder options of cli.py (--model, --backend, --model-path, --quantize,
+--threads) select the encoder that is benchmarked, e.g. to compare eager PyTorch
+with int8 weights or an ONNX export on the same images.
+
+Results are written as JSON so runs can be compared:
+
+    python bench.py                                    # 1k / 100k / 1M embeddings
+    python bench.py --scales 1000 100000 --output before.json
+    python bench.py --compare before.json after.json   # ratios of every timing and memory figure
+"""
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import tracemalloc
+from PIL import Image
+import numpy as np
+
+import cli
+import main
+import store
+import encoders
+import filters
+from ann import IVFIndex, DEFAULT_NPROBE
+from quantize import FORMATS, format_name
+
+# Bump when the layout of the results file changes
+BENCH_VERSION = 1
+
+# Index sizes (number of embeddings) searched by default, and the embedding size of ViT-B/32
+DEFAULT_SCALES = (1_000, 100_000, 1_000_000)
+EMBEDDING_DIM = 512
+
+# Share of the images the filtered search benchmark selects
+FILTER_SELECTIVITY = 0.01
+
+# Synthetic images for the pipeline benchmark
+DEFAULT_IMAGE_COUNT = 256
+DEFAULT_IMAGE_SIZE = (1280, 960)
+
+def _summary(seconds):
+    """Mean and latency percentiles (in milliseconds) of a list of durations in seconds."""
+    ms = 1000 * np.asarray(seconds, dtype=np.float64)
+    return {
+        "count": len(ms),
+        "mean_ms": round(float(ms.mean()), 4),
+        "p50_ms": round(float(np.percentile(ms, 50)), 4),
+        "p95_ms": round(float(np.percentile(ms, 95)), 4),
+        "p99_ms": round(float(np.percentile(ms, 99)), 4),
+    }
+
+def _stage(seconds, count):
+    """Totals of one pipeline stage that handled `count` images in `seconds`."""
+    return {
+        "total_s": round(seconds, 4),
+        "per_image_ms": round(1000 * seconds / count, 4) if count else None,
+        "images_per_s": round(count / seconds, 2) if seconds > 0 else None,
+    }
+
+def _measure_peak(fn, *args, **kwargs):
+    """Calls fn and returns (its result, peak bytes allocated meanwhile, as seen by tracemalloc)."""
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    try:
+        result = fn(*args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, peak
+
+def _max_rss_bytes():
+    """Peak resident set size of the whole process (None where the platform does not report it)."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return rss if sys.platform == "darwin" else rss * 1024
+
+# --- Synthetic data ---------------------------------------------------------
+def make_synthetic_images(directory, count=DEFAULT_IMAGE_COUNT, size=DEFAULT_IMAGE_SIZE, seed=0):
+    """
+    Writes `count` JPEGs of `size` (width, height) to a directory and returns their paths.
+    They are smooth colour gradients with noise, which compress and decode about
+    like camera photos (pure noise would be far slower to decode).
+    """
+    rng = np.random.default_rng(seed)
+    width, height = size
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    paths = []
+    for i in range(count):
+        phase = rng.uniform(0, 2 * np.pi, 3)
+        scale = rng.uniform(0.002, 0.01, 3)
+        channels = [127 + 100 * np.sin(scale[c] * (x + y * (c + 1)) + phase[c]) for c in range(3)]
+        pixels = np.stack(channels, axis=-1) + rng.normal(0, 12, (height, width, 3))
+        path = os.path.join(directory, f"synthetic_{i:05d}.jpg")
+        Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8)).save(path, "JPEG", quality=90)
+        paths.append(path)
+    return paths
+
+def random_embeddings(count, dim=EMBEDDING_DIM, dtype=np.float32, seed=0, chunk_rows=65536):
+    """Returns a (count, dim) matrix of random unit vectors, generated in chunks to bound memory."""
+    rng = np.random.default_rng(seed)
+    matrix = np.empty((count, dim), dtype=dtype)
+    for start in range(0, count, chunk_rows):
+        chunk = rng.standard_normal((min(chunk_rows, count - start), dim), dtype=np.float32)
+        chunk /= np.linalg.norm(chunk, axis=1, keepdims=True)
+        matrix[start:start + len(chunk)] = chunk
+    return matrix
+
+def reference_preprocess(image):
+    """Stand-in for the model's preprocessing when the model is not available (see encoders.clip_preprocess)."""
+    return encoders.clip_preprocess(image)
+
+def _try_load_model():
+    """Returns main.load_model() or None when the model cannot be loaded offline."""
+    encoder = main.get_encoder()
+    if not encoder.available_offline():
+        # clip.load would download the weights
+        print(f"Weights of {encoder.name} not cached, skipping the encode stage", file=sys.stderr)
+        return None
+    try:
+        return main.load_model()
+    except Exception as e:
+        print(f"Model not available, skipping the encode stage: {e}", file=sys.stderr)
+        return None
+
+# --- Benchmarks -------------------------------------------------------------
+def bench_pipeline(image_paths, batch_size=main.DEFAULT_BATCH_SIZE, use_model=True, fast_decode=True):
+    """
+    Times the indexing stages one after the other on a single thread, so each
+    figure is the cost of that stage alone: decode (read + open + convert to RGB,
+    at reduced resolution with `fast_decode`), preprocess and encode. With the
+    model available the full threaded pipeline (main.iter_index_images) is timed as well.
+    """
+    min_side = main.DECODE_MIN_SIDE if fast_decode else None
+    model = _try_load_model() if use_model else None
+    preprocess = model.preprocess if model is not None else reference_preprocess
+
+    def run_stages():
+        decode_s = preprocess_s = encode_s = 0.0
+        tensors = []
+        for path in image_paths:
+            start = time.perf_counter()
+            with open(path, "rb") as f:
+                image, _ = main.open_image(f.read(), min_side)
+            rgb = image.convert("RGB")
+            decode_s += time.perf_counter() - start
+
+            start = time.perf_counter()
+            tensors.append(preprocess(rgb))
+            preprocess_s += time.perf_counter() - start
+
+            if model is None:
+                # Nothing to encode: do not hold on to the preprocessed images
+                tensors.clear()
+            elif len(tensors) >= batch_size:
+                start = time.perf_counter()
+                main._encode_batch(tensors)
+                encode_s += time.perf_counter() - start
+                tensors.clear()
+        if model is not None and tensors:
+            start = time.perf_counter()
+            main._encode_batch(tensors)
+            encode_s += time.perf_counter() - start
+        return decode_s, preprocess_s, encode_s
+
+    (decode_s, preprocess_s, encode_s), peak = _measure_peak(run_stages)
+    count = len(image_paths)
+    result = {
+        "images": count,
+        "batch_size": batch_size,
+        "preprocess_impl": "clip" if model is not None else "reference",
+        "fast_decode": fast_decode,
+        "decode": _stage(decode_s, count),
+        "preprocess": _stage(preprocess_s, count),
+        "encode": _stage(encode_s, count) if model is not None else None,
+        "peak_bytes": peak,
+    }
+
+    if model is not None:
+        folder = os.path.dirname(image_paths[0])
+        start = time.perf_counter()
+        for _ in main.iter_index_images(folder, batch_size=batch_size, persist=False, recursive=False,
+                                        fast_decode=fast_decode):
+            pass
+        result["end_to_end"] = _stage(time.perf_counter() - start, count)
+        result["model_load_s"] = round(main.model_load_seconds, 4)
+    return result
+
+def bench_decode(image_paths, use_model=True):
+    """
+    Compares the reduced-resolution decode used for indexing (main.open_image) with
+    a full decode of the same files: time, size of the decoded bitmap, and the cosine
+    similarity between the two embeddings of every image. Without the model, the
+    preprocessed 224x224 inputs are compared instead (as flattened vectors).
+    """
+    model = _try_load_model() if use_model else None
+    preprocess = model.preprocess if model is not None else reference_preprocess
+    times = {"full": [], "fast": []}
+    pixels = {"full": 0, "fast": 0}
+    methods = {}
+    similarities = []
+    for path in image_paths:
+        with open(path, "rb") as f:
+            data = f.read()
+        inputs = {}
+        for name, min_side in (("full", None), ("fast", main.DECODE_MIN_SIDE)):
+            start = time.perf_counter()
+            image, method = main.open_image(data, min_side)
+            image = image.convert("RGB")
+            times[name].append(time.perf_counter() - start)
+            pixels[name] += image.width * image.height * 3
+            inputs[name] = preprocess(image)
+            if name == "fast":
+                methods[method] = methods.get(method, 0) + 1
+        if model is not None:
+            full, fast = main._encode_batch([inputs["full"], inputs["fast"]])
+        else:
+            full, fast = (np.asarray(inputs[name], dtype=np.float32).ravel() for name in ("full", "fast"))
+            full, fast = full / np.linalg.norm(full), fast / np.linalg.norm(fast)
+        similarities.append(float(np.dot(full, fast)))
+
+    count = len(image_paths)
+    similarities = np.asarray(similarities)
+    return {
+        "images": count,
+        "compared": "embedding" if model is not None else "preprocessed_input",
+        "methods": methods,
+        "full": dict(_summary(times["full"]), decoded_bytes_per_image=pixels["full"] // max(1, count)),
+        "fast": dict(_summary(times["fast"]), decoded_bytes_per_image=pixels["fast"] // max(1, count)),
+        "speedup": round(sum(times["full"]) / sum(times["fast"]), 2) if sum(times["fast"]) > 0 else None,
+        "cosine_mean": round(float(similarities.mean()), 6),
+        "cosine_min": round(float(similarities.min()), 6),
+    }
+
+def bench_text_encode(queries=32, use_model=True):
+    """Latency of encoding one text query without the cache, and of a batch of `queries`."""
+    if not use_model or _try_load_model() is None:
+        return None
+    texts = [f"a photo of object number {i}" for i in range(queries)]
+    main.encode_texts(texts[:1], use_cache=False)  # warm-up
+    single = []
+    for text in texts:
+        start = time.perf_counter()
+        main.encode_texts([text], use_cache=False)
+        single.append(time.perf_counter() - start)
+    start = time.perf_counter()
+    main.encode_texts(texts, use_cache=False)
+    batch_s = time.perf_counter() - start
+    return {"single": _summary(single), "batch": _stage(batch_s, len(texts))}
+
+def bench_search(count, dim=EMBEDDING_DIM, queries=50, k=10, dtype=np.float32,
+                 ann=False, nprobe=DEFAULT_NPROBE, seed=0):
+    """
+    Times search over `count` random embeddings: building the store, scoring every
+    row (EmbeddingStore.scores) and the full top-k search, exact and, with `ann`,
+    through an IVF index (with its recall@k against the exact results).
+
+    `dtype` is a storage format (see quantize.py). For the quantized formats the
+    default top-k path (the sign-bit scan of "binary") is timed too, and every
+    format other than float32 reports its recall@k against a float32 search.
+
+    `filtered_top_k` times a search limited by a date filter matching about
+    FILTER_SELECTIVITY of the images (see filters.py).
+    """
+    name = format_name(dtype)
+    # The quantized formats are built from float32 embeddings, like at indexing time
+    matrix = random_embeddings(count, dim, np.float16 if name == "float16" else np.float32, seed)
+    paths = store.PathList.from_paths([f"img_{i:07d}.jpg" for i in range(count)])
+    query_vectors = random_embeddings(queries, dim, np.float32, seed + 1)
+
+    truth = None
+    if name != "float32":
+        reference = store.EmbeddingStore(paths, matrix, dtype=np.float32)
+        truth = [{p for p, _ in reference.top_k(q, k, exact=True)} for q in query_vectors]
+        del reference
+
+    start = time.perf_counter()
+    embedding_store, peak = _measure_peak(store.EmbeddingStore, paths, matrix, dtype=name)
+    result = {
+        "images": count,
+        "dim": dim,
+        "dtype": name,
+        "matrix_bytes": int(embedding_store.matrix.nbytes + sum(c.nbytes for c in embedding_store.columns.values())),
+        "build_s": round(time.perf_counter() - start, 4),
+        "build_peak_bytes": peak,
+    }
+    del matrix
+
+    def recall(outputs, expected):
+        hits = sum(len({p for p, _ in a} & e) for a, e in zip(outputs, expected))
+        return round(hits / max(1, k * len(expected)), 4)
+
+    def timed(fn):
+        fn(query_vectors[0])  # warm-up
+        seconds, outputs = [], []
+        for query in query_vectors:
+            start = time.perf_counter()
+            outputs.append(fn(query))
+            seconds.append(time.perf_counter() - start)
+        return seconds, outputs
+
+    (seconds, _), peak = _measure_peak(timed, embedding_store.scores)
+    result["score"] = dict(_summary(seconds), peak_bytes=peak)
+    (seconds, exact), peak = _measure_peak(timed, lambda q: embedding_store.top_k(q, k, exact=True))
+    result["top_k"] = dict(_summary(seconds), peak_bytes=peak)
+    if truth is not None:
+        result["top_k"]["recall_vs_float32"] = recall(exact, truth)
+    if name == "binary":
+        (seconds, compact), peak = _measure_peak(timed, lambda q: embedding_store.top_k(q, k))
+        result["binary_top_k"] = dict(_summary(seconds), peak_bytes=peak, recall_vs_float32=recall(compact, truth))
+
+    # Capture dates spread over ten years; the filter keeps the most recent FILTER_SELECTIVITY of them
+    taken = np.random.default_rng(seed + 2).uniform(1.4e9, 1.4e9 + 10 * 365 * 86400, count)
+    dated_store = store.EmbeddingStore(paths, embedding_store.matrix, dtype=name,
+                                       columns=dict(embedding_store.columns, taken=taken))
+    where = filters.Filter(after=float(np.quantile(taken, 1 - FILTER_SELECTIVITY)))
+    (seconds, _), peak = _measure_peak(timed, lambda q: dated_store.top_k(q, k, where=where))
+    result["filtered_top_k"] = dict(_summary(seconds), peak_bytes=peak, selectivity=FILTER_SELECTIVITY)
+    del dated_store
+
+    if ann:
+        start = time.perf_counter()
+        embedding_store.ann, peak = _measure_peak(
+            lambda: IVFIndex.train(embedding_store.vectors).add(embedding_store.vectors)
+        )
+        result["ann_build_s"] = round(time.perf_counter() - start, 4)
+        result["ann_build_peak_bytes"] = peak
+        (seconds, approx), peak = _measure_peak(timed, lambda q: embedding_store.top_k(q, k, nprobe=nprobe))
+        result["ann_top_k"] = dict(_summary(seconds), peak_bytes=peak, nprobe=nprobe,
+                                   n_lists=embedding_store.ann.n_lists,
+                                   recall=recall(approx, [{p for p, _ in e} for e in exact]))
+    return result
+
+def run_benchmarks(args):
+    """Runs every benchmark selected by the command-line arguments and returns the results."""
+    results = {
+        "version": BENCH_VERSION,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "cpu_count": os.cpu_count(),
+        },
+        "config": {
+            "scales": args.scales,
+            "dtypes": args.dtypes,
+            "queries": args.queries,
+            "k": args.k,
+            "ann": args.ann,
+            "images": args.images,
+            "image_size": args.image_size,
+            "batch_size": args.batch_size,
+            "fast_decode": not args.full_decode,
+            "model": main.get_encoder().name if not args.no_model else None,
+            "threads": args.threads,
+        },
+    }
+    use_model = not args.no_model
+
+    if args.images:
+        with tempfile.TemporaryDirectory(prefix="snapseek-bench-") as directory:
+            print(f"Writing {args.images} synthetic images...", file=sys.stderr)
+            image_paths = make_synthetic_images(directory, args.images, tuple(args.image_size))
+            print("Benchmarking the indexing pipeline...", file=sys.stderr)
+            results["pipeline"] = bench_pipeline(image_paths, args.batch_size, use_model, not args.full_decode)
+            print("Comparing reduced-resolution and full decoding...", file=sys.stderr)
+            results["decode"] = bench_decode(image_paths, use_model)
+        results["text_encode"] = bench_text_encode(use_model=use_model)
+
+    results["search"] = []
+    for count in args.scales:
+        for dtype in args.dtypes:
+            print(f"Benchmarking search over {count} {dtype} embeddings...", file=sys.stderr)
+            results["search"].append(bench_search(count, queries=args.queries, k=args.k,
+                                                  dtype=dtype, ann=args.ann))
+    results["max_rss_bytes"] = _max_rss_bytes()
+    return results
+
+# --- Comparing runs -----------------------------------------------------------
+def _flatten(results):
+    """{"metric path": number} of the timing and memory figures in a results file."""
+    flat = {}
+
+    def walk(value, key):
+        if isinstance(value, dict):
+            for name, item in value.items():
+                walk(item, f"{key}.{name}" if key else name)
+        elif isinstance(value, list):
+            for item in value:
+                # Search runs are told apart by their size and dtype rather than their position
+                label = f"{item.get('images')}/{item.get('dtype')}" if isinstance(item, dict) else ""
+                walk(item, f"{key}[{label}]")
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            if key.endswith(("_ms", "_s", "_bytes", "per_image", "per_s", "recall", "speedup", "cosine_mean", "cosine_min")):
+                flat[key] = value
+
+    walk({name: results.get(name) for name in ("pipeline", "decode", "text_encode", "search", "max_rss_bytes")}, "")
+    return flat
+
+def compare(old, new):
+    """Returns (metric, old value, new value, new / old) for the metrics found in both runs."""
+    old_flat, new_flat = _flatten(old), _flatten(new)
+    rows = []
+    for key, new_value in new_flat.items():
+        old_value = old_flat.get(key)
+        if old_value is None:
+            continue
+        ratio = new_value / old_value if old_value else None
+        rows.append((key, old_value, new_value, ratio))
+    return rows
+
+def run(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmarks of SnapSeek's indexing and search.")
+    parser.add_argument("--scales", type=int, nargs="*", default=list(DEFAULT_SCALES),
+                        help="Index sizes (number of embeddings) to search")
+    parser.add_argument("--dtypes", nargs="*", default=["float32"], choices=list(FORMATS),
+                        help="Embedding formats to search (see quantize.py)")
+    parser.add_argument("--queries", type=int, default=50, help="Queries per search benchmark")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--ann", action="store_true", help="Also build and search an IVF index")
+    parser.add_argument("--images", type=int, default=DEFAULT_IMAGE_COUNT,
+                        help="Synthetic images for the pipeline benchmark (0 to skip it)")
+    parser.add_argument("--image-size", type=int, nargs=2, default=list(DEFAULT_IMAGE_SIZE), metavar=("W", "H"))
+    parser.add_argument("--batch-size", type=int, default=main.DEFAULT_BATCH_SIZE)
+    parser.add_argument("--full-decode", action="store_true", help="Time the pipeline with full-resolution decoding")
+    parser.add_argument("--no-model", action="store_true", help="Never load CLIP, even if it is cached")
+    parser.add_argument("--output", help="Results file (default: bench-<timestamp>.json)")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="Compare two results files and exit")
+    cli.add_encoder_arguments(parser)
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        with open(args.compare[0], encoding="utf-8") as f:
+            old = json.load(f)
+        with open(args.compare[1], encoding="utf-8") as f:
+            new = json.load(f)
+        print(f"{'metric':<60} {'old':>14} {'new':>14} {'new/old':>8}")
+        for key, old_value, new_value, ratio in compare(old, new):
+            ratio = f"{ratio:.2f}" if ratio is not None else "-"
+            print(f"{key:<60} {old_value:>14.4g} {new_value:>14.4g} {ratio:>8}")
+        return
+
+    cli.set_encoder(args)
+    results = run_benchmarks(args)
+    output = args.output or f"bench-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}", file=sys.stderr)
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,103 @@
+"""
+Cache of normalized text-query embeddings for SnapSeek.
+
+Running CLIP's text encoder is the most expensive part of a search over an
+in-memory index, and users tend to repeat or refine the same queries. The cache
+keeps the most recently used embeddings (least recently used ones are evicted
+once `max_entries` is reached), keyed by model name and query string, and can be
+saved to disk so it survives restarts.
+"""
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+
+# Default location of the persisted cache
+TEXT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".snapseek", "text_cache.npz")
+
+class TextEmbeddingCache:
+    """Thread-safe LRU cache of (model name, query) -> normalized (D,) text embedding."""
+
+    def __init__(self, max_entries=1024, path=None):
+        self.max_entries = max_entries
+        self.path = path
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if path is not None:
+            self.load()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, model_name, query):
+        """Returns the cached embedding (marking it as recently used), or None."""
+        key = (model_name, query)
+        with self._lock:
+            embedding = self._entries.get(key)
+            if embedding is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return embedding
+
+    def put(self, model_name, query, embedding):
+        key = (model_name, query)
+        with self._lock:
+            self._entries[key] = np.asarray(embedding, dtype=np.float32).reshape(-1)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    # --- Persistence -------------------------------------------------------
+    def load(self):
+        """Loads the saved entries, if any (a missing or unreadable file is ignored)."""
+        try:
+            with np.load(self.path) as data:
+                models, queries, embeddings = data["models"], data["queries"], data["embeddings"]
+                # Files written before "dims" was added hold one (N, D) matrix
+                dims = data["dims"] if "dims" in data.files else None
+        except (OSError, KeyError, ValueError):
+            return
+        if dims is not None:
+            if dims.sum() != len(embeddings):
+                return
+            embeddings = np.split(embeddings, np.cumsum(dims)[:-1])
+        # Entries are saved oldest first, so re-inserting them keeps the LRU order
+        for model_name, query, embedding in zip(models, queries, embeddings):
+            self.put(str(model_name), str(query), embedding)
+
+    def save(self):
+        """
+        Writes the cache to its path (does nothing for a memory-only cache).
+        The embeddings of different models may differ in size, so they are saved one
+        after the other in a flat array, with the size of each. A failed write is
+        reported and otherwise ignored, since the cache only saves time.
+        """
+        if self.path is None:
+            return
+        with self._lock:
+            keys = list(self._entries)
+            embeddings = list(self._entries.values())
+        if not keys:
+            return
+        tmp_path = self.path + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                np.savez(
+                    f,
+                    models=np.array([model_name for model_name, _ in keys], dtype=str),
+                    queries=np.array([query for _, query in keys], dtype=str),
+                    dims=np.array([len(embedding) for embedding in embeddings], dtype=np.int64),
+                    embeddings=np.concatenate(embeddings),
+                )
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"Could not save the query cache: {e}")
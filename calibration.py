@@ -0,0 +1,100 @@
+"""
+Adaptive cut-offs for SnapSeek search results.
+
+CLIP similarities are not calibrated across queries: one query scores its relevant
+photos above 0.3 while another barely reaches 0.25, so a fixed threshold keeps too
+much for the one and too little for the other. On top of the absolute threshold of
+a search, a Cutoff ends the ranking where it stops being relevant to this query:
+  - min_z       per-query z-score: only scores at least min_z standard deviations
+                above the query's mean similarity to the index are kept
+  - max_gap     the ranking stops at the first drop between neighbouring results
+                larger than max_gap
+  - top_margin  only scores within top_margin of the best one are kept
+
+The mean and standard deviation of a query's similarities follow from the first two
+moments of the embeddings (ScoreMoments): mean = q.m and var = q.S.q - (q.m)^2, with
+m the mean embedding and S the mean outer product. They are estimated once per store
+from an evenly spaced sample of its rows, so the z-score of a query costs one (D, D)
+product, whichever way the ranking is computed (exact, ANN or sign bits). It turns
+into a plain score floor, applied while the top k are selected; the gap and the
+margin are applied to the sorted head of the ranking.
+"""
+import numpy as np
+
+# Rows of a store used to estimate its ScoreMoments
+MOMENT_SAMPLE_ROWS = 20000
+
+class ScoreMoments:
+    """Row count, mean embedding (D,) and mean outer product (D, D) of a set of embeddings."""
+
+    def __init__(self, count, mean, second):
+        self.count = count
+        self.mean = mean
+        self.second = second
+
+    @classmethod
+    def estimate(cls, vectors, sample_rows=MOMENT_SAMPLE_ROWS):
+        """Moments of (N, D) embeddings (an array or DequantizedRows), from at most `sample_rows` evenly spaced rows."""
+        count = len(vectors)
+        rows = np.unique(np.linspace(0, count - 1, min(count, sample_rows)).astype(np.int64))
+        sample = np.asarray(vectors[rows], dtype=np.float32)
+        return cls(count, sample.mean(axis=0), (sample.T @ sample) / len(sample))
+
+    @classmethod
+    def combine(cls, moments):
+        """Moments of the union of several sets (e.g. the shards of a library); None if there are none."""
+        moments = [m for m in moments if m is not None and m.count]
+        if not moments:
+            return None
+        count = sum(m.count for m in moments)
+        mean = sum(m.mean * (m.count / count) for m in moments)
+        second = sum(m.second * (m.count / count) for m in moments)
+        return cls(count, mean, second)
+
+    def score_stats(self, query):
+        """(mean, standard deviation) of the similarities of a normalized query to the embeddings."""
+        query = np.asarray(query, dtype=np.float32).reshape(-1)
+        mean = float(query @ self.mean)
+        variance = float(query @ self.second @ query) - mean * mean
+        return mean, float(np.sqrt(max(variance, 0.0)))
+
+class Cutoff:
+    """
+    Relative and adaptive conditions on where a ranking ends (see the module
+    docstring). Unset conditions are not checked; a Cutoff without any condition
+    keeps every result.
+    """
+
+    def __init__(self, min_z=None, max_gap=None, top_margin=None):
+        self.min_z = min_z
+        self.max_gap = max_gap
+        self.top_margin = top_margin
+
+    def __bool__(self):
+        return any(value is not None for value in (self.min_z, self.max_gap, self.top_margin))
+
+    def __repr__(self):
+        return f"Cutoff({', '.join(f'{name}={value!r}' for name, value in vars(self).items() if value is not None)})"
+
+    def floor(self, query, moments, threshold=None):
+        """
+        The score a result of `query` has to exceed: the larger of `threshold` and the
+        min_z floor computed from `moments` (a ScoreMoments); None if there is neither.
+        """
+        if self.min_z is None or moments is None:
+            return threshold
+        mean, std = moments.score_stats(query)
+        floor = mean + self.min_z * std
+        return floor if threshold is None else max(threshold, floor)
+
+    def head(self, scores):
+        """Number of leading results of a ranking (`scores` sorted best first) that max_gap and top_margin keep."""
+        scores = np.asarray(scores, dtype=np.float32)
+        count = len(scores)
+        if self.top_margin is not None and count:
+            count = int(np.count_nonzero(scores >= scores[0] - self.top_margin))
+        if self.max_gap is not None and count > 1:
+            drops = np.flatnonzero(scores[:count - 1] - scores[1:count] > self.max_gap)
+            if len(drops):
+                count = int(drops[0]) + 1
+        return count
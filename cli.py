@@ -0,0 +1,308 @@
+"""
+Headless command-line interface for SnapSeek.
+
+    python cli.py index "D:/Photos"                   # index (or refresh) a folder
+    python cli.py search "D:/Photos" "a boy wearing a hat" -k 5
+    python cli.py search "D:/Photos" "beach after:2023-06-01 camera:canon type:jpg"   # filters, see filters.py
+    python cli.py stats "D:/Photos"                   # what the saved index holds
+    python cli.py serve "D:/Photos" --port 8765       # local HTTP query server (see server.py)
+
+    python cli.py library add "D:/Photos"             # multi-folder library (see library.py)
+    python cli.py library refresh                     # re-index every library folder
+    python cli.py library search "a boy wearing a hat"
+    python cli.py similar "D:/Photos" "D:/Photos/beach.jpg" --text "at night"   # query by example
+    python cli.py search "D:/Photos" "a red car" -k 20 --offset 20 --min-z 2   # cut-offs, see calibration.py
+
+`index` and `search` take `--metrics FILE` (or `-` for stdout) to dump the per-stage
+timings and the failed/slow file report as JSON (see profiling.py).
+
+The encoder is chosen before the command (see encoders.py):
+    python cli.py --model ViT-L/14 index "D:/Photos"
+    python cli.py --quantize --threads 4 search "D:/Photos" "a red car"       # int8 weights on the CPU
+    python cli.py export "D:/clip-onnx" --backend onnx                         # export ViT-B/32 to ONNX
+    python cli.py --backend onnx --model-path "D:/clip-onnx" search "D:/Photos" "a red car"
+"""
+import sys
+import json
+import argparse
+
+import main
+import store
+import decoder
+import encoders
+from library import Library
+from calibration import Cutoff
+from quantize import FORMATS
+from scanner import DEFAULT_EXCLUDE
+
+def dump_metrics(args):
+    """Writes main.metrics as JSON to the --metrics file ("-" for stdout), if one was given."""
+    if not args.metrics:
+        return
+    snapshot = main.metrics.snapshot()
+    if args.metrics == "-":
+        print(json.dumps(snapshot, indent=2))
+        return
+    with open(args.metrics, "w", encoding="utf-8") as f:
+        json.dump(snapshot, f, indent=2)
+
+def cmd_index(args):
+    progress = None
+    for progress in main.iter_index_images(
+        args.folder, batch_size=args.batch_size, num_workers=args.workers,
+        build_ann=args.ann, ann_lists=args.ann_lists, pq_subspaces=args.pq,
+        recursive=not args.no_recursive, include=args.include, exclude=args.exclude,
+        fast_decode=not args.full_decode, dtype=args.format, isolate=not args.no_isolate,
+        decode_timeout=args.decode_timeout, decode_memory=args.decode_memory * 1024 ** 2,
+        checkpoint_seconds=args.checkpoint_seconds or None,
+    ):
+        if not progress.finished and not args.quiet:
+            eta = f", ETA {progress.eta:.0f}s" if progress.eta is not None else ""
+            print(f"\r{progress.done}/{progress.total} images, {progress.rate:.1f} images/s{eta}   ",
+                  end="", file=sys.stderr, flush=True)
+    if not args.quiet:
+        print(file=sys.stderr)
+    print(f"Indexed {len(progress.results)} image(s) from {args.folder} "
+          f"({progress.processed} processed, {progress.failed} failed) in {progress.elapsed:.1f}s")
+    dump_metrics(args)
+
+def search_text(args, embeddings, **options):
+    """The search of a `search` command: images matching args.query."""
+    return main.search_images(args.query, embeddings, **options)
+
+def search_examples(args, embeddings, **options):
+    """The search of a `similar` command: images like args.images, mixed with args.text."""
+    return main.search_similar(args.images, embeddings, text=args.text, text_weight=args.text_weight, **options)
+
+def cmd_search(args):
+    # `search` and `similar` only differ in args.search (see build_parser)
+    embeddings = store.open_index(args.folder)
+    if embeddings is None:
+        raise SystemExit(f"No saved index for {args.folder}; run 'index' first")
+    print_results(args, embeddings)
+
+def print_results(args, embeddings):
+    """
+    Runs args.search (search_text or search_examples) on an index (or a Library) with
+    the result options of add_result_arguments, and prints the results.
+    """
+    if args.offset < 0:
+        raise SystemExit("--offset must not be negative")
+    collapse = args.collapse or args.near_duplicates
+    cutoff = Cutoff(min_z=args.min_z, max_gap=args.max_gap, top_margin=args.top_margin)
+    try:
+        results = args.search(args, embeddings, top_k=args.k, collapse=collapse,
+                              near_duplicates=args.near_duplicates, threshold=args.threshold,
+                              cutoff=cutoff, offset=args.offset)
+    except ValueError as e:
+        # An index built with another model (encoders.EncoderMismatch), an invalid filter
+        # term or an example image that cannot be read
+        raise SystemExit(str(e))
+    if not collapse:
+        results = [(path, score, []) for path, score in results]
+    if args.json:
+        print(json.dumps([{"path": path, "score": score, "alternates": alternates}
+                          for path, score, alternates in results], indent=2))
+    else:
+        for path, score, alternates in results:
+            print(f"{score:.4f}  {path}")
+            for alternate in alternates:
+                print(f"        = {alternate}")
+    # After printing, so the results are shown even if the cache cannot be written
+    main.text_cache.save()
+    dump_metrics(args)
+
+def cmd_stats(args):
+    info = store.index_info(args.folder)
+    if info is None:
+        raise SystemExit(f"No saved index for {args.folder}")
+    if args.json:
+        print(json.dumps(info, indent=2))
+        return
+    for key, value in info.items():
+        print(f"{key:>12}: {value}")
+
+def cmd_library(args):
+    library = Library()
+    if args.action == "list":
+        for entry in library.open().stats():
+            images = "not indexed" if entry["images"] is None else f"{entry['images']} image(s)"
+            print(f"{entry['folder']}  ({images})")
+    elif args.action == "add":
+        try:
+            folder = library.add(args.folder)
+        except ValueError as e:
+            raise SystemExit(str(e))
+        embeddings = library.refresh(folder, isolate=True)
+        print(f"Added {folder} ({len(embeddings)} image(s))")
+    elif args.action == "remove":
+        try:
+            library.remove(args.folder, delete_index=args.delete_index)
+        except KeyError:
+            raise SystemExit(f"{args.folder} is not in the library")
+        print(f"Removed {args.folder}")
+    elif args.action == "refresh":
+        folders = [args.folder] if args.folder else list(library.folders)
+        for folder in folders:
+            try:
+                embeddings = library.refresh(folder, isolate=True)
+            except KeyError:
+                raise SystemExit(f"{folder} is not in the library")
+            print(f"Refreshed {folder} ({len(embeddings)} image(s))")
+    elif args.action in ("search", "similar"):
+        library.open()
+        if not len(library):
+            raise SystemExit("The library has no indexed images; use 'library add' first")
+        print_results(args, library)
+
+def cmd_serve(args):
+    import server
+    embeddings = store.open_index(args.folder) if args.no_refresh else None
+    try:
+        server.serve(args.folder, args.host, args.port, embeddings, watch=not args.no_watch, isolate=True)
+    except encoders.EncoderMismatch as e:
+        raise SystemExit(str(e))
+
+def cmd_export(args):
+    try:
+        encoders.export_model(args.directory, args.backend, args.model, quantize=args.quantize)
+    except ValueError as e:
+        raise SystemExit(str(e))
+    print(f"Exported {args.model} for the {args.backend} backend to {args.directory}")
+
+def add_encoder_arguments(parser):
+    """Adds the options that select the encoder (see encoders.py) to an argument parser."""
+    parser.add_argument("--model", default=encoders.DEFAULT_MODEL, help="CLIP model of the torch backend")
+    parser.add_argument("--backend", choices=encoders.BACKENDS, default="torch", help="Encoder runtime")
+    parser.add_argument("--model-path", default=None,
+                        help="Directory of a model exported with 'export' (torchscript and onnx backends)")
+    parser.add_argument("--quantize", action="store_true",
+                        help="Run the torch backend with dynamic int8 weights on the CPU")
+    parser.add_argument("--threads", type=int, default=None, help="CPU threads of the encoder")
+
+def set_encoder(args):
+    """Makes the encoder selected by the add_encoder_arguments options the active one."""
+    try:
+        main.set_encoder(encoders.create_encoder(args.backend, args.model, args.model_path,
+                                                 threads=args.threads, quantize=args.quantize))
+    except (OSError, ValueError) as e:
+        raise SystemExit(f"Error creating the encoder: {e}")
+
+def add_result_arguments(parser):
+    """Adds the options of the commands that print search results."""
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--offset", type=int, default=0, help="Skip this many results (the next page)")
+    parser.add_argument("--threshold", type=float, default=main.SEARCH_THRESHOLD,
+                        help="Drop results with a similarity at or below this")
+    parser.add_argument("--min-z", type=float, default=None,
+                        help="Keep results at least this many standard deviations above the query's mean score")
+    parser.add_argument("--max-gap", type=float, default=None,
+                        help="End the results at the first score drop larger than this")
+    parser.add_argument("--top-margin", type=float, default=None,
+                        help="Keep results within this much of the best score")
+    parser.add_argument("--json", action="store_true")
+    parser.add_argument("--collapse", action="store_true", help="One result per group of identical files")
+    parser.add_argument("--near-duplicates", action="store_true",
+                        help="Also group resized or re-encoded copies (implies --collapse)")
+    parser.add_argument("--metrics", metavar="FILE", help="Write stage timings as JSON")
+
+def add_similar_arguments(parser):
+    """Adds the example images and text mixing options of a `similar` command."""
+    parser.add_argument("images", nargs="+", help="Example image(s), indexed or not")
+    parser.add_argument("--text", default=None, help="Text mixed into the query (may hold filter terms)")
+    parser.add_argument("--text-weight", type=float, default=0.5, help="Weight of --text against the images (0-1)")
+    add_result_arguments(parser)
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="snapseek", description="Search images with text prompts.")
+    add_encoder_arguments(parser)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    index = commands.add_parser("index", help="Index (or refresh the index of) a folder")
+    index.add_argument("folder")
+    index.add_argument("--batch-size", type=int, default=main.DEFAULT_BATCH_SIZE)
+    index.add_argument("--workers", type=int, default=main.DEFAULT_NUM_WORKERS)
+    index.add_argument("--no-recursive", action="store_true", help="Only index the top-level folder")
+    index.add_argument("--include", nargs="*", default=None, help="File name glob patterns to index")
+    index.add_argument("--exclude", nargs="*", default=list(DEFAULT_EXCLUDE), help="Glob patterns to skip")
+    index.add_argument("--ann", action="store_true", help="Build an approximate nearest-neighbour index")
+    index.add_argument("--ann-lists", type=int, default=None)
+    index.add_argument("--pq", type=int, default=0, help="Product-quantization subspaces for --ann")
+    index.add_argument("--format", choices=FORMATS, default="float32",
+                       help="Embedding storage: float16 halves the index, int8 quarters it, "
+                            "binary adds sign bits that are scanned first (see quantize.py)")
+    index.add_argument("--full-decode", action="store_true",
+                       help="Decode JPEGs at full resolution instead of the reduced-size fast path")
+    index.add_argument("--no-isolate", action="store_true",
+                       help="Decode in threads of this process instead of supervised worker processes")
+    index.add_argument("--decode-timeout", type=float, default=decoder.DECODE_TIMEOUT,
+                       help="Seconds a worker may spend on one file before it is killed")
+    index.add_argument("--decode-memory", type=int, default=decoder.DECODE_MEMORY_LIMIT // 1024 ** 2,
+                       help="MB a worker may allocate to decode one file")
+    index.add_argument("--checkpoint-seconds", type=float, default=main.CHECKPOINT_SECONDS,
+                       help="Save newly encoded images this often, so an interrupted run resumes (0: never)")
+    index.add_argument("-q", "--quiet", action="store_true")
+    index.add_argument("--metrics", metavar="FILE", help="Write stage timings and failed/slow files as JSON")
+    index.set_defaults(func=cmd_index)
+
+    search = commands.add_parser("search", help="Search the saved index of a folder")
+    search.add_argument("folder")
+    search.add_argument("query")
+    add_result_arguments(search)
+    search.set_defaults(func=cmd_search, search=search_text)
+
+    similar = commands.add_parser("similar", help="Find images of a folder similar to example images")
+    similar.add_argument("folder")
+    add_similar_arguments(similar)
+    similar.set_defaults(func=cmd_search, search=search_examples)
+
+    stats = commands.add_parser("stats", help="Show what the saved index of a folder holds")
+    stats.add_argument("folder")
+    stats.add_argument("--json", action="store_true")
+    stats.set_defaults(func=cmd_stats)
+
+    library = commands.add_parser("library", help="Manage and search the multi-folder library")
+    actions = library.add_subparsers(dest="action", required=True)
+    actions.add_parser("list", help="List the library folders").set_defaults(func=cmd_library)
+    add = actions.add_parser("add", help="Add a folder and index it")
+    add.add_argument("folder")
+    add.set_defaults(func=cmd_library)
+    remove = actions.add_parser("remove", help="Remove a folder from the library")
+    remove.add_argument("folder")
+    remove.add_argument("--delete-index", action="store_true", help="Also delete its saved index")
+    remove.set_defaults(func=cmd_library)
+    refresh = actions.add_parser("refresh", help="Re-index one library folder, or all of them")
+    refresh.add_argument("folder", nargs="?")
+    refresh.set_defaults(func=cmd_library)
+    library_search = actions.add_parser("search", help="Search all library folders")
+    library_search.add_argument("query")
+    add_result_arguments(library_search)
+    library_search.set_defaults(func=cmd_library, search=search_text)
+    library_similar = actions.add_parser("similar", help="Find images similar to example images in all folders")
+    add_similar_arguments(library_similar)
+    library_similar.set_defaults(func=cmd_library, search=search_examples)
+
+    serve = commands.add_parser("serve", help="Answer search requests over HTTP on localhost")
+    serve.add_argument("folder")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=8765)
+    serve.add_argument("--no-refresh", action="store_true", help="Serve the saved index without re-scanning")
+    serve.add_argument("--no-watch", action="store_true", help="Don't apply changes to the folder while serving")
+    serve.set_defaults(func=cmd_serve)
+
+    export = commands.add_parser("export", help="Export a CLIP model for the torchscript or onnx backend")
+    export.add_argument("directory")
+    export.add_argument("--backend", choices=("torchscript", "onnx"), default="onnx")
+    export.add_argument("--model", default=encoders.DEFAULT_MODEL)
+    export.add_argument("--quantize", action="store_true", help="Dynamic int8 weights (torchscript only)")
+    export.set_defaults(func=cmd_export)
+    return parser
+
+def run(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.command != "export":
+        set_encoder(args)
+    args.func(args)
+
+if __name__ == "__main__":
+    run()
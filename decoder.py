@@ -0,0 +1,222 @@
+"""
+Process-isolated image decoding for SnapSeek's indexer.
+
+Decoding is where a bad file does damage: a corrupt or hostile image can hang the
+decoder, crash the process in native code or allocate gigabytes. DecodePool runs
+the decoding (main._decode_image: EXIF metadata, open, convert to RGB, perceptual
+hash) in worker processes, one file at a time per worker, supervised by the
+indexing threads that hand them the files:
+  - a worker that does not answer within `timeout` seconds is killed and replaced,
+    and the file fails with DecodeTimeout
+  - a worker that dies (a crash in native code, killed by the OS) is replaced, and
+    the file fails with WorkerCrashed
+  - a worker may grow by at most `memory_limit` bytes once started (resource limit
+    on Linux); images whose pixels would not fit are refused before decoding with
+    MemoryError, on every platform
+Failed files are left out of the index and retried on the next run, like any other
+file that fails to load.
+
+The decoded pixels are sent back to the indexing process, which preprocesses them
+for the encoder. With a `min_side` (fast decoding), _decode_image has already
+reduced images at least twice that size by a whole factor, so not much more than
+the encoder's input travels between the processes.
+
+Workers are started with "spawn" on every platform (forking a process that has
+loaded torch is unsafe) and import main.py when they start.
+"""
+import os
+import time
+import queue
+import threading
+import multiprocessing
+from PIL import Image
+
+# Seconds a worker may take to decode one file before it is killed
+DECODE_TIMEOUT = 30.0
+
+# Bytes a worker may allocate on top of what it holds once started
+DECODE_MEMORY_LIMIT = 2 * 1024 ** 3
+
+# Seconds a worker may take to start (it imports main.py and its dependencies)
+START_TIMEOUT = 120.0
+
+# Bytes a worker needs per byte of the file it decodes (the request and its unpickled copy)
+BYTES_PER_FILE_BYTE = 2
+
+# Bytes per pixel counted for the decoded image and its RGB copy when refusing oversized images
+BYTES_PER_PIXEL = 8
+
+class DecodeTimeout(TimeoutError):
+    """Raised when a worker takes longer than the pool's timeout to decode a file."""
+
+class WorkerCrashed(RuntimeError):
+    """Raised when a worker process dies while decoding a file."""
+
+def _address_space():
+    """Virtual memory size of this process in bytes (0 where /proc is not available)."""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[0]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return 0
+
+def _limit_memory(memory_limit):
+    """Caps the address space of this process at its current size plus `memory_limit` bytes."""
+    try:
+        import resource
+    except ImportError:
+        # Windows: only the pixel count check applies
+        return
+    current = _address_space()
+    if not current:
+        return
+    try:
+        _, hard = resource.getrlimit(resource.RLIMIT_AS)
+        limit = current + memory_limit
+        if hard != resource.RLIM_INFINITY:
+            limit = min(limit, hard)
+        resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+    except (ValueError, OSError):
+        pass
+
+def _serve(conn, memory_limit):
+    """Worker process: answers (data, min_side) requests until it gets None or the pipe closes."""
+    import main
+    if memory_limit:
+        _limit_memory(memory_limit)
+    max_pixels = memory_limit // BYTES_PER_PIXEL if memory_limit else None
+    conn.send("ready")
+    while True:
+        try:
+            request = conn.recv()
+        except (EOFError, MemoryError):
+            # A request that does not fit leaves the rest of it in the pipe; the pool replaces this worker
+            return
+        if request is None:
+            return
+        data, min_side = request
+        timings = {}
+        try:
+            image, content, method = main._decode_image(data, min_side, timings, max_pixels)
+            reply = ("ok", image.size, image.tobytes(), content, method, timings)
+        except Exception as e:
+            reply = ("error", e, timings)
+        image = None
+        try:
+            conn.send(reply)
+        except Exception as e:
+            # The exception could not be pickled, or the pixels did not fit
+            error = reply[1] if reply[0] == "error" else e
+            conn.send(("error", RuntimeError(f"{type(error).__name__}: {error}"), timings))
+
+class _Worker:
+    """One worker process and the parent's end of its pipe."""
+
+    def __init__(self, context, memory_limit):
+        self.conn, child = context.Pipe()
+        self.process = context.Process(target=_serve, args=(child, memory_limit),
+                                       name="snapseek-decode", daemon=True)
+        self.process.start()
+        child.close()
+        self.ready = False
+
+    def wait_ready(self):
+        if not self.ready:
+            if not self.conn.poll(START_TIMEOUT):
+                raise EOFError("worker did not start")
+            self.conn.recv()
+            self.ready = True
+
+    def stop(self, kill=False):
+        """Stops the process (killing it if it is busy or `kill` is set) and returns its exit code."""
+        if not kill:
+            try:
+                self.conn.send(None)
+            except OSError:
+                kill = True
+        if not kill:
+            self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join()
+        self.conn.close()
+        return self.process.exitcode
+
+class DecodePool:
+    """
+    Up to `num_workers` decode processes shared by the indexing threads; decode()
+    blocks until a worker is free. Workers are only started when there is something
+    to decode, so a run that finds nothing new starts none.
+    Use as a context manager, or call close() to stop them.
+    """
+
+    def __init__(self, num_workers, timeout=DECODE_TIMEOUT, memory_limit=DECODE_MEMORY_LIMIT):
+        self.num_workers = max(1, num_workers)
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self._context = multiprocessing.get_context("spawn")
+        self._idle = queue.Queue()
+        self._started = 0
+        self._lock = threading.Lock()
+
+    def _acquire(self):
+        with self._lock:
+            if self._idle.empty() and self._started < self.num_workers:
+                self._started += 1
+                return _Worker(self._context, self.memory_limit)
+        return self._idle.get()
+
+    def _replace(self, worker):
+        """Kills a worker and starts another one in its place; returns (new worker, exit code of the old one)."""
+        exit_code = worker.stop(kill=True)
+        return _Worker(self._context, self.memory_limit), exit_code
+
+    def decode(self, data, min_side=None, timings=None):
+        """
+        Decodes image bytes with main._decode_image in a worker and returns
+        (image, content, method). The worker's per-stage times are added to `timings`.
+        Raises what the decoding raised, DecodeTimeout or WorkerCrashed; the worker is
+        replaced after the last two.
+        """
+        timings = {} if timings is None else timings
+        if self.memory_limit and BYTES_PER_FILE_BYTE * len(data) > self.memory_limit:
+            raise MemoryError(f"{len(data)} byte file is too large to decode")
+        worker = self._acquire()
+        reply = None
+        start = time.perf_counter()
+        try:
+            try:
+                worker.wait_ready()
+                worker.conn.send((data, min_side))
+                if worker.conn.poll(self.timeout):
+                    reply = worker.conn.recv()
+            except (EOFError, OSError):
+                timings["decode"] = time.perf_counter() - start
+                worker, exit_code = self._replace(worker)
+                raise WorkerCrashed(f"Decode worker exited with code {exit_code}") from None
+            if reply is None:
+                timings["decode"] = self.timeout
+                worker, _ = self._replace(worker)
+                raise DecodeTimeout(f"Decoding took longer than {self.timeout:g}s")
+        finally:
+            self._idle.put(worker)
+        if reply[0] != "ok":
+            _, error, worker_timings = reply
+            timings.update(worker_timings)
+            raise error
+        _, size, pixels, content, method, worker_timings = reply
+        timings.update(worker_timings)
+        return Image.frombytes("RGB", size, pixels), content, method
+
+    def close(self):
+        """Stops every worker (waiting for the busy ones to finish their file)."""
+        with self._lock:
+            started, self._started = self._started, 0
+        for _ in range(started):
+            self._idle.get().stop()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
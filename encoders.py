@@ -0,0 +1,345 @@
+"""
+Image and text encoders for SnapSeek.
+
+An encoder turns images and text queries into normalized embeddings of one shared
+space. main.py indexes and searches with the active encoder (main.set_encoder),
+and every backend offers the same methods: load, preprocess (a PIL image into a
+model input), encode_images + to_numpy (a batch of inputs into an (N, D) float32
+array) and encode_texts.
+
+Backends:
+  - "torch":       CLIP in eager PyTorch (the `clip` package), any model of
+                   clip.available_models(). With `quantize`, its linear layers run
+                   with dynamic int8 weights on the CPU.
+  - "torchscript": the image and text towers of a CLIP model exported by
+                   export_model, run with torch.jit (no Python model code needed)
+  - "onnx":        the same towers exported to ONNX, run with onnxruntime on the CPU
+An exported model is a directory holding image.<ext>, text.<ext> and
+encoder.json, which names the CLIP model it came from.
+
+`threads` sets the number of CPU threads of the runtime (None keeps its default).
+
+Indexes record the encoder that built them (Encoder.info). Embeddings can only be
+compared within one CLIP model, so an index is only searched, or re-used when
+re-indexing, with an encoder of the same model: the backends of one model can be
+mixed (an index built with "torch" can be queried through "onnx").
+"""
+import os
+import json
+import time
+import threading
+import numpy as np
+from PIL import Image
+
+# CLIP model used unless another one is chosen
+DEFAULT_MODEL = "ViT-B/32"
+
+BACKENDS = ("torch", "torchscript", "onnx")
+
+# Where clip.load keeps the weights it downloads
+CLIP_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "clip")
+
+# Indexes saved before encoders were recorded were all built with this one
+LEGACY_ENCODER = {"model": DEFAULT_MODEL, "backend": "torch"}
+
+# CLIP's input resolution and normalization constants
+CLIP_INPUT_SIZE = 224
+CLIP_MEAN = np.array([0.48145466, 0.4578275, 0.40821073], dtype=np.float32)
+CLIP_STD = np.array([0.26862954, 0.26130258, 0.27577711], dtype=np.float32)
+
+class EncoderMismatch(ValueError):
+    """Raised when embeddings of different encoders would be compared."""
+
+def clip_preprocess(image, size=CLIP_INPUT_SIZE):
+    """
+    NumPy version of CLIP's preprocessing (bicubic resize of the short side, centre
+    crop, normalization) of an RGB PIL image; returns a (3, size, size) float32 array.
+    """
+    width, height = image.size
+    scale = size / min(width, height)
+    image = image.resize((max(size, round(width * scale)), max(size, round(height * scale))), Image.BICUBIC)
+    left = (image.width - size) // 2
+    top = (image.height - size) // 2
+    image = image.crop((left, top, left + size, top + size))
+    pixels = np.asarray(image, dtype=np.float32) / 255.0
+    return ((pixels - CLIP_MEAN) / CLIP_STD).transpose(2, 0, 1)
+
+def tokenize(texts):
+    """CLIP's tokenizer, as an (N, 77) int64 array (long queries are truncated)."""
+    import clip
+    return np.asarray(clip.tokenize(list(texts), truncate=True).numpy(), dtype=np.int64)
+
+def _normalize(x):
+    x = np.asarray(x, dtype=np.float32)
+    return x / np.maximum(np.linalg.norm(x, axis=-1, keepdims=True), 1e-12)
+
+def compatible(info, other):
+    """True if embeddings of the two encoders (Encoder.info dicts) can be compared."""
+    info, other = info or LEGACY_ENCODER, other or LEGACY_ENCODER
+    if info.get("model") != other.get("model"):
+        return False
+    return info.get("dim") is None or other.get("dim") is None or info["dim"] == other["dim"]
+
+def describe(info):
+    info = info or LEGACY_ENCODER
+    return info.get("name") or f"{info['model']} ({info['backend']})"
+
+class Encoder:
+    """
+    Base class of the backends. The model is loaded on the first call to load()
+    (once, even when several threads ask at the same time); the encode methods
+    expect it to be loaded.
+    """
+
+    backend = None
+
+    def __init__(self, model=DEFAULT_MODEL, threads=None):
+        self.model = model
+        self.threads = threads
+        self.dim = None
+        self.load_seconds = None
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    @property
+    def name(self):
+        return f"{self.model} ({self.backend})"
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    def info(self):
+        """What an index records about the encoder that built it."""
+        return {"model": self.model, "backend": self.backend, "name": self.name, "dim": self.dim}
+
+    def load(self):
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    start = time.perf_counter()
+                    self._load()
+                    self.load_seconds = time.perf_counter() - start
+                    self._loaded = True
+        return self
+
+    def _load(self):
+        raise NotImplementedError
+
+    def available_offline(self):
+        """True if load() needs nothing from the network (exported models are local files)."""
+        return True
+
+    def preprocess(self, image):
+        raise NotImplementedError
+
+    def encode_images(self, inputs):
+        """Normalized embeddings of a list of preprocessed images, in the backend's own array type."""
+        raise NotImplementedError
+
+    def to_numpy(self, embeddings):
+        """The result of encode_images as an (N, D) float32 NumPy array."""
+        return np.asarray(embeddings, dtype=np.float32)
+
+    def encode_texts(self, texts):
+        """Normalized (N, D) float32 embeddings of a list of text queries."""
+        raise NotImplementedError
+
+class ClipEncoder(Encoder):
+    """CLIP in eager PyTorch; with `quantize`, dynamic int8 weights on the CPU."""
+
+    backend = "torch"
+
+    def __init__(self, model=DEFAULT_MODEL, threads=None, device=None, quantize=False):
+        super().__init__(model, threads)
+        self.device = device
+        self.quantize = quantize
+
+    @property
+    def name(self):
+        return f"{self.model} (torch, int8)" if self.quantize else f"{self.model} (torch)"
+
+    def info(self):
+        return dict(super().info(), quantized=self.quantize)
+
+    def available_offline(self):
+        """True if the weights are a local file or already in clip.load's download cache."""
+        if os.path.isfile(self.model):
+            return True
+        try:
+            import clip
+        except ImportError:
+            return False
+        url = getattr(getattr(clip, "clip", None), "_MODELS", {}).get(self.model)
+        return url is not None and os.path.isfile(os.path.join(CLIP_CACHE_DIR, os.path.basename(url)))
+
+    def _load(self):
+        import torch
+        import clip
+        if self.threads:
+            torch.set_num_threads(self.threads)
+        if self.device is None:
+            # Dynamic quantization only has CPU kernels
+            self.device = "cuda" if torch.cuda.is_available() and not self.quantize else "cpu"
+        model, self._preprocess = clip.load(self.model, device=self.device)
+        model.eval()
+        if self.quantize:
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        self._model = model
+        self.dim = int(model.visual.output_dim) if hasattr(model, "visual") else None
+
+    def preprocess(self, image):
+        return self._preprocess(image)
+
+    def encode_images(self, inputs):
+        import torch
+        image_input = torch.stack(inputs).to(self.device)
+        # Compute the embeddings (no gradient calculation needed)
+        with torch.no_grad():
+            embeddings = self._model.encode_image(image_input)
+        # Normalize the embeddings for consistent similarity comparisons
+        embeddings = embeddings / embeddings.norm(dim=-1, keepdim=True)
+        if self.device == "cuda":
+            # CUDA runs asynchronously; wait so the forward pass is not counted as host copy
+            torch.cuda.synchronize()
+        return embeddings
+
+    def to_numpy(self, embeddings):
+        # Move them to CPU memory (as a NumPy array)
+        return embeddings.cpu().float().numpy()
+
+    def encode_texts(self, texts):
+        import torch
+        import clip
+        # Tokenize the queries and compute their embeddings using CLIP's text encoder.
+        text_tokens = clip.tokenize(list(texts), truncate=True).to(self.device)
+        with torch.no_grad():
+            text_embeddings = self._model.encode_text(text_tokens)
+        # Normalize the text embeddings to ensure consistent similarity comparisons.
+        text_embeddings = text_embeddings / text_embeddings.norm(dim=-1, keepdim=True)
+        return text_embeddings.cpu().float().numpy()
+
+class ExportedEncoder(Encoder):
+    """An image and a text tower exported by export_model, with NumPy pre- and post-processing."""
+
+    extension = None
+
+    def __init__(self, path, threads=None):
+        with open(os.path.join(path, "encoder.json"), "r", encoding="utf-8") as f:
+            config = json.load(f)
+        super().__init__(config["model"], threads)
+        self.path = path
+        self.dim = config.get("dim")
+        self.image_size = config.get("image_size", CLIP_INPUT_SIZE)
+
+    def tower(self, name):
+        return os.path.join(self.path, f"{name}.{self.extension}")
+
+    def preprocess(self, image):
+        return clip_preprocess(image, self.image_size)
+
+    def to_numpy(self, embeddings):
+        return _normalize(embeddings)
+
+    def encode_texts(self, texts):
+        return self.to_numpy(self._run(self._text, tokenize(texts)))
+
+    def encode_images(self, inputs):
+        return self._run(self._image, np.stack(inputs).astype(np.float32))
+
+class TorchScriptEncoder(ExportedEncoder):
+    backend = "torchscript"
+    extension = "pt"
+
+    def _load(self):
+        import torch
+        if self.threads:
+            torch.set_num_threads(self.threads)
+        self._image = torch.jit.load(self.tower("image"), map_location="cpu").eval()
+        self._text = torch.jit.load(self.tower("text"), map_location="cpu").eval()
+
+    def _run(self, module, array):
+        import torch
+        with torch.no_grad():
+            return module(torch.from_numpy(array)).float().numpy()
+
+class OnnxEncoder(ExportedEncoder):
+    backend = "onnx"
+    extension = "onnx"
+
+    def _load(self):
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        if self.threads:
+            options.intra_op_num_threads = self.threads
+        providers = ["CPUExecutionProvider"]
+        self._image = onnxruntime.InferenceSession(self.tower("image"), options, providers=providers)
+        self._text = onnxruntime.InferenceSession(self.tower("text"), options, providers=providers)
+
+    def _run(self, session, array):
+        return session.run(None, {session.get_inputs()[0].name: array})[0]
+
+def create_encoder(backend="torch", model=DEFAULT_MODEL, path=None, threads=None, quantize=False, device=None):
+    """
+    Returns an encoder of a backend: "torch" runs the CLIP `model` (int8 weights with
+    `quantize`), "torchscript" and "onnx" run the model exported to `path`.
+    """
+    if backend == "torch":
+        return ClipEncoder(model, threads=threads, device=device, quantize=quantize)
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown encoder backend: {backend}")
+    if path is None:
+        raise ValueError(f"The {backend} backend needs the directory of an exported model")
+    if quantize:
+        raise ValueError("Quantize the model when exporting it (export_model(..., quantize=True))")
+    return (TorchScriptEncoder if backend == "torchscript" else OnnxEncoder)(path, threads=threads)
+
+def export_model(path, backend="onnx", model=DEFAULT_MODEL, quantize=False):
+    """
+    Exports the image and text towers of a CLIP model to `path` for the
+    "torchscript" or "onnx" backend. With `quantize` (TorchScript only), the
+    exported towers use dynamic int8 weights.
+    """
+    import torch
+    import clip
+
+    if backend not in ("torchscript", "onnx"):
+        raise ValueError(f"Cannot export for the {backend} backend")
+    clip_model, _ = clip.load(model, device="cpu")
+    clip_model.eval()
+    if quantize:
+        if backend == "onnx":
+            raise ValueError("Dynamic int8 weights cannot be exported to ONNX; quantize the ONNX model instead")
+        clip_model = torch.ao.quantization.quantize_dynamic(clip_model, {torch.nn.Linear}, dtype=torch.qint8)
+
+    class ImageTower(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.clip = clip_model
+
+        def forward(self, image):
+            return self.clip.encode_image(image)
+
+    class TextTower(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.clip = clip_model
+
+        def forward(self, tokens):
+            return self.clip.encode_text(tokens)
+
+    size = clip_model.visual.input_resolution
+    examples = {"image": (ImageTower(), torch.zeros(1, 3, size, size)),
+                "text": (TextTower(), clip.tokenize(["a photo"]))}
+    os.makedirs(path, exist_ok=True)
+    with torch.no_grad():
+        for name, (tower, example) in examples.items():
+            file_name = os.path.join(path, f"{name}.{'pt' if backend == 'torchscript' else 'onnx'}")
+            if backend == "torchscript":
+                torch.jit.trace(tower, example).save(file_name)
+            else:
+                torch.onnx.export(tower, example, file_name, input_names=[name], output_names=["embedding"],
+                                  dynamic_axes={name: {0: "batch"}, "embedding": {0: "batch"}}, opset_version=14)
+    with open(os.path.join(path, "encoder.json"), "w", encoding="utf-8") as f:
+        json.dump({"model": model, "dim": int(clip_model.visual.output_dim), "image_size": size,
+                   "quantized": quantize}, f, indent=2)
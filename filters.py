@@ -0,0 +1,181 @@
+"""
+Metadata filters for SnapSeek searches.
+
+A Filter limits a search to the images whose metadata matches it: capture date,
+camera, folder, file type and file size. It is evaluated as a boolean mask over
+the columns of an EmbeddingStore (see store.py) and over its path blob, all with
+vectorized NumPy operations, and only the matching rows are scored afterwards,
+so the more selective a filter is, the cheaper the search.
+
+Filters can be written into the search text as `key:value` terms:
+    beach at sunset after:2023-06-01 before:2023-09-01 camera:canon type:jpg,png
+  - after:DATE / before:DATE  taken on or after DATE / before DATE (YYYY, YYYY-MM,
+                              YYYY-MM-DD or YYYY-MM-DDTHH:MM); images without an
+                              EXIF date go by their modification time
+  - camera:TEXT               EXIF make or model contains TEXT (case-insensitive)
+  - folder:PATH               below PATH (repeat the term for several folders)
+  - type:EXT[,EXT...]         file extension
+  - larger:SIZE / smaller:SIZE  file size, e.g. 500KB or 2MB
+Values with spaces are quoted: camera:"eos 5d".
+"""
+import os
+import re
+import copy
+from datetime import datetime
+import numpy as np
+
+# Units accepted in sizes (larger:/smaller:)
+SIZE_UNITS = {"": 1, "b": 1, "kb": 1024, "mb": 1024 ** 2, "gb": 1024 ** 3}
+
+# A `key:value` term of the search text; the value is a quoted string or runs up to the next space
+_TERM = re.compile(r'(?<!\S)(after|before|camera|folder|type|larger|smaller):("[^"]*"|\S+)', re.IGNORECASE)
+_DATE_FORMATS = ("%Y-%m-%dT%H:%M", "%Y-%m-%d %H:%M", "%Y-%m-%d", "%Y-%m", "%Y")
+
+def parse_date(text):
+    """Seconds since the epoch of a local date or date and time (see _DATE_FORMATS)."""
+    for date_format in _DATE_FORMATS:
+        try:
+            return datetime.strptime(text, date_format).timestamp()
+        except ValueError:
+            pass
+    raise ValueError(f"Invalid date: {text} (expected YYYY-MM-DD)")
+
+def parse_size(text):
+    """Bytes of a size such as 500KB, 2mb or 1024."""
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([kmg]?b?)\s*", text, re.IGNORECASE)
+    if match is None:
+        raise ValueError(f"Invalid size: {text} (expected e.g. 500KB or 2MB)")
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).lower()])
+
+class Filter:
+    """
+    Conditions on image metadata, all of which must hold (folders and extensions
+    each match any of theirs). Unset conditions are not checked; a Filter without
+    any condition matches everything. `exclude` lists files left out whatever their
+    metadata (e.g. the examples of a query by example), and `exclude_hashes` the
+    content hashes (store.content_hash) of files left out wherever they are.
+    """
+
+    def __init__(self, after=None, before=None, camera=None, folders=None, extensions=None,
+                 min_size=None, max_size=None, exclude=None, exclude_hashes=None):
+        self.after = after
+        self.before = before
+        self.camera = camera.lower() if camera else None
+        self.folders = [os.path.abspath(folder) for folder in folders or ()]
+        self.extensions = ["." + extension.lower().lstrip(".") for extension in extensions or ()]
+        self.min_size = min_size
+        self.max_size = max_size
+        self.exclude = list(exclude or ())
+        self.exclude_hashes = list(exclude_hashes or ())
+
+    @classmethod
+    def parse(cls, text):
+        """Builds a Filter from `key:value` terms (see the module docstring)."""
+        query, where = split_query(text)
+        if query:
+            raise ValueError(f"Not a filter term: {query}")
+        return where
+
+    def __bool__(self):
+        return any((self.after is not None, self.before is not None, self.camera, self.folders, self.extensions,
+                    self.min_size is not None, self.max_size is not None, self.exclude, self.exclude_hashes))
+
+    def __repr__(self):
+        return f"Filter({', '.join(f'{name}={value!r}' for name, value in vars(self).items() if value)})"
+
+    def excluding(self, paths, hashes=()):
+        """A copy of this filter that also leaves out `paths` and the files with content `hashes`."""
+        where = copy.copy(self)
+        where.exclude = self.exclude + list(paths)
+        where.exclude_hashes = self.exclude_hashes + list(hashes)
+        return where
+
+    def covers_folder(self, folder):
+        """False if no image below `folder` can match (the folder is outside every filter folder)."""
+        if not self.folders:
+            return True
+        folder = os.path.normcase(os.path.abspath(folder))
+        for wanted in self.folders:
+            wanted = os.path.normcase(wanted)
+            # Either folder may lie inside the other
+            if (folder + os.sep).startswith(wanted.rstrip(os.sep) + os.sep) or \
+                    (wanted + os.sep).startswith(folder.rstrip(os.sep) + os.sep):
+                return True
+        return False
+
+    def mask(self, embedding_store):
+        """
+        (N,) boolean mask of the rows of an EmbeddingStore that match, or None if the
+        filter has no condition. Conditions on columns the store lacks match nothing.
+        """
+        if not self:
+            return None
+        mask = np.ones(len(embedding_store), dtype=bool)
+
+        if self.after is not None or self.before is not None:
+            taken, mtime = embedding_store.column("taken"), embedding_store.column("mtime")
+            if taken is None and mtime is None:
+                mask[:] = False
+            else:
+                dates = mtime if taken is None else taken if mtime is None else np.where(taken > 0, taken, mtime)
+                if self.after is not None:
+                    mask &= dates >= self.after
+                if self.before is not None:
+                    mask &= dates < self.before
+        if self.min_size is not None or self.max_size is not None:
+            sizes = embedding_store.column("size")
+            if sizes is None:
+                mask[:] = False
+            else:
+                if self.min_size is not None:
+                    mask &= sizes >= self.min_size
+                if self.max_size is not None:
+                    mask &= sizes <= self.max_size
+        if self.camera:
+            cameras = embedding_store.column("camera")
+            if cameras is None:
+                mask[:] = False
+            elif mask.any():
+                rows = np.flatnonzero(mask)
+                mask[rows] = np.char.find(cameras[rows], self.camera.encode("utf-8")) >= 0
+        paths = embedding_store.path_list
+        if self.extensions and mask.any():
+            mask &= np.logical_or.reduce([paths.endswith(extension, ignore_case=True) for extension in self.extensions])
+        if self.folders and mask.any():
+            # Folders compare like covers_folder does: case-insensitively where paths are (Windows)
+            ignore_case = os.path.normcase("A") == "a"
+            mask &= np.logical_or.reduce([paths.startswith(folder.rstrip(os.sep) + os.sep, ignore_case=ignore_case)
+                                          for folder in self.folders])
+        for path in self.exclude:
+            # Indexed as given or as an absolute path
+            for candidate in dict.fromkeys((path, os.path.abspath(path))):
+                row = paths.find(candidate)
+                if row is not None:
+                    mask[row] = False
+        hashes = embedding_store.column("hash")
+        if self.exclude_hashes and hashes is not None and mask.any():
+            mask &= ~np.isin(hashes, np.array(self.exclude_hashes, dtype=hashes.dtype))
+        return mask
+
+def split_query(text):
+    """
+    Splits search text into the query proper and a Filter of its `key:value` terms
+    (see the module docstring). Raises ValueError for a term with an invalid value.
+    """
+    options = {"folders": [], "extensions": []}
+    for match in _TERM.finditer(text):
+        key, value = match.group(1).lower(), match.group(2).strip('"')
+        if key in ("after", "before"):
+            options[key] = parse_date(value)
+        elif key == "camera":
+            options["camera"] = value
+        elif key == "folder":
+            options["folders"].append(value)
+        elif key == "type":
+            options["extensions"].extend(extension for extension in value.split(",") if extension)
+        elif key == "larger":
+            options["min_size"] = parse_size(value)
+        else:
+            options["max_size"] = parse_size(value)
+    query = " ".join(_TERM.sub(" ", text).split())
+    return query, Filter(**options)
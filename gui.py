@@ -1,177 +1,341 @@
+import time
+# Taken before the heavy imports so the reported startup time covers them too
+_START_TIME = time.perf_counter()
+
 import sys
 import os
+import threading
+from collections import OrderedDict, deque
 from PyQt5.QtCore import (
-    Qt, QThread, pyqtSignal, QSize, QUrl
+    Qt, QThread, pyqtSignal, QSize, QUrl, QObject, QRunnable, QThreadPool,
+    QAbstractListModel, QModelIndex, QRect, QTimer
 )
 from PyQt5.QtGui import (
-    QPixmap, QImage, QDesktopServices, QIcon, QFont
+    QPixmap, QImage, QDesktopServices, QIcon, QFont, QColor, QPainter, QPainterPath
 )
 from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
     QPushButton, QLabel, QLineEdit, QFileDialog, QMessageBox,
-    QScrollArea, QGridLayout, QProgressDialog, QSpacerItem,
-    QSizePolicy, QFrame
+    QProgressDialog, QSizePolicy, QListView, QStyledItemDelegate, QStyle, QPlainTextEdit, QCheckBox, QMenu
 )
-from PIL import Image
 
 # ----------------------------------------------------
 #   Import your indexing/search logic from main.py
 # ----------------------------------------------------
-from main import index_images, search_images  # Ensure these are implemented
+from main import iter_index_images, search_images, search_similar, load_model, text_cache, metrics  # Ensure these are implemented
+from main import SEARCH_THRESHOLD
+from calibration import Cutoff
+from profiling import format_stages
+from library import Library
+from watcher import FolderWatcher
+from thumbnails import ThumbnailCache
 
 # ----------------------------------------------------
 #               Worker Threads
 # ----------------------------------------------------
 class IndexWorker(QThread):
-    """Indexes images in a given folder in a background thread."""
-    finished = pyqtSignal(object, str)  # (embeddings, folder_path)
+    """
+    Indexes images in a given folder in a background thread, reporting progress
+    (with the partial, already searchable results) after every batch. A folder
+    watcher that was stopped for this run (`stopped_watcher`) is waited for first,
+    so an update it is still saving lands before the index is read and saved again.
+    """
+    progress = pyqtSignal(object)        # IndexProgress
+    finished = pyqtSignal(object, str)   # (embeddings, folder_path)
+    cancelled = pyqtSignal(object, str)  # (embeddings indexed before the cancel, folder_path)
     error = pyqtSignal(str)
     
-    def __init__(self, folder_path):
+    def __init__(self, folder_path, stopped_watcher=None):
         super().__init__()
         self.folder_path = folder_path
+        self.stopped_watcher = stopped_watcher
+        self.cancel_event = threading.Event()
+    
+    def cancel(self):
+        """Asks the indexing to stop after the current image."""
+        self.cancel_event.set()
     
     def run(self):
         try:
-            embeddings = index_images(self.folder_path)
-            self.finished.emit(embeddings, self.folder_path)
+            if self.stopped_watcher is not None:
+                self.stopped_watcher.stop(wait=True)
+            for progress in iter_index_images(self.folder_path, cancel_event=self.cancel_event, isolate=True):
+                if not progress.finished:
+                    self.progress.emit(progress)
+            if progress.cancelled:
+                self.cancelled.emit(progress.results, self.folder_path)
+            else:
+                self.finished.emit(progress.results, self.folder_path)
         except Exception as e:
             self.error.emit(str(e))
 
+class ModelLoader(QThread):
+    """Loads the CLIP model in the background so the window can show up right away."""
+    loaded = pyqtSignal(float)  # load time in seconds
+    error = pyqtSignal(str)
+    
+    def run(self):
+        try:
+            start = time.perf_counter()
+            load_model()
+            self.loaded.emit(time.perf_counter() - start)
+        except Exception as e:
+            self.error.emit(str(e))
+
+# Results fetched per search; the next page is loaded when the view scrolls to the end
+RESULTS_PAGE_SIZE = 200
+
+# Results end where they stop standing out for the query: at least this many standard
+# deviations above its mean similarity to the library (see calibration.py)
+SEARCH_CUTOFF = Cutoff(min_z=2.0)
+
 class SearchWorker(QThread):
-    """Performs search on the already indexed embeddings in a background thread."""
-    finished = pyqtSignal(object, str)  # (results, query)
+    """
+    Performs search on the already indexed embeddings (a Library) in a background thread:
+    a text search, or with `example` a search for images similar to that image (mixed
+    with the text query, if any). Returns one page of results, starting at `offset`.
+    """
+    finished = pyqtSignal(object, str, int, bool)  # (results, query, offset, more results available)
     error = pyqtSignal(str)
     
-    def __init__(self, query, embeddings):
+    def __init__(self, query, embeddings, group_duplicates=False, example=None, offset=0):
         super().__init__()
         self.query = query
         self.embeddings = embeddings
+        self.group_duplicates = group_duplicates
+        self.example = example
+        self.offset = offset
+        # What the results header shows
+        self.label = query
+        if example is not None:
+            name = os.path.basename(example)
+            self.label = f"images like {name} + {query}" if query else f"images like {name}"
     
     def run(self):
         try:
-            # Instead of a fixed 5, set top_k to the total number of images
-            results = search_images(self.query, self.embeddings, top_k=len(self.embeddings))
-            self.finished.emit(results, self.query)
+            # One result past the page tells whether there is another page
+            options = dict(top_k=RESULTS_PAGE_SIZE + 1, collapse=self.group_duplicates,
+                           near_duplicates=self.group_duplicates, threshold=SEARCH_THRESHOLD,
+                           cutoff=SEARCH_CUTOFF, offset=self.offset)
+            if self.example is not None:
+                results = search_similar(self.example, self.embeddings, text=self.query or None, **options)
+            else:
+                results = search_images(self.query, self.embeddings, **options)
+            if not self.group_duplicates:
+                results = [(path, score, []) for path, score in results]
+            self.finished.emit(results[:RESULTS_PAGE_SIZE], self.label, self.offset,
+                               len(results) > RESULTS_PAGE_SIZE)
         except Exception as e:
             self.error.emit(str(e))
 
 # ----------------------------------------------------
-#         ClickableLabel for clickable thumbnails
+#          Thumbnail Loading (off the GUI thread)
 # ----------------------------------------------------
-class ClickableLabel(QLabel):
-    """A QLabel that emits a signal when clicked."""
-    clicked = pyqtSignal(str)
+# Size of the preview drawn in each result card
+PREVIEW_SIZE = 260
 
-    def __init__(self, image_path, parent=None):
-        super().__init__(parent)
-        self.image_path = image_path
+# Decoded previews kept in memory (scrolling back does not reload them)
+PIXMAP_CACHE_ENTRIES = 600
+
+# Shared on-disk thumbnail cache
+thumbnail_cache = ThumbnailCache()
+
+class ThumbnailSignals(QObject):
+    """QRunnable cannot emit signals itself, so the tasks share this object."""
+    loaded = pyqtSignal(str, QImage)  # (image path, preview; null QImage on failure)
 
-    def mousePressEvent(self, event):
-        if event.button() == Qt.LeftButton:
-            self.clicked.emit(self.image_path)
-        super().mousePressEvent(event)
+class WatcherSignals(QObject):
+    """Carries the updates of the folder watchers (which run on their own threads) to the GUI thread."""
+    updated = pyqtSignal(str, object, int, object)  # (folder, updated embeddings, files changed, watcher)
+
+class ThumbnailTask(QRunnable):
+    """Loads one preview from the thumbnail cache on a thread-pool thread."""
+    
+    def __init__(self, image_path, signals):
+        super().__init__()
+        self.image_path = image_path
+        self.signals = signals
+    
+    def run(self):
+        try:
+            pil_image = thumbnail_cache.get(self.image_path)
+            pil_image.thumbnail((PREVIEW_SIZE, PREVIEW_SIZE))
+            pil_image = pil_image.convert("RGBA")
+            data = pil_image.tobytes("raw", "RGBA")
+            # QImage (unlike QPixmap) may be built off the GUI thread; copy() detaches it from `data`
+            qimage = QImage(data, pil_image.width, pil_image.height, QImage.Format_RGBA8888).copy()
+        except Exception:
+            qimage = QImage()
+        self.signals.loaded.emit(self.image_path, qimage)
 
 # ----------------------------------------------------
-#          ImageCard Widget
+#          Results Model / Delegate
 # ----------------------------------------------------
-class ImageCard(QWidget):
+# Item data role holding the (image_path, similarity, alternate paths) of a result
+ResultRole = Qt.UserRole + 1
+
+class ResultsModel(QAbstractListModel):
     """
-    A widget that holds:
-      - A clickable image preview.
-      - A title label with an arrow icon button beside it.
-      - An optional similarity label.
-    Clicking the arrow icon (or the image) will trigger navigation to the image location.
+    List model over the search results. The view only asks for the rows it shows,
+    so previews are only requested (and decoded in the thread pool) for visible rows.
+    Results come in pages: when the view reaches the last row and there are more,
+    more_requested asks the window for the next page.
     """
-    clicked = pyqtSignal(str)  # Signal to open the image location.
-
-    def __init__(self, image_path="", title="Image Name", similarity=None, parent=None):
+    more_requested = pyqtSignal()
+    
+    def __init__(self, parent=None):
         super().__init__(parent)
-        self.image_path = image_path
-        self.title = title
-        self.similarity = similarity
-        
-        # Main layout.
-        layout = QVBoxLayout()
-        layout.setSpacing(5)
-        layout.setContentsMargins(10, 10, 10, 10)
-        
-        # Clickable image label.
-        self.image_label = ClickableLabel(self.image_path)
-        self.image_label.setAlignment(Qt.AlignCenter)
-        self.image_label.setObjectName("ImagePreview")
-        self.image_label.clicked.connect(self.on_image_clicked)
-        
-        # Load thumbnail (or fallback).
-        pixmap = self._load_thumbnail(self.image_path)
-        self.image_label.setPixmap(pixmap)
-        layout.addWidget(self.image_label)
-        
-        # Title area with arrow icon.
-        title_layout = QHBoxLayout()
-        
-        # Title label.
-        self.title_label = QLabel(self.title)
-        self.title_label.setObjectName("ImageTitle")
-        self.title_label.setAlignment(Qt.AlignLeft | Qt.AlignVCenter)
-        title_layout.addWidget(self.title_label)
-        
-        # Arrow icon button.
-        self.arrow_button = QPushButton()
-        self.arrow_button.setObjectName("ArrowButton")
-        self.arrow_button.setIcon(QIcon("arrow.png"))
-        self.arrow_button.setIconSize(QSize(16, 16))
-        self.arrow_button.setFlat(True)  # Remove the button border.
-        self.arrow_button.clicked.connect(self.on_arrow_clicked)
-        title_layout.addWidget(self.arrow_button)
-        
-        layout.addLayout(title_layout)
-        
-        # Optional: similarity label.
-        if self.similarity is not None:
-            self.similarity_label = QLabel(f"Similarity: {self.similarity:.4f}")
-            self.similarity_label.setAlignment(Qt.AlignCenter)
-            self.similarity_label.setStyleSheet("color: #BBBBBB; font-size: 12px;")
-            layout.addWidget(self.similarity_label)
-        
-        # Styling for the card.
-        self.setObjectName("ImageCardFrame")
-        self.setLayout(layout)
-    
-    def on_image_clicked(self, path):
-        """Relay the click signal so the parent can handle navigation."""
-        self.clicked.emit(path)
-    
-    def on_arrow_clicked(self):
-        """Triggered when the arrow icon is clicked. Emits the same signal."""
-        self.clicked.emit(self.image_path)
-    
-    def _load_thumbnail(self, path):
-        """Load and scale the image for display."""
-        if os.path.exists(path):
-            try:
-                pil_image = Image.open(path)
-                # Increase the thumbnail size for a larger preview
-                pil_image.thumbnail((600, 600))
-                pil_image = pil_image.convert("RGBA")
-                data = pil_image.tobytes("raw", "RGBA")
-                qimage = QImage(data, pil_image.width, pil_image.height, QImage.Format_RGBA8888)
-                pixmap = QPixmap.fromImage(qimage)
-            except Exception:
-                pixmap = QPixmap(400, 400)
-                pixmap.fill(Qt.darkGray)
-        else:
-            pixmap = QPixmap(400, 400)
+        self.results = []
+        self.rows_by_path = {}
+        self.has_more = False
+        self.pixmaps = OrderedDict()  # image path -> QPixmap (least recently used first)
+        self.requested = set()
+        
+        self.thread_pool = QThreadPool(self)
+        self.thread_pool.setMaxThreadCount(max(2, min(4, os.cpu_count() or 1)))
+        self.signals = ThumbnailSignals()
+        self.signals.loaded.connect(self.thumbnail_loaded)
+    
+    def set_results(self, results, has_more=False):
+        # Previews queued for the previous results are no longer needed
+        self.thread_pool.clear()
+        self.beginResetModel()
+        self.results = list(results)
+        self.rows_by_path = {}
+        for row, (path, _, _) in enumerate(self.results):
+            self.rows_by_path.setdefault(path, row)
+        self.requested.clear()
+        self.has_more = has_more
+        self.endResetModel()
+    
+    def append_results(self, results, has_more=False):
+        """Adds the next page of results after the current ones."""
+        self.has_more = has_more
+        if not results:
+            return
+        first = len(self.results)
+        self.beginInsertRows(QModelIndex(), first, first + len(results) - 1)
+        self.results.extend(results)
+        for row, (path, _, _) in enumerate(results, first):
+            self.rows_by_path.setdefault(path, row)
+        self.endInsertRows()
+    
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and self.has_more
+    
+    def fetchMore(self, parent=QModelIndex()):
+        if parent.isValid() or not self.has_more:
+            return
+        # Asked again once the page has arrived
+        self.has_more = False
+        self.more_requested.emit()
+    
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.results)
+    
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or index.row() >= len(self.results):
+            return None
+        path, score, alternates = self.results[index.row()]
+        if role == Qt.DisplayRole:
+            return os.path.basename(path)
+        if role == Qt.ToolTipRole:
+            if alternates:
+                return "\n".join([path, "Also at:"] + alternates)
+            return path
+        if role == ResultRole:
+            return (path, score, alternates)
+        if role == Qt.DecorationRole:
+            return self.pixmap(path)
+        return None
+    
+    def pixmap(self, path):
+        """Returns the cached preview, or None after queueing its load."""
+        pixmap = self.pixmaps.get(path)
+        if pixmap is not None:
+            self.pixmaps.move_to_end(path)
+            return pixmap
+        if path not in self.requested:
+            self.requested.add(path)
+            self.thread_pool.start(ThumbnailTask(path, self.signals))
+        return None
+    
+    def thumbnail_loaded(self, path, qimage):
+        if qimage.isNull():
+            pixmap = QPixmap(PREVIEW_SIZE, PREVIEW_SIZE)
             pixmap.fill(Qt.darkGray)
-        
-        # Return a larger scaled pixmap for better visibility
-        return pixmap.scaled(
-            400, 400,
-            Qt.KeepAspectRatio,
-            Qt.SmoothTransformation
-        )
-
+        else:
+            pixmap = QPixmap.fromImage(qimage)
+        self.pixmaps[path] = pixmap
+        while len(self.pixmaps) > PIXMAP_CACHE_ENTRIES:
+            evicted, _ = self.pixmaps.popitem(last=False)
+            # Evicted previews are loaded again if their row comes back into view
+            self.requested.discard(evicted)
+        row = self.rows_by_path.get(path)
+        if row is not None:
+            index = self.index(row)
+            self.dataChanged.emit(index, index, [Qt.DecorationRole])
 
+class ResultDelegate(QStyledItemDelegate):
+    """
+    Paints a result card: the preview, the file name with the arrow icon beside it,
+    and the similarity score. Clicking a card opens the image location.
+    """
+    CARD_SIZE = QSize(PREVIEW_SIZE + 30, PREVIEW_SIZE + 80)
+    
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.arrow = QIcon("arrow.png").pixmap(16, 16)
+        self.title_font = QFont()
+        self.title_font.setPixelSize(13)
+        self.score_font = QFont()
+        self.score_font.setPixelSize(12)
+    
+    def sizeHint(self, option, index):
+        return self.CARD_SIZE
+    
+    def paint(self, painter, option, index):
+        path, score, alternates = index.data(ResultRole)
+        painter.save()
+        painter.setRenderHint(QPainter.Antialiasing)
+        
+        # Card background
+        card = option.rect.adjusted(5, 5, -5, -5)
+        background = QPainterPath()
+        background.addRoundedRect(card.x(), card.y(), card.width(), card.height(), 8, 8)
+        hovered = option.state & QStyle.State_MouseOver
+        painter.fillPath(background, QColor("#2A3450" if hovered else "#1E2638"))
+        
+        # Preview (a placeholder until the thumbnail arrives)
+        preview_rect = QRect(card.x() + 10, card.y() + 10, card.width() - 20, PREVIEW_SIZE)
+        pixmap = index.data(Qt.DecorationRole)
+        if pixmap is None:
+            painter.fillRect(preview_rect, QColor("#151B29"))
+        else:
+            x = preview_rect.x() + (preview_rect.width() - pixmap.width()) // 2
+            y = preview_rect.y() + (preview_rect.height() - pixmap.height()) // 2
+            painter.drawPixmap(x, y, pixmap)
+        painter.setPen(QColor("#3B4A6A"))
+        painter.drawRect(preview_rect)
+        
+        # Title with the arrow icon beside it
+        title_rect = QRect(card.x() + 10, preview_rect.bottom() + 8, card.width() - 40, 20)
+        painter.setFont(self.title_font)
+        painter.setPen(QColor("#FFFFFF"))
+        title = painter.fontMetrics().elidedText(index.data(Qt.DisplayRole), Qt.ElideMiddle, title_rect.width())
+        painter.drawText(title_rect, Qt.AlignLeft | Qt.AlignVCenter, title)
+        painter.drawPixmap(title_rect.right() + 8, title_rect.y() + 2, self.arrow)
+        
+        # Similarity
+        score_rect = QRect(card.x(), title_rect.bottom() + 4, card.width(), 18)
+        painter.setFont(self.score_font)
+        painter.setPen(QColor("#BBBBBB"))
+        text = f"Similarity: {score:.4f}"
+        if alternates:
+            # Duplicates collapsed into this card (see "Group duplicates")
+            text += f"  (+{len(alternates)} {'copy' if len(alternates) == 1 else 'copies'})"
+        painter.drawText(score_rect, Qt.AlignCenter, text)
+        painter.restore()
 
 # ----------------------------------------------------
 #                  Main Window
@@ -187,8 +351,24 @@ class SnapSeek(QMainWindow):
         # Set the window icon to logo.png
         self.setWindowIcon(QIcon("logo.png"))
         
-        # Will hold the image embeddings after indexing
-        self.embeddings = None
+        # The indexed folders; each one is a shard that is searched together with the others
+        self.library = Library().open()
+        
+        # Progress dialogs of the running search and indexing (the latter stays None
+        # while a saved index is refreshed in the background)
+        self.progress = None
+        self.index_progress = None
+        self.index_thread = None
+        self.search_thread = None
+        # (query, group duplicates, example) of the results shown, for loading their next page
+        self.search_args = None
+        # Folders waiting to be indexed, one at a time
+        self.index_queue = deque()
+        
+        # Watchers keeping the indexed folders up to date while the app runs
+        self.watchers = {}
+        self.watcher_signals = WatcherSignals()
+        self.watcher_signals.updated.connect(self.watch_updated)
         
         # Central widget
         self.central_widget = QWidget()
@@ -201,22 +381,45 @@ class SnapSeek(QMainWindow):
         # Top section (logo, title, subtitle, select folder & search bar)
         self.init_top_section()
         
-        # Scroll area for image grid
-        self.scroll_area = QScrollArea()
-        self.scroll_area.setWidgetResizable(True)
-        # Set an object name so we can style it
-        self.scroll_area.setObjectName("ResultsScrollArea")
-        self.main_layout.addWidget(self.scroll_area)
-        
-        # Container for the grid
-        self.grid_container = QWidget()
-        self.grid_container.setObjectName("grid_container")
-        self.image_grid_layout = QGridLayout(self.grid_container)
-        self.image_grid_layout.setSpacing(20)
-        self.scroll_area.setWidget(self.grid_container)
-        
-        # Keep references to cards to avoid garbage collection
-        self.image_cards = []
+        # Header above the results
+        self.results_header = QLabel()
+        self.results_header.setObjectName("ResultsHeader")
+        self.results_header.setAlignment(Qt.AlignCenter)
+        self.results_header.hide()
+        self.main_layout.addWidget(self.results_header)
+        
+        # Results grid: a list view in icon mode only paints the visible cards,
+        # so even tens of thousands of results scroll smoothly
+        self.results_model = ResultsModel(self)
+        self.results_model.more_requested.connect(self.load_more_results)
+        self.results_view = QListView()
+        self.results_view.setObjectName("ResultsView")
+        self.results_view.setViewMode(QListView.IconMode)
+        self.results_view.setResizeMode(QListView.Adjust)
+        self.results_view.setMovement(QListView.Static)
+        self.results_view.setUniformItemSizes(True)
+        self.results_view.setSpacing(10)
+        self.results_view.setMouseTracking(True)
+        self.results_view.setVerticalScrollMode(QListView.ScrollPerPixel)
+        self.results_view.setModel(self.results_model)
+        self.results_view.setItemDelegate(ResultDelegate(self.results_view))
+        self.results_view.clicked.connect(self.result_clicked)
+        # Right-click: find similar images, or open the file location
+        self.results_view.setContextMenuPolicy(Qt.CustomContextMenu)
+        self.results_view.customContextMenuRequested.connect(self.show_result_menu)
+        self.main_layout.addWidget(self.results_view)
+        
+        # Performance panel (toggled by the Stats button): per-stage timings of
+        # indexing and search, and the files that failed or were slow
+        self.stats_panel = QPlainTextEdit()
+        self.stats_panel.setObjectName("StatsPanel")
+        self.stats_panel.setReadOnly(True)
+        self.stats_panel.setMaximumHeight(180)
+        self.stats_panel.hide()
+        self.main_layout.addWidget(self.stats_panel)
+        self.stats_timer = QTimer(self)
+        self.stats_timer.setInterval(1000)
+        self.stats_timer.timeout.connect(self.refresh_stats)
         
         # Apply style sheet
         self.apply_styles()
@@ -252,19 +455,29 @@ class SnapSeek(QMainWindow):
         # --- Search Area Row: Select Folder button, Search bar, and Search button ---
         search_container = QHBoxLayout()
         
-        # Select Folder button with icon (now on the left side)
-        self.select_folder_btn = QPushButton(" Select Folder")
+        # Add Folder button with icon (now on the left side)
+        self.select_folder_btn = QPushButton(" Add Folder")
         self.select_folder_btn.setObjectName("SelectFolderButton")
         self.select_folder_btn.setIcon(QIcon("open-folder.png"))
         self.select_folder_btn.setIconSize(QSize(16, 16))
         self.select_folder_btn.clicked.connect(self.select_folder)
         search_container.addWidget(self.select_folder_btn)
         
+        # Library menu: the indexed folders, to refresh or remove them
+        self.library_btn = QPushButton("Library")
+        self.library_btn.setObjectName("LibraryButton")
+        self.library_menu = QMenu(self)
+        self.library_menu.aboutToShow.connect(self.build_library_menu)
+        self.library_btn.setMenu(self.library_menu)
+        search_container.addWidget(self.library_btn)
+        
         search_container.addSpacing(10)  # Optional spacing between the button and search bar
         
         # Search bar
         self.search_bar = QLineEdit()
         self.search_bar.setPlaceholderText("Search...")
+        self.search_bar.setToolTip("Narrow the search with filter terms, e.g.\n"
+                                   "beach after:2023-06-01 before:2023-09-01 camera:canon type:jpg folder:D:/Photos")
         self.search_bar.setObjectName("SearchBar")
         self.search_bar.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Fixed)
         search_container.addWidget(self.search_bar)
@@ -278,6 +491,27 @@ class SnapSeek(QMainWindow):
         self.search_btn.clicked.connect(self.perform_search)
         search_container.addWidget(self.search_btn)
         
+        # Query by example: images similar to a picked image (indexed or not)
+        self.by_image_btn = QPushButton("By Image")
+        self.by_image_btn.setObjectName("ByImageButton")
+        self.by_image_btn.setToolTip("Find images similar to an image file (mixed with the search text, if any)")
+        self.by_image_btn.clicked.connect(self.search_by_image)
+        search_container.addWidget(self.by_image_btn)
+        
+        # Show copies of the same photo (backups, exports) as one result
+        self.group_duplicates = QCheckBox("Group duplicates")
+        self.group_duplicates.setObjectName("GroupDuplicates")
+        self.group_duplicates.setChecked(True)
+        search_container.addWidget(self.group_duplicates)
+        
+        # Toggles the performance panel
+        self.stats_btn = QPushButton("Stats")
+        self.stats_btn.setObjectName("StatsButton")
+        self.stats_btn.setToolTip("Show indexing and search timings")
+        self.stats_btn.setCheckable(True)
+        self.stats_btn.toggled.connect(self.toggle_stats)
+        search_container.addWidget(self.stats_btn)
+        
         top_container.addLayout(search_container)
         
         self.main_layout.addLayout(top_container)
@@ -300,7 +534,7 @@ class SnapSeek(QMainWindow):
                 font-size: 14px;
                 color: #cfcfcf;
             }
-            #SelectFolderButton, #SearchButton {
+            #SelectFolderButton, #LibraryButton, #SearchButton, #ByImageButton, #StatsButton {
                 background-color: #2D3956;
                 color: #ffffff;
                 border: none;
@@ -308,9 +542,20 @@ class SnapSeek(QMainWindow):
                 font-size: 14px;
                 border-radius: 4px;
             }
-            #SelectFolderButton:hover, #SearchButton:hover {
+            #SelectFolderButton:hover, #LibraryButton:hover, #SearchButton:hover, #ByImageButton:hover, #StatsButton:hover, #StatsButton:checked {
                 background-color: #3B4A6A;
             }
+            #GroupDuplicates {
+                color: #cfcfcf;
+                font-size: 13px;
+            }
+            #StatsPanel {
+                background-color: #1D2535;
+                color: #cfcfcf;
+                border: none;
+                font-family: Consolas, monospace;
+                font-size: 12px;
+            }
             #SearchBar {
                 background-color: #1D2535;
                 color: #ffffff;
@@ -319,58 +564,228 @@ class SnapSeek(QMainWindow):
                 font-size: 14px;
                 border-radius: 4px;
             }
-            /* Make the scroll area match the app color (transparent to let gradient show) */
-            #ResultsScrollArea {
+            /* Match the results view to the app colors */
+            #ResultsView {
                 background-color: #1D2535;
                 border: none;
             }
-            /* The container inside the scroll area also transparent, so it doesn't appear white */
-            #grid_container {
-                background-color: #1D2535;
-            }
-            #ImageCardFrame {
-                background-color: #1E2638;
-                border-radius: 8px;
-                padding: 10px;
-            }
-            #ImageTitle {
+            #ResultsHeader {
                 color: #ffffff;
-                font-size: 13px;
-            }
-            #ImagePreview {
-                border: 1px solid #3B4A6A;
-                border-radius: 4px;
+                font-size: 16px;
+                font-weight: bold;
             }
         """)
     
+    # ------------------------------------------------
+    #         Startup / Model Warm-up
+    # ------------------------------------------------
+    def warm_model(self):
+        """Reports the startup time and starts loading the model in the background."""
+        startup = time.perf_counter() - _START_TIME
+        print(f"SnapSeek window ready in {startup:.2f}s")
+        self.statusBar().showMessage(f"Ready in {startup:.2f}s with {len(self.library)} image(s) "
+                                     f"from {len(self.library.folders)} folder(s), loading model...")
+        
+        self.model_thread = ModelLoader()
+        self.model_thread.loaded.connect(self.model_loaded)
+        self.model_thread.error.connect(self.model_error)
+        self.model_thread.start()
+        
+        # Library folders without a saved index (e.g. it was deleted) are indexed again,
+        # the others are watched for changes (including those made while the app was closed)
+        for entry in self.library.stats():
+            if entry["images"] is None:
+                self.queue_indexing(entry["folder"])
+            else:
+                self.start_watching(entry["folder"])
+    
+    def model_loaded(self, seconds):
+        print(f"CLIP model loaded in {seconds:.2f}s")
+        self.statusBar().showMessage(f"Model loaded in {seconds:.2f}s", 5000)
+    
+    def model_error(self, error_msg):
+        # Not fatal here: the next index/search retries the load and reports the error
+        self.statusBar().showMessage(f"Could not load model: {error_msg}")
+    
     # ------------------------------------------------
     #         Folder Selection / Indexing
     # ------------------------------------------------
     def select_folder(self):
-        folder = QFileDialog.getExistingDirectory(self, "Select Image Folder")
+        folder = QFileDialog.getExistingDirectory(self, "Add Image Folder")
         if folder:
-            self.progress = QProgressDialog("Indexing images...", None, 0, 0, self)
-            self.progress.setWindowModality(Qt.WindowModal)
-            self.progress.show()
-            
-            self.select_folder_btn.setEnabled(False)
-            self.search_btn.setEnabled(False)
-            self.search_bar.setEnabled(False)
-            
-            self.index_thread = IndexWorker(folder)
-            self.index_thread.finished.connect(self.index_finished)
-            self.index_thread.error.connect(self.worker_error)
-            self.index_thread.start()
+            try:
+                folder = self.library.add(folder)
+            except ValueError as e:
+                QMessageBox.warning(self, "Folder Not Added", str(e))
+                return
+            self.queue_indexing(folder)
+    
+    def build_library_menu(self):
+        self.library_menu.clear()
+        stats = self.library.stats()
+        if not stats:
+            self.library_menu.addAction("No folders yet").setEnabled(False)
+            return
+        for entry in stats:
+            folder = entry["folder"]
+            images = "not indexed" if entry["images"] is None else f"{entry['images']} image(s)"
+            submenu = self.library_menu.addMenu(f"{folder}  ({images})")
+            submenu.addAction("Refresh", lambda folder=folder: self.queue_indexing(folder))
+            submenu.addAction("Remove", lambda folder=folder: self.remove_folder(folder))
+        self.library_menu.addSeparator()
+        self.library_menu.addAction("Refresh All", self.refresh_library)
+    
+    def refresh_library(self):
+        for folder in self.library.folders:
+            self.queue_indexing(folder)
+    
+    def remove_folder(self, folder):
+        if folder in self.index_queue:
+            self.index_queue.remove(folder)
+        if self.is_indexing() and self.index_thread.folder_path == folder:
+            QMessageBox.warning(self, "Folder Busy", f"{folder} is being indexed; cancel that first.")
+            return
+        self.stop_watching(folder)
+        self.library.remove(folder)
+        self.update_search_enabled()
+        self.statusBar().showMessage(f"Removed {folder} from the library", 5000)
+    
+    def queue_indexing(self, folder):
+        """Indexes (or refreshes) a library folder once the folders queued before it are done."""
+        running = self.is_indexing() and self.index_thread.folder_path == folder
+        if not running and folder not in self.index_queue:
+            self.index_queue.append(folder)
+        self.start_next_index()
+    
+    def start_next_index(self):
+        if self.is_indexing() or not self.index_queue:
+            return
+        folder = self.index_queue.popleft()
+        # The full refresh covers whatever the watcher would have picked up
+        stopped_watcher = self.stop_watching(folder)
+        if self.library.shard(folder) is not None:
+            # A saved index is memory-mapped and searchable right away;
+            # it is refreshed in the background instead of behind a modal dialog
+            self.index_progress = None
+            self.statusBar().showMessage(f"Checking {folder} for changes...")
+        else:
+            # Not modal: the images indexed so far can be searched while indexing continues
+            self.index_progress = QProgressDialog(f"Scanning {folder}...", "Cancel", 0, 0, self)
+            self.index_progress.setWindowModality(Qt.NonModal)
+            self.index_progress.setAutoClose(False)
+            self.index_progress.setAutoReset(False)
+            self.index_progress.canceled.connect(self.cancel_indexing)
+            self.index_progress.show()
+        
+        self.index_thread = IndexWorker(folder, stopped_watcher)
+        self.index_thread.progress.connect(self.index_progress_update)
+        self.index_thread.finished.connect(self.index_finished)
+        self.index_thread.cancelled.connect(self.index_cancelled)
+        self.index_thread.error.connect(self.index_error)
+        self.index_thread.start()
+    
+    def update_search_enabled(self):
+        searchable = len(self.library) > 0 and not self.is_searching()
+        self.search_btn.setEnabled(searchable)
+        self.search_bar.setEnabled(searchable)
+        self.by_image_btn.setEnabled(searchable)
+    
+    def is_indexing(self):
+        return self.index_thread is not None and self.index_thread.isRunning()
+    
+    def is_searching(self):
+        return self.search_thread is not None and self.search_thread.isRunning()
+    
+    def index_progress_update(self, progress):
+        if progress.total == 0:
+            return
+        # While the folder is still being walked the total keeps growing
+        found = f"{progress.total}+" if progress.scanning else f"{progress.total}"
+        text = f"Indexed {progress.done} of {found} image(s)"
+        if progress.processed:
+            text += f" - {progress.rate:.1f} images/s"
+        if progress.eta is not None:
+            minutes, seconds = divmod(int(progress.eta), 60)
+            text += f", about {minutes}:{seconds:02d} left"
+        
+        if self.index_progress is None:
+            # Background refresh of a saved index: keep searching the saved one
+            self.statusBar().showMessage(text)
+            return
+        if not self.index_progress.wasCanceled():
+            self.index_progress.setMaximum(progress.total)
+            self.index_progress.setValue(progress.done)
+            self.index_progress.setLabelText(text)
+        
+        # Make the partial results searchable
+        if len(progress.results):
+            self.library.set_shard(self.index_thread.folder_path, progress.results)
+            self.update_search_enabled()
+    
+    def cancel_indexing(self):
+        if self.is_indexing():
+            self.index_thread.cancel()
+            self.statusBar().showMessage("Cancelling indexing...")
     
     def index_finished(self, embeddings, folder):
-        self.embeddings = embeddings
-        self.progress.cancel()
-        self.select_folder_btn.setEnabled(True)
-        self.search_btn.setEnabled(True)
-        self.search_bar.setEnabled(True)
-        
+        self.set_indexed_shard(embeddings, folder)
         num_images = len(embeddings) if embeddings else 0
-        QMessageBox.information(self, "Folder Indexed", f"Indexed {num_images} image(s) from:\n{folder}")
+        if self.index_progress is None:
+            # Background refresh of a saved index
+            self.statusBar().showMessage(f"Index up to date: {num_images} image(s) from {folder}", 5000)
+        else:
+            self.index_progress.cancel()
+            self.index_progress = None
+            QMessageBox.information(self, "Folder Indexed", f"Indexed {num_images} image(s) from:\n{folder}")
+        self.start_watching(folder)
+        self.start_next_index()
+    
+    def index_cancelled(self, embeddings, folder):
+        # What was indexed before the cancel is kept (and saved) and stays searchable
+        self.set_indexed_shard(embeddings, folder)
+        if self.index_progress is not None:
+            self.index_progress.cancel()
+            self.index_progress = None
+        num_images = len(embeddings) if embeddings else 0
+        self.statusBar().showMessage(f"Indexing cancelled: {num_images} image(s) from {folder} are searchable", 5000)
+        self.start_watching(folder)
+        self.start_next_index()
+    
+    def set_indexed_shard(self, embeddings, folder):
+        # The folder may have been removed from the library while it was being indexed
+        if self.library.find(folder) is not None:
+            self.library.set_shard(folder, embeddings)
+        self.update_search_enabled()
+    
+    # ------------------------------------------------
+    #          Live Updates (Folder Watchers)
+    # ------------------------------------------------
+    def start_watching(self, folder):
+        """Follows changes to an indexed library folder and applies them to its shard."""
+        self.stop_watching(folder)
+        embeddings = self.library.shard(folder)
+        if embeddings is None:
+            return
+        emit = lambda updated, paths: self.watcher_signals.updated.emit(folder, updated, len(paths), watcher)
+        watcher = FolderWatcher(folder, embeddings, on_update=emit)
+        self.watchers[folder] = watcher.start()
+    
+    def stop_watching(self, folder):
+        """Stops the folder's watcher, if any, and returns it (None if there was none)."""
+        watcher = self.watchers.pop(folder, None)
+        if watcher is not None:
+            # Don't block the GUI on an update that is being encoded; its result is ignored
+            watcher.stop(wait=False)
+        return watcher
+    
+    def watch_updated(self, folder, embeddings, changed, watcher):
+        # A late update of a watcher that has since been stopped (or replaced) is stale
+        indexing = self.is_indexing() and self.index_thread.folder_path == folder
+        if self.watchers.get(folder) is not watcher or indexing or self.library.find(folder) is None:
+            return
+        self.library.set_shard(folder, embeddings)
+        self.update_search_enabled()
+        self.statusBar().showMessage(f"Updated {changed} file(s) in {folder}", 5000)
     
     # ------------------------------------------------
     #               Perform Search
@@ -380,88 +795,140 @@ class SnapSeek(QMainWindow):
         if not query:
             QMessageBox.warning(self, "Empty Query", "Please enter a search query.")
             return
-        if not self.embeddings:
-            QMessageBox.warning(self, "No Images Indexed", "Please select an image folder first.")
+        self.start_search(query)
+    
+    def search_by_image(self):
+        path, _ = QFileDialog.getOpenFileName(self, "Find Similar Images", "",
+                                              "Images (*.jpg *.jpeg *.png *.bmp *.gif *.tiff *.webp)")
+        if path:
+            self.find_similar(path, self.search_bar.text().strip())
+    
+    def find_similar(self, path, text=""):
+        """Searches for images similar to `path` (an indexed image reuses its stored embedding)."""
+        self.start_search(text, example=path)
+    
+    def start_search(self, query, example=None):
+        if not len(self.library):
+            QMessageBox.warning(self, "No Images Indexed", "Please add an image folder first.")
             return
         
         self.progress = QProgressDialog("Searching...", None, 0, 0, self)
         self.progress.setWindowModality(Qt.WindowModal)
         self.progress.show()
         
-        self.select_folder_btn.setEnabled(False)
+        self.search_args = (query, self.group_duplicates.isChecked(), example)
+        self.run_search_worker(0)
+    
+    def load_more_results(self):
+        """Fetches the page after the results shown (the view scrolled to their end); no progress dialog."""
+        if self.search_args is None or self.is_searching():
+            return
+        self.run_search_worker(len(self.results_model.results))
+    
+    def run_search_worker(self, offset):
         self.search_btn.setEnabled(False)
         self.search_bar.setEnabled(False)
+        self.by_image_btn.setEnabled(False)
         
-        self.search_thread = SearchWorker(query, self.embeddings)
+        query, group_duplicates, example = self.search_args
+        self.search_thread = SearchWorker(query, self.library, group_duplicates, example, offset)
         self.search_thread.finished.connect(self.search_finished)
         self.search_thread.error.connect(self.worker_error)
         self.search_thread.start()
     
-    def search_finished(self, results, query):
-        self.progress.cancel()
-        self.select_folder_btn.setEnabled(True)
-        self.search_btn.setEnabled(True)
-        self.search_bar.setEnabled(True)
-        
-        # Filter the results to only include images with similarity > 0.2
-        filtered_results = [(img_path, score) for (img_path, score) in results if score > 0.22]
-        
-        # You can optionally check if filtered_results is empty and show a message.
-        if not filtered_results:
-            QMessageBox.information(self, "No Results", "No images found with similarity greater than 0.22.")
+    def search_finished(self, results, query, offset, has_more):
+        if self.progress is not None:
+            self.progress.cancel()
+            self.progress = None
+        self.update_search_enabled()
+        
+        if offset:
+            self.results_model.append_results(results, has_more)
+            return
+        # The search engine already dropped the results below the cut-off for this query
+        if not results:
+            QMessageBox.information(self, "No Results", "No images found that match the query closely enough.")
         
-        self.display_results(filtered_results, query)
+        self.display_results(results, query, has_more)
     
     # ------------------------------------------------
     #            Error Handling
     # ------------------------------------------------
+    def index_error(self, error_msg):
+        if self.index_progress is not None:
+            self.index_progress.cancel()
+            self.index_progress = None
+        self.worker_error(error_msg)
+        # The saved index (if any) is still searchable, so keep following the folder
+        self.start_watching(self.index_thread.folder_path)
+        # Go on with the other queued folders
+        self.start_next_index()
+    
     def worker_error(self, error_msg):
-        self.progress.cancel()
+        if self.progress is not None:
+            self.progress.cancel()
         QMessageBox.critical(self, "Error", error_msg)
-        self.select_folder_btn.setEnabled(True)
-        self.search_btn.setEnabled(True)
-        self.search_bar.setEnabled(True)
+        self.update_search_enabled()
     
     # ------------------------------------------------
     #           Display Search Results
     # ------------------------------------------------
-    def display_results(self, results, query):
-        # Clear existing items in the grid
-        for i in reversed(range(self.image_grid_layout.count())):
-            widget = self.image_grid_layout.itemAt(i).widget()
-            if widget is not None:
-                widget.deleteLater()
-        self.image_cards.clear()
-        
-        # Optionally add a row at the top with a header label
-        header = QLabel(f'Search Results for: "{query}"')
-        header.setStyleSheet("color: #ffffff; font-size: 16px; font-weight: bold;")
-        header.setAlignment(Qt.AlignCenter)
-        self.image_grid_layout.addWidget(header, 0, 0, 1, 3)  # spanning 3 columns
-        
-        # Populate with ImageCards
-        row = 1
-        col = 0
-        columns_per_row = 3
-        
-        for (img_path, score) in results:
-            # Title: the file name
-            title = os.path.basename(img_path)
-            
-            card = ImageCard(
-                image_path=img_path,
-                title=title,
-                similarity=score
-            )
-            card.clicked.connect(self.open_image_location)
-            
-            self.image_grid_layout.addWidget(card, row, col)
-            self.image_cards.append(card)
-            
-            col += 1
-            if col >= columns_per_row:
-                col = 0
-                row += 1
+    def display_results(self, results, query, has_more=False):
+        self.results_header.setText(f'Search Results for: "{query}"')
+        self.results_header.show()
+        self.results_model.set_results(results, has_more)
+        self.results_view.scrollToTop()
+    
+    def result_clicked(self, index):
+        path = index.data(ResultRole)[0]
+        self.open_image_location(path)
+    
+    def show_result_menu(self, position):
+        index = self.results_view.indexAt(position)
+        if not index.isValid():
+            return
+        path = index.data(ResultRole)[0]
+        text = self.search_bar.text().strip()
+        menu = QMenu(self)
+        searchable = not self.is_searching()
+        menu.addAction("Find Similar", lambda: self.find_similar(path)).setEnabled(searchable)
+        if text:
+            menu.addAction(f'Find Similar + "{text}"', lambda: self.find_similar(path, text)).setEnabled(searchable)
+        menu.addSeparator()
+        menu.addAction("Open File Location", lambda: self.open_image_location(path))
+        menu.exec_(self.results_view.viewport().mapToGlobal(position))
+    
+    # ------------------------------------------------
+    #              Performance Panel
+    # ------------------------------------------------
+    def toggle_stats(self, checked):
+        self.stats_panel.setVisible(checked)
+        if checked:
+            self.refresh_stats()
+            self.stats_timer.start()
+        else:
+            self.stats_timer.stop()
+    
+    def refresh_stats(self):
+        snapshot = metrics.snapshot()
+        lines = [format_stages(snapshot)]
+        for entry in snapshot["failed_files"][:20]:
+            lines.append(f"FAILED {entry['path']} ({entry['stage']}): {entry['error']}")
+        for entry in snapshot["slow_files"][:20]:
+            lines.append(f"SLOW   {entry['path']}: {entry['seconds']:.2f}s")
+        text = "\n".join(lines)
+        if text != self.stats_panel.toPlainText():
+            self.stats_panel.setPlainText(text)
+    
+    # ------------------------------------------------
+    #                 Shutdown
+    # ------------------------------------------------
+    def closeEvent(self, event):
+        for folder in list(self.watchers):
+            self.stop_watching(folder)
+        # Keep the query embeddings of this session for the next one
+        text_cache.save()
+        super().closeEvent(event)
     
     # ------------------------------------------------
     #     Open Image in File Explorer / Finder
@@ -484,6 +951,7 @@ def main():
     app = QApplication(sys.argv)
     window = SnapSeek()
     window.show()
+    window.warm_model()
     sys.exit(app.exec_())
 
 if __name__ == "__main__":
@@ -0,0 +1,261 @@
+"""
+Multi-folder image library for SnapSeek.
+
+A library is a list of root folders (saved in ~/.snapseek/library.json). Each root
+is indexed on its own, as the usual per-folder index (see store.py), and acts as
+one shard of the library: roots can be added, removed or refreshed without
+touching the others.
+
+A query is scored against all shards in parallel on a thread pool (NumPy releases
+the GIL while scoring), each shard returns its own top k, and the sorted per-shard
+lists are merged with a heap. Searching many drives therefore costs about as much
+as searching the largest one. Adaptive cut-offs (see calibration.py) are computed
+for the library as a whole, so every shard applies the same score floor.
+"""
+import os
+import json
+import shutil
+import heapq
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import store
+from ann import DEFAULT_NPROBE
+from calibration import ScoreMoments
+
+# Where the list of library folders is kept
+LIBRARY_PATH = os.path.join(os.path.expanduser("~"), ".snapseek", "library.json")
+
+# Shards searched at the same time
+DEFAULT_SEARCH_WORKERS = min(8, os.cpu_count() or 1)
+
+def _same_or_inside(path, root):
+    """True if `path` is `root` or lies below it (both absolute, compared case-insensitively on Windows)."""
+    path, root = os.path.normcase(path), os.path.normcase(root)
+    return path == root or path.startswith(root.rstrip(os.sep) + os.sep)
+
+class Library:
+    """
+    The indexed root folders and their shards (one EmbeddingStore per folder).
+
+    A folder without a usable index yet has no shard until it is refreshed. Shards
+    are swapped whole (set_shard), so a search that is running keeps the shards it
+    started with. Like an EmbeddingStore, a library can be passed to
+    main.search_images: it offers the same top_k and top_k_groups methods.
+    """
+
+    def __init__(self, path=LIBRARY_PATH, index_root=store.INDEX_ROOT, num_workers=DEFAULT_SEARCH_WORKERS):
+        self.path = path
+        self.index_root = index_root
+        self.num_workers = num_workers
+        self.folders = []
+        self._shards = {}
+        self._lock = threading.Lock()
+        self._executor = None
+        if path is not None:
+            self.load()
+
+    # --- Folders ----------------------------------------------------------
+    def load(self):
+        """Reads the folder list (a missing or unreadable file means an empty library)."""
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self.folders = list(json.load(f).get("folders", []))
+        except (OSError, ValueError):
+            self.folders = []
+
+    def save(self):
+        if self.path is None:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": 1, "folders": self.folders}, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def find(self, folder):
+        """Returns the library folder equal to `folder` (as stored), or None."""
+        folder = os.path.normcase(os.path.abspath(folder))
+        for root in self.folders:
+            if os.path.normcase(root) == folder:
+                return root
+        return None
+
+    def add(self, folder):
+        """
+        Adds a root folder and opens its saved index if it has one; returns the folder
+        as stored. Folders nested in (or containing) a library folder are refused,
+        since their images would be indexed and returned twice.
+        """
+        folder = os.path.abspath(folder)
+        existing = self.find(folder)
+        if existing is not None:
+            return existing
+        for root in self.folders:
+            if _same_or_inside(folder, root) or _same_or_inside(root, folder):
+                raise ValueError(f"{folder} overlaps the library folder {root}")
+        self.folders.append(folder)
+        self.save()
+        self.open_shard(folder)
+        return folder
+
+    def remove(self, folder, delete_index=False):
+        """Removes a root folder and its shard; with `delete_index` its saved index is deleted too."""
+        root = self.find(folder)
+        if root is None:
+            raise KeyError(folder)
+        self.folders.remove(root)
+        self.save()
+        with self._lock:
+            self._shards.pop(root, None)
+        if delete_index:
+            shutil.rmtree(store.index_dir(root, self.index_root), ignore_errors=True)
+
+    # --- Shards -----------------------------------------------------------
+    def open(self):
+        """Opens the saved index of every folder (memory-mapped, so this is quick)."""
+        for folder in self.folders:
+            self.open_shard(folder)
+        return self
+
+    def open_shard(self, folder):
+        embeddings = store.open_index(folder, self.index_root)
+        if embeddings is not None:
+            self.set_shard(folder, embeddings)
+        return embeddings
+
+    def set_shard(self, folder, embeddings):
+        """Replaces the shard of a library folder, e.g. with a refreshed or partial index."""
+        root = self.find(folder)
+        if root is None:
+            raise KeyError(folder)
+        with self._lock:
+            self._shards[root] = store.EmbeddingStore.from_dict(embeddings)
+
+    def shard(self, folder):
+        root = self.find(folder)
+        return self._shards.get(root) if root is not None else None
+
+    def shards(self):
+        """Returns [(folder, EmbeddingStore)] of the folders that have a shard."""
+        with self._lock:
+            return [(folder, self._shards[folder]) for folder in self.folders if folder in self._shards]
+
+    def refresh(self, folder, **index_kwargs):
+        """Re-indexes one folder (only new or changed images are encoded) and swaps its shard in."""
+        import main
+        root = self.find(folder)
+        if root is None:
+            raise KeyError(folder)
+        embeddings = main.index_images(root, **index_kwargs)
+        self.set_shard(root, embeddings)
+        return embeddings
+
+    def __len__(self):
+        return sum(len(embeddings) for _, embeddings in self.shards())
+
+    def vector(self, path):
+        """The stored embedding of an indexed image (see EmbeddingStore.vector), or None."""
+        for folder, shard in self.shards():
+            if _same_or_inside(path, folder):
+                vector = shard.vector(path)
+                if vector is not None:
+                    return vector
+        return None
+
+    @property
+    def moments(self):
+        """ScoreMoments of all shards together (see EmbeddingStore.moments); None if there are none."""
+        return ScoreMoments.combine(shard.moments for _, shard in self.shards())
+
+    def stats(self):
+        """Per-folder summary: [{"folder", "images" (None if not indexed yet)}]."""
+        shards = dict(self.shards())
+        return [{"folder": folder, "images": len(shards[folder]) if folder in shards else None}
+                for folder in self.folders]
+
+    # --- Search -----------------------------------------------------------
+    def _fan_out(self, search, where=None):
+        """
+        Runs search(shard) on every shard in parallel; returns [(folder, shard, result)].
+        Shards that cannot hold an image matching `where` (a filters.Filter) are skipped.
+        """
+        shards = [(folder, shard) for folder, shard in self.shards() if where is None or where.covers_folder(folder)]
+        if len(shards) <= 1:
+            return [(folder, shard, search(shard)) for folder, shard in shards]
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=max(1, self.num_workers),
+                                                thread_name_prefix="library-search")
+        futures = [(folder, shard, self._executor.submit(search, shard)) for folder, shard in shards]
+        return [(folder, shard, future.result()) for folder, shard, future in futures]
+
+    def top_k(self, query, k, threshold=None, nprobe=DEFAULT_NPROBE, rerank=None, exact=False, where=None,
+              cutoff=None, offset=0):
+        """
+        Returns the k best (path, similarity) pairs over all shards: every shard
+        returns its own top k (sorted), and the lists are merged with a heap.
+        With `where` (a filters.Filter), shards outside its folders are not searched.
+        `cutoff` and `offset` work as in EmbeddingStore.top_k; the z-score floor comes
+        from the moments of the whole library, and shards return offset + k results.
+        """
+        query = np.asarray(query, dtype=np.float32).reshape(-1)
+        if cutoff:
+            threshold = cutoff.floor(query, self.moments, threshold)
+        per_shard = self._fan_out(
+            lambda shard: shard.top_k(query, offset + k, threshold=threshold, nprobe=nprobe, rerank=rerank,
+                                      exact=exact, where=where),
+            where,
+        )
+        merged = heapq.merge(*(results for _, _, results in per_shard), key=lambda result: result[1], reverse=True)
+        results = list(itertools.islice(merged, offset + k))
+        end = cutoff.head([score for _, score in results]) if cutoff else len(results)
+        return results[offset:end]
+
+    def top_k_groups(self, query, k, threshold=None, nprobe=DEFAULT_NPROBE, rerank=None, exact=False,
+                     near_duplicates=False, max_distance=store.PHASH_MAX_DISTANCE, where=None, cutoff=None, offset=0):
+        """
+        Like top_k, with one (path, similarity, alternate paths) entry per group of
+        duplicates (see EmbeddingStore.top_k_groups); copies on different drives are
+        grouped too.
+        """
+        query = np.asarray(query, dtype=np.float32).reshape(-1)
+        if cutoff:
+            threshold = cutoff.floor(query, self.moments, threshold)
+        k = offset + k
+        fetch = k
+        while True:
+            per_shard = self._fan_out(
+                lambda shard: shard._top_group_rows(query, fetch, threshold, nprobe, rerank, exact,
+                                                    near_duplicates, max_distance, where),
+                where,
+            )
+            # Shard groups, best first: (score, content hash, perceptual hash, paths)
+            candidates = heapq.merge(
+                *([self._describe_group(shard, score, rows, near_duplicates) for score, rows in groups]
+                  for _, shard, groups in per_shard),
+                key=lambda candidate: candidate[0], reverse=True,
+            )
+            candidates = list(candidates)
+            groups = store.group_duplicates([candidate[:3] for candidate in candidates], max_distance)
+            # Groups can merge across shards; look further down while some shard may hold more
+            exhausted = all(len(shard_groups) < fetch for _, _, shard_groups in per_shard)
+            if len(groups) >= k or exhausted:
+                break
+            fetch *= 4
+
+        groups = groups[:k]
+        end = cutoff.head([candidates[members[0]][0] for members in groups]) if cutoff else len(groups)
+        results = []
+        for members in groups[offset:end]:
+            paths = [path for i in members for path in candidates[i][3]]
+            results.append((paths[0], candidates[members[0]][0], paths[1:]))
+        return results
+
+    @staticmethod
+    def _describe_group(shard, score, rows, near_duplicates):
+        hashes = shard.column("hash")
+        phashes = shard.column("phash") if near_duplicates else None
+        digest = hashes[rows[0]] if hashes is not None else b""
+        phash = phashes[rows[0]] if phashes is not None else 0
+        return score, digest, phash, [shard.paths[row] for row in rows]
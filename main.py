@@ -1,99 +1,978 @@
 import os
-from PIL import Image
-import torch
-import clip
+import io
+import time
+from datetime import datetime
+from collections import deque, ChainMap
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ExifTags
 import numpy as np  # <-- Make sure to import NumPy for similarity calculations
+import store
+import encoders
+import filters
+from ann import IVFIndex, DEFAULT_NPROBE
+from decoder import DecodePool, DECODE_TIMEOUT, DECODE_MEMORY_LIMIT
+from cache import TextEmbeddingCache, TEXT_CACHE_PATH
+from profiling import Metrics
+from scanner import scan_images, VALID_EXTENSIONS, DEFAULT_EXCLUDE
 
-# (Assuming that you already have these from Step 1)
-device = "cuda" if torch.cuda.is_available() else "cpu"
-model, preprocess = clip.load("ViT-B/32", device=device)
+# CLIP model used for images and text queries unless another encoder is set
+MODEL_NAME = encoders.DEFAULT_MODEL
 
-def index_images(image_folder):
+# Encoder used for indexing and search (see encoders.py and set_encoder). Its model
+# is loaded on first use (see load_model), so importing this module stays cheap
+_encoder = encoders.ClipEncoder(MODEL_NAME)
+
+# Seconds the last model load took (None until the model is loaded)
+model_load_seconds = None
+
+def get_encoder():
+    return _encoder
+
+def set_encoder(encoder):
     """
-    Scans the provided folder for images, preprocesses them, computes their embeddings,
-    and returns a dictionary mapping image file paths to their embeddings.
+    Makes `encoder` (see encoders.create_encoder) the one used for indexing and
+    search from now on. Runs that already started keep the encoder they started with.
+    """
+    global _encoder, model_load_seconds
+    _encoder = encoder
+    model_load_seconds = encoder.load_seconds
+
+def load_model():
+    """
+    Returns the active encoder, importing its runtime and loading the model the
+    first time it is needed. Safe to call from several threads at once: only one
+    of them loads the model, the others wait for it.
+    """
+    global model_load_seconds
+    encoder = _encoder.load()
+    model_load_seconds = encoder.load_seconds
+    return encoder
+
+def is_model_loaded():
+    return _encoder.loaded
+
+def check_encoder(image_embeddings, encoder=None):
+    """
+    Raises encoders.EncoderMismatch if an index (an EmbeddingStore or every shard of
+    a library.Library) was built with an encoder whose embeddings cannot be compared
+    with the ones of `encoder` (default: the active encoder).
     """
-    # Supported image extensions
-    valid_extensions = (".png", ".jpg", ".jpeg", ".bmp", ".gif")
+    encoder = encoder or _encoder
+    stores = image_embeddings.shards() if hasattr(image_embeddings, "shards") else [image_embeddings]
+    for embedding_store in stores:
+        if not hasattr(embedding_store, "encoder"):
+            continue
+        if not encoders.compatible(embedding_store.encoder, encoder.info()):
+            raise encoders.EncoderMismatch(
+                f"The index was built with {encoders.describe(embedding_store.encoder)}; "
+                f"it cannot be searched with {encoder.name}. Re-index the folder or choose that model."
+            )
+
+# Normalized embeddings of recent text queries, saved to TEXT_CACHE_PATH by text_cache.save()
+text_cache = TextEmbeddingCache(max_entries=4096, path=TEXT_CACHE_PATH)
+
+# Per-stage timings of indexing and search, and the failed/slow file report (see profiling.py)
+metrics = Metrics()
+
+# Indexing pipeline defaults: images per encode_image call and decode threads
+DEFAULT_BATCH_SIZE = 32
+DEFAULT_NUM_WORKERS = min(8, os.cpu_count() or 1)
+
+# Results with a similarity score at or below this are dropped
+SEARCH_THRESHOLD = 0.2
+
+# Unchanged images are moved over from the saved index in chunks of this many rows
+REUSE_CHUNK_ROWS = 4096
+
+# While indexing, newly encoded images are checkpointed to disk at most this many seconds apart
+CHECKPOINT_SECONDS = 60.0
+
+# Images are decoded for indexing with their shortest side at least this large (CLIP's input is 224x224)
+DECODE_MIN_SIDE = 224
+
+# EXIF tags of IFD1 giving the offset and length of the embedded JPEG thumbnail
+_EXIF_THUMBNAIL_OFFSET = 0x0201
+_EXIF_THUMBNAIL_LENGTH = 0x0202
+
+# EXIF tags of the camera make and model, the modification time (IFD0) and the capture time (Exif IFD)
+_EXIF_MAKE = 0x010F
+_EXIF_MODEL = 0x0110
+_EXIF_DATETIME = 0x0132
+_EXIF_DATETIME_ORIGINAL = 0x9003
+
+def _exif_thumbnail(image, min_side):
+    """
+    Returns the JPEG thumbnail embedded in the EXIF data of `image` if it can stand
+    in for the full image (shortest side >= min_side, same aspect ratio), else None.
+    """
+    try:
+        raw = image.info.get("exif")
+        thumbnail_ifd = image.getexif().get_ifd(ExifTags.IFD.IFD1)
+        offset = thumbnail_ifd.get(_EXIF_THUMBNAIL_OFFSET)
+        length = thumbnail_ifd.get(_EXIF_THUMBNAIL_LENGTH)
+        if not (raw and offset and length):
+            return None
+        # Offsets count from the TIFF header, which follows the "Exif\0\0" marker
+        start = offset + 6 if raw.startswith(b"Exif\x00\x00") else offset
+        thumbnail = Image.open(io.BytesIO(raw[start:start + length]))
+    except Exception:
+        return None
+    width, height = thumbnail.size
+    if min(width, height) < min_side:
+        return None
+    # Letterboxed thumbnails (e.g. 160x120 of a 3:2 photo) would shift the embedding
+    aspect = image.width / image.height
+    if abs(width / height - aspect) > 0.01 * aspect:
+        return None
+    return thumbnail
+
+def open_image(data, min_side=DECODE_MIN_SIDE):
+    """
+    Opens image bytes for indexing without decoding them yet; the pixels are decoded
+    by the convert("RGB") that follows. Returns (image, method).
+
+    CLIP downsamples every image to 224px, so there is no need to decode a 24MP
+    photo at full size. For JPEGs this returns, in order of preference:
+      - "exif":  the embedded EXIF thumbnail, if it is large enough (see _exif_thumbnail)
+      - "draft": the image in draft mode, which scales by 1/2, 1/4 or 1/8 inside the
+                 JPEG decoder (DCT scaling) while keeping the shortest side >= min_side
+    Other formats, small JPEGs and min_side=None give the full image ("full").
+    """
+    image = Image.open(io.BytesIO(data))
+    if min_side and image.format == "JPEG":
+        thumbnail = _exif_thumbnail(image, min_side)
+        if thumbnail is not None:
+            return thumbnail, "exif"
+        full_size = image.size
+        image.draft("RGB", (min_side, min_side))
+        if image.size != full_size:
+            return image, "draft"
+    return image, "full"
+
+def perceptual_hash(image):
+    """
+    64-bit difference hash of a PIL image: one bit per pair of neighbouring pixels
+    of a 9x8 grayscale thumbnail, set where brightness increases. Resized,
+    re-encoded or lightly edited copies of a photo get hashes a few bits apart
+    (see store.PHASH_MAX_DISTANCE).
+    """
+    pixels = np.asarray(image.convert("L").resize((9, 8), Image.BILINEAR), dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).ravel()
+    return int(np.packbits(bits).view(">u8")[0])
+
+def image_metadata(image):
+    """
+    Returns the "taken" and "camera" columns (see store.FILE_COLUMNS) of an opened
+    PIL image from its EXIF data: the capture time in seconds since the epoch (0.0
+    if unknown) and the lowercased camera make and model (b"" if unknown).
+    Only the header is read, the pixels are not decoded.
+    """
+    try:
+        exif = image.getexif()
+        stamp = exif.get_ifd(ExifTags.IFD.Exif).get(_EXIF_DATETIME_ORIGINAL) or exif.get(_EXIF_DATETIME)
+        make = str(exif.get(_EXIF_MAKE) or "").strip("\0 ")
+        model = str(exif.get(_EXIF_MODEL) or "").strip("\0 ")
+    except Exception:
+        return 0.0, b""
+    taken = 0.0
+    if stamp:
+        try:
+            taken = datetime.strptime(str(stamp).strip("\0 ")[:19], "%Y:%m:%d %H:%M:%S").timestamp()
+        except (ValueError, OverflowError, OSError):
+            pass
+    # Models usually repeat the make ("Canon" / "Canon EOS 5D")
+    camera = model if model.lower().startswith(make.lower()) else f"{make} {model}"
+    return taken, camera.strip().lower().encode("utf-8")
+
+def file_metadata(path):
+    """image_metadata of an image file, reading only its header; (0.0, b"") if it cannot be read."""
+    try:
+        with Image.open(path) as image:
+            return image_metadata(image)
+    except Exception:
+        return 0.0, b""
+
+def _content_columns(contents):
+    """{column: values} of a list of `content` dicts returned by _load_image."""
+    return {name: [content[name] for content in contents] for name in store.CONTENT_COLUMNS}
+
+def _decode_image(data, min_side=DECODE_MIN_SIDE, timings=None, max_pixels=None):
+    """
+    Decodes image bytes for indexing: reads the EXIF metadata, opens the image (at
+    reduced resolution with `min_side`, see open_image), converts it to RGB and hashes
+    it perceptually. With `min_side`, an image still at least twice that size is then
+    reduced by a whole factor, as JPEG draft mode does for JPEGs, so every format and
+    both decoding paths (threads or decoder.py workers) give the encoder the same pixels.
+    Returns (image, content, method) with `content` the file's store.CONTENT_COLUMNS
+    values. Images of more than `max_pixels` pixels are refused with MemoryError
+    before they are decoded.
+    """
+    with metrics.stage("metadata", timings):
+        taken, camera = image_metadata(Image.open(io.BytesIO(data)))
+    # Load the image and convert to RGB (if not already); opening only parses the header
+    with metrics.stage("open", timings):
+        image, method = open_image(data, min_side)
+        if max_pixels and image.width * image.height > max_pixels:
+            raise MemoryError(f"{image.width}x{image.height} image is too large to decode")
+    with metrics.stage("convert", timings):
+        image = image.convert("RGB")
+    with metrics.stage("phash", timings):
+        phash = perceptual_hash(image)
+    factor = min(image.size) // min_side if min_side else 1
+    if factor >= 2:
+        with metrics.stage("reduce", timings):
+            image = image.reduce(factor)
+    return image, {"phash": phash, "taken": taken, "camera": camera}, method
+
+def _decode_isolated(decode_pool, data, min_side, timings):
+    """_decode_image in a worker process of `decode_pool`; its stage times are added to `metrics`."""
+    worker_timings = {}
+    try:
+        return decode_pool.decode(data, min_side, worker_timings)
+    finally:
+        for name, seconds in worker_timings.items():
+            metrics.add(name, seconds)
+        timings.update(worker_timings)
+
+def _load_image(path, known_hashes=(), fast_decode=True, encoder=None, decode_pool=None):
+    """
+    Reads an image, hashes its bytes, decodes it (see _decode_image) and applies the
+    preprocessing of `encoder` (default: the active encoder).
+    With `fast_decode` JPEGs are decoded at reduced resolution (see open_image).
+    With a `decode_pool` (see decoder.py) the decoding runs in one of its worker
+    processes, so a file that hangs or crashes the decoder only fails itself.
+    Returns (content_hash, tensor, content) with `content` the values of the file's
+    store.CONTENT_COLUMNS (perceptual hash and EXIF metadata), with tensor and content
+    set to None when the content hash is in `known_hashes` (the embedding can be
+    reused), or None if the file could not be read.
+    Each step is timed in `metrics`; failures are added to its file report.
+    """
+    timings = {}
+    try:
+        with metrics.stage("read", timings):
+            with open(path, "rb") as f:
+                data = f.read()
+            digest = store.content_hash(data)
+        if digest in known_hashes:
+            return digest, None, None
+        min_side = DECODE_MIN_SIDE if fast_decode else None
+        if decode_pool is not None:
+            image, content, method = _decode_isolated(decode_pool, data, min_side, timings)
+        else:
+            image, content, method = _decode_image(data, min_side, timings)
+        metrics.count(f"decode_{method}")
+        # Preprocess the image as required by the model
+        encoder = (encoder or _encoder).load()
+        with metrics.stage("preprocess", timings):
+            tensor = encoder.preprocess(image)
+        return digest, tensor, content
+    except Exception as e:
+        print(f"Error processing {path}: {e}")
+        metrics.file_failed(path, e, timings)
+        return None
+    finally:
+        metrics.file_done(path, timings)
+
+def _encode_batch(tensors, encoder=None):
+    """
+    Runs a list of preprocessed images through the image encoder of `encoder`
+    (default: the active encoder) in a single forward pass and returns the
+    normalized embeddings as an (N, D) NumPy array.
+    """
+    encoder = (encoder or _encoder).load()
+    with metrics.stage("encode", items=len(tensors)):
+        embeddings = encoder.encode_images(tensors)
+    with metrics.stage("host_copy", items=len(tensors)):
+        return encoder.to_numpy(embeddings)
+
+def _iter_preprocessed(image_paths, executor, prefetch, known_hashes=(), fast_decode=True, encoder=None,
+                       decode_pool=None):
+    """
+    Yields (path, _load_image result) pairs in input order while keeping at most `prefetch`
+    images decoding in the worker pool, so decoding overlaps with encoding
+    without holding the whole folder in memory.
+    """
+    pending = deque()
+    paths = iter(image_paths)
+
+    def submit(path):
+        pending.append((path, executor.submit(_load_image, path, known_hashes, fast_decode, encoder, decode_pool)))
+
+    for path in paths:
+        submit(path)
+        if len(pending) >= prefetch:
+            break
+    while pending:
+        path, future = pending.popleft()
+        next_path = next(paths, None)
+        if next_path is not None:
+            submit(next_path)
+        yield path, future.result()
+
+class IndexProgress:
+    """
+    Progress report yielded by iter_index_images.
+
+    `done`/`total` count images (including the ones reused from the saved index),
+    `rate` and `eta` only consider the images this run actually has to process.
+    While the folder is still being walked (`scanning`), `total` is only the number
+    of images found so far and there is no ETA.
+    `results` is an EmbeddingStore of everything indexed so far, which can already
+    be searched; in the last report (`finished`) it is the complete index.
+    """
+
+    def __init__(self, done, total, processed, to_process, failed, elapsed, results,
+                 scanning=False, finished=False, cancelled=False):
+        self.done = done
+        self.total = total
+        self.processed = processed
+        self.to_process = to_process
+        self.failed = failed
+        self.elapsed = elapsed
+        self.results = results
+        self.scanning = scanning
+        self.finished = finished
+        self.cancelled = cancelled
+
+    @property
+    def rate(self):
+        """Images processed per second in this run."""
+        return self.processed / self.elapsed if self.elapsed > 0 else 0.0
+
+    @property
+    def eta(self):
+        """Estimated seconds left, or None while there is no rate to go by."""
+        if self.finished:
+            return 0.0
+        if self.scanning:
+            return None
+        rate = self.rate
+        return (self.to_process - self.processed) / rate if rate > 0 else None
+
+def iter_index_images(image_folder, batch_size=DEFAULT_BATCH_SIZE, num_workers=DEFAULT_NUM_WORKERS,
+                      persist=True, dtype=np.float32, build_ann=False, ann_lists=None, pq_subspaces=0,
+                      recursive=True, include=None, exclude=DEFAULT_EXCLUDE, cancel_event=None,
+                      fast_decode=True, isolate=False, decode_timeout=DECODE_TIMEOUT,
+                      decode_memory=DECODE_MEMORY_LIMIT, checkpoint_seconds=CHECKPOINT_SECONDS):
+    """
+    Streaming version of index_images: yields an IndexProgress after every encoded
+    batch and a final one with `finished` set.
+
+    The folder is walked by scanner.scan_images while images are being encoded, so
+    the first batches go through the model before the whole tree has been listed.
+
+    Setting `cancel_event` (a threading.Event) stops the run after the current
+    image; the images indexed so far are still saved and returned in the final
+    report (with `cancelled` set), so the next run picks up from there.
+
+    With `persist`, the images encoded since the last checkpoint are saved every
+    `checkpoint_seconds` (see store.save_checkpoint; None turns this off). If the
+    run dies before it finishes, the next run of the folder reuses them instead of
+    encoding them again.
+    """
+    start_time = time.perf_counter()
+    # The whole run uses the encoder that is active when it starts
+    encoder = _encoder
+    
+    # Previously saved index (memory-mapped): rows by path and by content hash. Reused
+    # rows are read as float32 `old_vectors`, so they can go into a store of any format.
+    # An index built by an incompatible encoder (another model) is rebuilt from scratch
+    saved = store.open_index(image_folder) if persist else None
+    if saved is not None and not encoders.compatible(saved.encoder, encoder.info()):
+        print(f"Re-indexing {image_folder}: it was indexed with {encoders.describe(saved.encoder)}, "
+              f"not {encoder.name}")
+        saved = None
+
+    # Rows encoded by an earlier run that was interrupted are reused like saved rows
+    checkpoint = store.load_checkpoint(image_folder) if persist else None
+    if checkpoint is not None and not encoders.compatible(checkpoint.encoder, encoder.info()):
+        checkpoint = None
+    if checkpoint is not None:
+        print(f"Resuming the index of {image_folder}: {len(checkpoint)} image(s) were encoded before it stopped")
+        if saved is None:
+            saved = checkpoint
+        else:
+            merged = saved.without(checkpoint.paths)
+            merged.append(checkpoint.paths, checkpoint.vectors, columns=checkpoint.columns)
+            merged.unknown_columns = saved.unknown_columns
+            saved = merged
+    if saved is not None:
+        old_paths, old_columns, old_embeddings, old_ann = saved.paths, saved.columns, saved.matrix, saved.ann
+        old_vectors = saved.vectors
+    else:
+        old_paths, old_columns, old_embeddings, old_ann, old_vectors = [], None, None, None, None
+    rows_by_path = {path: i for i, path in enumerate(old_paths)}
+    rows_by_hash = {}
+    if saved is not None:
+        rows_by_hash = {digest.decode("ascii"): i for i, digest in enumerate(old_columns["hash"])}
+    # The saved index predates the metadata columns: reused rows get them from the file headers
+    backfill = saved is not None and "taken" in saved.unknown_columns
+
     
-    # Gather all image file paths in the folder
-    image_paths = [
-        os.path.join(image_folder, filename)
-        for filename in os.listdir(image_folder)
-        if filename.lower().endswith(valid_extensions)
-    ]
+    # Image path -> (size, mtime) of every image found, and image path -> row of the
+    # saved index whose embedding is reused
+    files = {}
+    reused_rows = {}
     
-    # Dictionary to hold image path -> embedding mapping
-    image_embeddings = {}
+    # Duplicates within this run share one encode: content hash -> row of `results`
+    # once its first copy is encoded, and content hash -> paths of the further copies
+    # found while the first one still waits in the batch
+    encoded_rows = {}
+    waiting_copies = {}
+    # Hashes whose embedding is known or on its way; the decode workers skip those files
+    known_hashes = ChainMap(waiting_copies, encoded_rows, rows_by_hash)
     
-    # Process each image
-    for path in image_paths:
-        try:
-            # Load the image and convert to RGB (if not already)
-            image = Image.open(path).convert("RGB")
-            # Preprocess the image as required by CLIP
-            image_input = preprocess(image).unsqueeze(0).to(device)
-            # Compute the embedding (no gradient calculation needed)
-            with torch.no_grad():
-                embedding = model.encode_image(image_input)
-            # Normalize the embedding for consistent similarity comparisons
-            embedding = embedding / embedding.norm(dim=-1, keepdim=True)
-            # Save the embedding in CPU memory (as a NumPy array)
-            image_embeddings[path] = embedding.cpu().numpy()
-        except Exception as e:
-            print(f"Error processing {path}: {e}")
-    
-    return image_embeddings
-
-def search_images(query, image_embeddings, top_k=10):
-    """
-    Given a text query and a dictionary of precomputed image embeddings,
-    this function returns the top_k image paths that best match the query,
-    filtering out results with a similarity score <= 0.2.
-    """
-    # Tokenize the query and compute its embedding using CLIP's text encoder.
-    text_tokens = clip.tokenize(query).to(device)
-    with torch.no_grad():
-        text_embedding = model.encode_text(text_tokens)
-    
-    # Normalize the text embedding to ensure consistent similarity comparisons.
-    text_embedding = text_embedding / text_embedding.norm(dim=-1, keepdim=True)
-    text_embedding = text_embedding.cpu().numpy()  # Move to CPU for NumPy operations
-    
-    # Compute cosine similarity between the query and each image embedding.
-    similarities = []
-    for path, embedding in image_embeddings.items():
-        # Since embeddings are normalized, the dot product is equivalent to cosine similarity.
-        similarity = np.dot(embedding, text_embedding.T).item()
-        if similarity > 0.2:  # Filter out low-score images
-            similarities.append((path, similarity))
-    
-    # Sort the images by similarity in descending order.
-    similarities.sort(key=lambda x: x[1], reverse=True)
-    
-    return similarities[:top_k]  # Return the top-k results that meet the threshold
-
-
-# For testing the complete functionality:
-if __name__ == "__main__":
-    # Replace this with the path to your image folder
-    image_folder = "D:/Pachmari/images"
+    # Growing store of everything indexed so far, with the file columns of every row
+    results = store.EmbeddingStore(dtype=dtype, encoder=encoder.info())
+    reused_pending = []
     
-    # Call the indexing function and retrieve embeddings
-    embeddings = index_images(image_folder)
+    def add_rows(paths, embeddings, digests, content):
+        results.append(paths, embeddings, columns=dict(content, **{
+            "size": [files[path][0] for path in paths],
+            "mtime": [files[path][1] for path in paths],
+            "hash": digests,
+        }))
     
-    # Print out the indexed image paths (and optionally check their embedding shapes)
-    print("Indexed images:")
-    for path, embedding in embeddings.items():
-        print(f"{path} - Embedding shape: {embedding.shape}")
+    def reused_content(paths, rows):
+        content = {name: old_columns[name][rows] for name in store.CONTENT_COLUMNS}
+        if backfill:
+            metadata = [file_metadata(path) for path in paths]
+            content["taken"] = [taken for taken, _ in metadata]
+            content["camera"] = [camera for _, camera in metadata]
+        return content
     
-    # Now prompt the user for a search query
-    user_query = input("Enter your search query: ")
+    def append_reused():
+        # Gather the waiting reused rows from the saved matrix in one go (in file order)
+        if reused_pending:
+            reused_pending.sort(key=lambda item: item[1])
+            paths = [path for path, _ in reused_pending]
+            rows = np.array([row for _, row in reused_pending])
+            add_rows(paths, old_vectors[rows], old_columns["hash"][rows], reused_content(paths, rows))
+            reused_pending.clear()
     
-    # Retrieve the top matching images
-    top_matches = search_images(user_query, embeddings, top_k=5)
+    counts = {"pending": 0, "processed": 0, "failed": 0, "encoded": 0}
+    scan_state = {"done": False}
     
-    # Display the results
-    print("\nTop matching images:")
-    for path, score in top_matches:
-        print(f"{path} - Similarity: {score:.4f}")
+    def paths_to_process():
+        """Walks the folder; unchanged files (same size and mtime) keep their embedding without being read."""
+        for path, stat in scan_images(image_folder, recursive=recursive, include=include, exclude=exclude):
+            files[path] = (stat.st_size, stat.st_mtime)
+            i = rows_by_path.get(path)
+            if i is not None and (old_columns["size"][i], old_columns["mtime"][i]) == files[path]:
+                reused_rows[path] = i
+                reused_pending.append((path, i))
+                if len(reused_pending) >= REUSE_CHUNK_ROWS:
+                    append_reused()
+            else:
+                counts["pending"] += 1
+                yield path
+        append_reused()
+        scan_state["done"] = True
+    
+    def report(final=None, **kwargs):
+        append_reused()
+        snapshot = final if final is not None else results.snapshot()
+        return IndexProgress(
+            len(snapshot), len(files), counts["processed"], counts["pending"], counts["failed"],
+            time.perf_counter() - start_time, snapshot, scanning=not scan_state["done"], **kwargs
+        )
+    
+    batch_paths, batch_tensors, batch_hashes, batch_contents = [], [], [], []
+    cancelled = False
+    # Rows of `results` encoded since the last checkpoint
+    unsaved_rows = []
+    last_checkpoint = time.perf_counter()
+
+    def flush():
+        embeddings = _encode_batch(batch_tensors, encoder)
+        with metrics.stage("append", items=len(batch_paths)):
+            first_row = len(results)
+            add_rows(batch_paths, embeddings, batch_hashes, _content_columns(batch_contents))
+            for i, (digest, content) in enumerate(zip(batch_hashes, batch_contents)):
+                encoded_rows[digest] = first_row + i
+                copies = waiting_copies.pop(digest, None)
+                if copies:
+                    add_rows(copies, np.repeat(embeddings[i:i + 1], len(copies), axis=0),
+                             [digest] * len(copies), _content_columns([content] * len(copies)))
+            unsaved_rows.extend(range(first_row, len(results)))
+        counts["encoded"] += len(batch_paths)
+        for batch in (batch_paths, batch_tensors, batch_hashes, batch_contents):
+            batch.clear()
+
+    def checkpoint_due():
+        return (persist and checkpoint_seconds is not None and unsaved_rows
+                and time.perf_counter() - last_checkpoint >= checkpoint_seconds)
+
+    def save_checkpoint():
+        rows = np.array(unsaved_rows)
+        with metrics.stage("checkpoint", items=len(rows)):
+            columns = {name: results.column(name)[rows] for name in store.FILE_COLUMNS}
+            store.save_checkpoint(image_folder, [results.paths[i] for i in rows], columns,
+                                  results.vectors[rows], encoder=encoder.info())
+        unsaved_rows.clear()
+
+    # Decoding runs in supervised worker processes (see decoder.py), which are stopped after the executor
+    decode_pool = DecodePool(num_workers, decode_timeout, decode_memory) if isolate else None
+    with decode_pool or nullcontext(), ThreadPoolExecutor(max_workers=max(1, num_workers)) as executor:
+        prefetch = 2 * max(batch_size, num_workers)
+        for path, loaded in _iter_preprocessed(paths_to_process(), executor, prefetch, known_hashes,
+                                                 fast_decode, encoder, decode_pool):
+            if cancel_event is not None and cancel_event.is_set():
+                cancelled = True
+                break
+            counts["processed"] += 1
+            if loaded is None:
+                counts["failed"] += 1
+                continue
+            digest, tensor, content = loaded
+            if digest in rows_by_hash:
+                # Same bytes as an already indexed file (touched, renamed or moved)
+                row = rows_by_hash[digest]
+                reused_rows[path] = row
+                add_rows([path], old_vectors[row], [digest], reused_content([path], [row]))
+                continue
+            if digest in encoded_rows or digest in waiting_copies:
+                # Another copy of a file encoded in this run (a backup, an export...)
+                metrics.count("duplicate_files")
+                row = encoded_rows.get(digest)
+                if row is None:
+                    waiting_copies[digest].append(path)
+                else:
+                    add_rows([path], np.array(results.vectors[row]), [digest],
+                             {name: results.column(name)[row:row + 1] for name in store.CONTENT_COLUMNS})
+                continue
+            waiting_copies[digest] = []
+            batch_paths.append(path)
+            batch_tensors.append(tensor)
+            batch_hashes.append(digest)
+            batch_contents.append(content)
+            if len(batch_tensors) >= batch_size:
+                flush()
+                if checkpoint_due():
+                    save_checkpoint()
+                    last_checkpoint = time.perf_counter()
+                yield report()
+        if cancelled:
+            # Stop the queued decodes instead of waiting for them
+            executor.shutdown(wait=True, cancel_futures=True)
+        if batch_tensors:
+            flush()
+        append_reused()
+    
+    # Nothing was added, changed or removed (and the format is the same): search the saved index in place.
+    # Rows resumed from a checkpoint are not saved yet, so they rule this out
+    unchanged = len(reused_rows) == len(old_paths) and all(
+        rows_by_path.get(path) == row for path, row in reused_rows.items()
+    ) and saved is not None and saved.format == results.format and saved.encoder is not None and not backfill \
+        and checkpoint is None
+    if unchanged and not counts["encoded"] and not cancelled and (old_ann is not None or not build_ann):
+        final = store.EmbeddingStore(old_paths, old_embeddings, dtype=dtype, ann=old_ann if build_ann else None,
+                                     columns=old_columns, encoder=saved.encoder)
+        yield report(final, finished=True)
+        return
+    
+    if cancelled and saved is not None:
+        # Keep the saved rows of files the walk had not reached yet; they are checked next time
+        unseen = [(path, i) for path, i in rows_by_path.items() if path not in files]
+        for path, i in unseen:
+            files[path] = (int(old_columns["size"][i]), float(old_columns["mtime"][i]))
+        reused_pending.extend(unseen)
+        append_reused()
+    
+    # Files that failed to load are left out so they are retried next time
+    embedding_store = results.snapshot()
+    if len(embedding_store):
+        embedding_store.encoder = dict(embedding_store.encoder, dim=embedding_store.dim)
+    
+    if build_ann and len(embedding_store) and not cancelled:
+        dim = embedding_store.dim
+        reuse = (
+            old_ann is not None and old_ann.centroids.shape[1] == dim
+            and ann_lists in (None, old_ann.n_lists) and pq_subspaces == old_ann.pq_subspaces
+        )
+        with metrics.stage("ann_build", items=len(embedding_store)):
+            if reuse:
+                ann_index = IVFIndex(old_ann.centroids, codebooks=old_ann.codebooks)
+            else:
+                ann_index = IVFIndex.train(embedding_store.vectors, ann_lists, pq_subspaces)
+            embedding_store.ann = ann_index.add(embedding_store.vectors)
+    
+    if persist:
+        with metrics.stage("save", items=len(embedding_store)):
+            store.save_index(image_folder, embedding_store.paths, embedding_store.columns,
+                             embedding_store.matrix, embedding_store.ann, encoder=embedding_store.encoder)
+    
+    yield report(embedding_store, finished=True, cancelled=cancelled)
+
+def index_images(image_folder, batch_size=DEFAULT_BATCH_SIZE, num_workers=DEFAULT_NUM_WORKERS,
+                 persist=True, dtype=np.float32, build_ann=False, ann_lists=None, pq_subspaces=0,
+                 recursive=True, include=None, exclude=DEFAULT_EXCLUDE, fast_decode=True, isolate=False,
+                 decode_timeout=DECODE_TIMEOUT, decode_memory=DECODE_MEMORY_LIMIT, checkpoint_seconds=CHECKPOINT_SECONDS):
+    """
+    Scans the provided folder for images, preprocesses them, computes their embeddings,
+    and returns an EmbeddingStore mapping image file paths to their embeddings.
+
+    With `recursive` the whole folder tree is indexed; `include` and `exclude` are
+    glob patterns that select files and skip files or directories (see scanner.py).
+
+    Decoding and preprocessing run on `num_workers` threads, while the encoder
+    receives the images in batches of `batch_size`. With `fast_decode` JPEGs are
+    decoded at reduced resolution or from their EXIF thumbnail (see open_image).
+
+    With `isolate` the images are decoded in supervised worker processes (see
+    decoder.py): a file that takes longer than `decode_timeout` seconds, needs more
+    than `decode_memory` bytes or crashes the decoder fails on its own instead of
+    hanging or killing the whole run. The workers are started with "spawn", which
+    imports the calling script again in each of them: a script that indexes with
+    `isolate` must do so under `if __name__ == "__main__":`. The command line and
+    the GUI turn it on; decoding stays in threads by default.
+
+    With `persist` enabled the embeddings are saved to the folder's on-disk index
+    (see store.py). On the next call only new or changed images are encoded again,
+    and images that were deleted from the folder are dropped from the index. The
+    images encoded so far are also checkpointed every `checkpoint_seconds`, so an
+    interrupted run resumes where it stopped.
+
+    `dtype` selects the storage format, in memory and on disk: np.float32, np.float16,
+    "int8" (scalar-quantized) or "binary" (sign bits re-ranked with int8 codes),
+    see quantize.py.
+
+    With `build_ann` an approximate nearest-neighbour index (see ann.py) with
+    `ann_lists` clusters (default: about 4 * sqrt(N)) and, if `pq_subspaces` > 0,
+    product-quantized residuals is built and attached to the returned store.
+    Once trained, its centroids are reused when the folder is re-indexed.
+
+    The embeddings are computed by the active encoder (see set_encoder), which is
+    recorded in the index; a saved index built with another model is rebuilt.
+
+    See iter_index_images for a version that reports progress and can be cancelled.
+    """
+    progress = None
+    for progress in iter_index_images(image_folder, batch_size, num_workers, persist, dtype,
+                                      build_ann, ann_lists, pq_subspaces, recursive, include, exclude,
+                                      fast_decode=fast_decode, isolate=isolate, decode_timeout=decode_timeout,
+                                      decode_memory=decode_memory, checkpoint_seconds=checkpoint_seconds):
+        pass
+    return progress.results
+
+def update_index(image_folder, embeddings, paths, batch_size=DEFAULT_BATCH_SIZE, num_workers=DEFAULT_NUM_WORKERS,
+                 persist=True, fast_decode=True):
+    """
+    Applies changes to single files of an indexed folder without walking it again:
+    every path in `paths` (added, changed or deleted files, e.g. from watcher.py) is
+    looked at once more. Deleted files are dropped, new or modified ones are encoded,
+    and files whose size and mtime did not change keep their row.
+
+    A file with the same bytes as one that was dropped in the same update (a rename
+    or move) reuses its embedding. Files that fail to load are left out.
+
+    Returns a new EmbeddingStore (`embeddings` itself if nothing changed), with its
+    ANN index, if any, rebuilt on the same centroids; with `persist` it is saved too.
+    A memory-mapped index is not copied into memory for this: the saved index is
+    rewritten from its mapped rows block by block (see _rewrite_index) and the
+    result is memory-mapped again. Either way, every update writes the whole index.
+    Raises encoders.EncoderMismatch if the active encoder cannot add to the index.
+    """
+    embeddings = store.EmbeddingStore.from_dict(embeddings)
+    encoder = _encoder
+    check_encoder(embeddings, encoder)
+    columns = embeddings.columns
+    dropped, to_load = [], []
+    for path in sorted(set(paths)):
+        row = embeddings.row(path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            if row is not None:
+                dropped.append(path)
+            continue
+        if row is not None:
+            if "size" in columns and (columns["size"][row], columns["mtime"][row]) == (stat.st_size, stat.st_mtime):
+                continue
+            dropped.append(path)
+        to_load.append((path, stat))
+    if not dropped and not to_load:
+        return embeddings
+
+    # Embeddings and content columns of the dropped rows, by content hash, for renamed and moved files
+    moved = {}
+    if "hash" in columns:
+        for path in dropped:
+            row = embeddings.row(path)
+            content = {name: columns[name][row:row + 1] for name in store.CONTENT_COLUMNS if name in columns}
+            moved[columns["hash"][row].decode("ascii")] = (np.array(embeddings.vectors[row]), content)
+
+    # New rows go into a store of their own when a mapped index is rewritten from disk
+    rewrite = persist and embeddings.mapped
+    if rewrite:
+        results = store.EmbeddingStore(dtype=embeddings.format, encoder=embeddings.encoder)
+    else:
+        results = embeddings.without(dropped)
+    stats = dict(to_load)
+
+    def add_rows(paths, rows, digests, content):
+        results.append(paths, rows, columns=dict(content, **{
+            "size": [stats[path].st_size for path in paths],
+            "mtime": [stats[path].st_mtime for path in paths],
+            "hash": digests,
+        }))
+
+    batch_paths, batch_tensors, batch_hashes, batch_contents = [], [], [], []
+
+    def flush():
+        add_rows(batch_paths, _encode_batch(batch_tensors, encoder), batch_hashes, _content_columns(batch_contents))
+        metrics.count("live_encoded", len(batch_paths))
+        for batch in (batch_paths, batch_tensors, batch_hashes, batch_contents):
+            batch.clear()
+
+    with ThreadPoolExecutor(max_workers=max(1, num_workers)) as executor:
+        prefetch = 2 * max(batch_size, num_workers)
+        loading = (path for path, _ in to_load)
+        for path, loaded in _iter_preprocessed(loading, executor, prefetch, moved, fast_decode, encoder):
+            if loaded is None:
+                continue
+            digest, tensor, content = loaded
+            if tensor is None:
+                embedding, content = moved[digest]
+                add_rows([path], embedding, [digest], content)
+                continue
+            batch_paths.append(path)
+            batch_tensors.append(tensor)
+            batch_hashes.append(digest)
+            batch_contents.append(content)
+            if len(batch_tensors) >= batch_size:
+                flush()
+        if batch_tensors:
+            flush()
+    if not dropped and len(results) == (0 if rewrite else len(embeddings)):
+        # Only files that failed to load
+        return embeddings
+    metrics.count("live_removed", len(dropped))
+    if results.encoder is None and len(results):
+        results.encoder = dict(encoder.info(), dim=results.dim)
+    if rewrite:
+        return _rewrite_index(image_folder, embeddings, dropped, results)
+
+    if embeddings.ann is not None and len(results):
+        with metrics.stage("ann_build", items=len(results)):
+            ann_index = IVFIndex(embeddings.ann.centroids, codebooks=embeddings.ann.codebooks)
+            results.ann = ann_index.add(results.vectors)
+
+    if persist:
+        with metrics.stage("save", items=len(results)):
+            store.save_index(image_folder, results.paths, results.columns, results.matrix, results.ann,
+                             encoder=results.encoder)
+    return results
+
+def _rewrite_index(image_folder, saved, dropped, added):
+    """
+    Saves the memory-mapped index `saved` without the rows of the `dropped` paths and
+    with the rows of the `added` store at the end, reading the saved rows block by
+    block, and returns the new index, memory-mapped as well (see update_index).
+    """
+    keep = np.ones(len(saved), dtype=bool)
+    for path in dropped:
+        keep[saved.row(path)] = False
+    paths = [path for path, kept in zip(saved.paths, keep) if kept] + list(added.paths)
+    # Columns only one side has are zero on the other, as EmbeddingStore.append does
+    columns = {}
+    for name in set(saved.columns) | set(added.columns):
+        old, new = saved.column(name), added.column(name)
+        template = old if old is not None else new
+        if old is None:
+            old = np.zeros((len(saved),) + template.shape[1:], dtype=template.dtype)
+        if new is None:
+            new = np.zeros((len(added),) + template.shape[1:], dtype=template.dtype)
+        columns[name] = np.concatenate([old[keep], new])
+    rows = store.ConcatenatedRows([(saved.matrix, keep), (added.matrix, None)])
+    encoder = saved.encoder or added.encoder
+    with metrics.stage("save", items=len(paths)):
+        store.save_index(image_folder, paths, columns, rows, encoder=encoder)
+    results = store.open_index(image_folder)
+
+    if saved.ann is not None and len(results):
+        with metrics.stage("ann_build", items=len(results)):
+            ann_index = IVFIndex(saved.ann.centroids, codebooks=saved.ann.codebooks)
+            results.ann = ann_index.add(results.vectors)
+        # The lists are built from the rewritten rows, so the index is saved once more
+        # (from the mapped matrix, again without reading it into memory)
+        with metrics.stage("save", items=len(results)):
+            store.save_index(image_folder, results.paths, results.columns, results.matrix, results.ann,
+                             encoder=encoder)
+        results = store.open_index(image_folder)
+    return results
+
+def encode_texts(queries, use_cache=True, encoder=None):
+    """
+    Returns the normalized embeddings of a list of text queries as an (N, D)
+    float32 array, computed by `encoder` (default: the active encoder). Queries found
+    in the text cache are not encoded again; all the others go through the text
+    encoder together in a single forward pass.
+    """
+    encoder = encoder or _encoder
+    queries = list(queries)
+    embeddings = [text_cache.get(encoder.name, query) if use_cache else None for query in queries]
+    missing = sorted({query for query, embedding in zip(queries, embeddings) if embedding is None})
+    
+    if missing:
+        encoder.load()
+        with metrics.stage("text_encode", items=len(missing)):
+            text_embeddings = encoder.encode_texts(missing)
+        
+        encoded = dict(zip(missing, text_embeddings))
+        for query in missing:
+            text_cache.put(encoder.name, query, encoded[query])
+        embeddings = [encoded[query] if embedding is None else embedding for query, embedding in zip(queries, embeddings)]
+    
+    if not embeddings:
+        return np.empty((0, 0), dtype=np.float32)
+    return np.stack(embeddings)
+
+def image_embedding(path, image_embeddings=None, encoder=None):
+    """
+    Returns the normalized (D,) embedding of an image file. An image that
+    `image_embeddings` (an EmbeddingStore or a library.Library) already holds gets its
+    stored embedding, without reading the file; any other image is read and encoded
+    by `encoder` (default: the active encoder). Returns None if it cannot be read.
+    """
+    if image_embeddings is not None and hasattr(image_embeddings, "vector"):
+        for candidate in dict.fromkeys((path, os.path.abspath(path))):
+            vector = image_embeddings.vector(candidate)
+            if vector is not None:
+                metrics.count("query_image_stored")
+                return vector
+    encoder = encoder or _encoder
+    loaded = _load_image(path, encoder=encoder)
+    if loaded is None:
+        return None
+    metrics.count("query_image_encoded")
+    return _encode_batch([loaded[1]], encoder)[0].astype(np.float32)
+
+def combine_queries(vectors, weights=None):
+    """
+    Mixes query vectors (normalized image and text embeddings) into one normalized
+    query: their weighted sum (equal weights by default), so the results are the
+    images closest to all of them.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32).reshape(len(vectors), -1)
+    weights = np.ones(len(vectors), dtype=np.float32) if weights is None else np.asarray(weights, dtype=np.float32)
+    query = weights @ vectors
+    norm = np.linalg.norm(query)
+    return query / norm if norm > 0 else query
+
+def search_by_embedding(query_embedding, image_embeddings, top_k=10, nprobe=DEFAULT_NPROBE,
+                        threshold=SEARCH_THRESHOLD, collapse=False, near_duplicates=False, where=None,
+                        cutoff=None, offset=0):
+    """
+    Returns the top_k (path, similarity) pairs for an already normalized query
+    embedding, dropping results with a similarity score <= threshold.
+    With `collapse`, duplicates are grouped and (path, similarity, alternate paths)
+    triples are returned instead (see EmbeddingStore.top_k_groups).
+    `where` (a filters.Filter) limits the search to the images matching it; they are
+    selected before scoring, so a selective filter makes the search cheaper.
+    `cutoff` (a calibration.Cutoff) ends the results where they stop being relevant
+    to this query, and `offset` skips the first results, for paging through them.
+    """
+    # Since embeddings are normalized, the dot product with the whole matrix gives the
+    # cosine similarity of every image at once. Stores and libraries (see library.py)
+    # search themselves; a plain dictionary is turned into a store first.
+    embedding_store = image_embeddings
+    if not hasattr(embedding_store, "top_k"):
+        embedding_store = store.EmbeddingStore.from_dict(image_embeddings)
+    with metrics.stage("search"):
+        if collapse:
+            return embedding_store.top_k_groups(query_embedding, top_k, threshold=threshold, nprobe=nprobe,
+                                                near_duplicates=near_duplicates, where=where,
+                                                cutoff=cutoff, offset=offset)
+        return embedding_store.top_k(query_embedding, top_k, threshold=threshold, nprobe=nprobe, where=where,
+                                     cutoff=cutoff, offset=offset)
+
+def search_images(query, image_embeddings, top_k=10, nprobe=DEFAULT_NPROBE, collapse=False, near_duplicates=False,
+                  where=None, threshold=SEARCH_THRESHOLD, cutoff=None, offset=0):
+    """
+    Given a text query and the precomputed image embeddings (an EmbeddingStore, a
+    library.Library or a {path: embedding} dictionary), this function returns the top_k image paths that
+    best match the query, filtering out results with a similarity score <= threshold (0.2).
+    `cutoff` and `offset` work as in search_by_embedding.
+    If the store has an ANN index, `nprobe` sets how many of its clusters are searched.
+    With `collapse`, copies of the same image count as one result, returned as
+    (path, similarity, alternate paths); `near_duplicates` also groups resized or
+    re-encoded copies.
+    `where` (a filters.Filter) limits the results to images with matching metadata.
+    Without it, `key:value` filter terms in the query ("beach after:2023-06-01
+    camera:canon", see filters.py) are taken out of the text and applied instead.
+    Raises encoders.EncoderMismatch if the index was built with another model than
+    the active encoder, and ValueError for a filter term with an invalid value.
+    """
+    if where is None:
+        query, where = filters.split_query(query)
+    encoder = _encoder
+    check_encoder(image_embeddings, encoder)
+    # Text embedding of the query (from the cache when it was searched before)
+    text_embedding = encode_texts([query], encoder=encoder)[0]
+    return search_by_embedding(text_embedding, image_embeddings, top_k, nprobe, threshold,
+                               collapse=collapse, near_duplicates=near_duplicates, where=where or None,
+                               cutoff=cutoff, offset=offset)
+
+
+def search_similar(images, image_embeddings, top_k=10, text=None, text_weight=0.5, nprobe=DEFAULT_NPROBE,
+                   collapse=False, near_duplicates=False, where=None, include_examples=False,
+                   threshold=SEARCH_THRESHOLD, cutoff=None, offset=0):
+    """
+    Query by example: returns the top_k images most similar to one or several
+    example images (paths), in the same form as search_images. Indexed examples use
+    their stored embedding (see image_embedding), so a search costs about as much as
+    a text search; other images are encoded first.
+
+    With `text`, the mean image query is mixed with the text embedding, which gets
+    `text_weight` of the weight ("this photo, but at night"). Filter terms in the text
+    apply as in search_images.
+    The examples themselves, and byte-identical copies of them (same content hash),
+    are left out of the results unless `include_examples` (before `cutoff` and
+    `offset` apply, which work as in search_by_embedding).
+    Raises ValueError if an example cannot be read (or encoders.EncoderMismatch as
+    for search_images).
+    """
+    examples = [images] if isinstance(images, (str, os.PathLike)) else list(images)
+    encoder = _encoder
+    check_encoder(image_embeddings, encoder)
+    vectors = []
+    hashes = []
+    for path in examples:
+        vector = image_embedding(path, image_embeddings, encoder)
+        if vector is None:
+            raise ValueError(f"Could not read the image {path}")
+        vectors.append(vector)
+        if not include_examples:
+            try:
+                with open(path, "rb") as f:
+                    hashes.append(store.content_hash(f.read()))
+            except OSError:
+                pass
+    query_embedding = combine_queries(vectors)
+    if text:
+        text, parsed = filters.split_query(text)
+        where = where or parsed
+        if text:
+            text_embedding = encode_texts([text], encoder=encoder)[0]
+            query_embedding = combine_queries([query_embedding, text_embedding], [1 - text_weight, text_weight])
+
+    if not include_examples:
+        # Left out by the filter, so they take no place in the ranking and no part in the cut-off
+        where = (where or filters.Filter()).excluding(examples, hashes)
+    results = search_by_embedding(query_embedding, image_embeddings, top_k, nprobe, threshold,
+                                  collapse=collapse, near_duplicates=near_duplicates, where=where or None,
+                                  cutoff=cutoff, offset=offset)
+    if include_examples or not collapse:
+        return results
+    # An example whose file could not be hashed (e.g. since deleted) may be an alternate of its copies
+    excluded = {os.path.abspath(path) for path in examples}
+    return [(path, score, [alternate for alternate in alternates if os.path.abspath(alternate) not in excluded])
+            for path, score, alternates in results]
+
+
+if __name__ == "__main__":
+    # Command-line interface: python main.py index|search|stats|serve ... (see cli.py)
+    import cli
+    cli.run()
@@ -0,0 +1,178 @@
+"""
+Timing counters and profiler hooks for SnapSeek's indexing and search paths.
+
+main.py wraps every stage of indexing (reading and hashing the file, Image.open,
+convert("RGB"), preprocessing, the encode_image forward pass and the copy of the
+embeddings back to host memory) and of search (text encoding, scoring) in
+`metrics.stage(name)`, which adds the elapsed time to that stage's counters.
+
+Profiler hooks are callables taking the stage name and returning a context
+manager (or None); they are entered around every stage, e.g. to label the stages
+in a torch.profiler trace (see torch_profiler_hook).
+
+Files that fail to load, and the slowest files, are kept with their per-stage
+times so they can be reported instead of only being printed.
+"""
+import time
+import heapq
+import threading
+from contextlib import contextmanager, ExitStack
+
+# Files that take longer than this to read, decode and preprocess are reported as slow (seconds)
+SLOW_FILE_SECONDS = 1.0
+
+# At most this many failed and slow files are kept
+MAX_REPORTED_FILES = 200
+
+class StageStats:
+    """Counters of one stage: calls, items handled (e.g. images in a batch), total and longest time."""
+
+    def __init__(self):
+        self.calls = 0
+        self.items = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+
+    def as_dict(self):
+        return {
+            "calls": self.calls,
+            "items": self.items,
+            "total_s": round(self.seconds, 6),
+            "mean_ms": round(1000 * self.seconds / self.calls, 4) if self.calls else None,
+            "per_item_ms": round(1000 * self.seconds / self.items, 4) if self.items else None,
+            "max_ms": round(1000 * self.max_seconds, 4),
+        }
+
+class Metrics:
+    """Thread-safe per-stage timing counters, profiler hooks and a report of failed and slow files."""
+
+    def __init__(self, slow_seconds=SLOW_FILE_SECONDS, max_files=MAX_REPORTED_FILES):
+        self.slow_seconds = slow_seconds
+        self.max_files = max_files
+        self.enabled = True
+        self._lock = threading.Lock()
+        self._hooks = []
+        self._stages = {}
+        self._counters = {}
+        self._failed = []
+        self._failed_count = 0
+        # Min-heap of (seconds, sequence number, entry), so the fastest slow file is dropped first
+        self._slow = []
+        self._slow_count = 0
+
+    # --- Profiler hooks ---------------------------------------------------
+    def add_hook(self, hook):
+        """Registers hook(stage name) -> context manager (or None), entered around every stage."""
+        with self._lock:
+            self._hooks.append(hook)
+
+    def remove_hook(self, hook):
+        with self._lock:
+            self._hooks.remove(hook)
+
+    # --- Timing -------------------------------------------------------------
+    @contextmanager
+    def stage(self, name, timings=None, items=1):
+        """
+        Times the enclosed block as stage `name`. If a `timings` dict is given, the
+        elapsed time is also stored in it under `name` (per-file breakdowns).
+        The time is recorded even when the block raises.
+        """
+        if not self.enabled:
+            yield
+            return
+        with ExitStack() as stack:
+            for hook in list(self._hooks):
+                context = hook(name)
+                if context is not None:
+                    stack.enter_context(context)
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                seconds = time.perf_counter() - start
+                if timings is not None:
+                    timings[name] = timings.get(name, 0.0) + seconds
+                self.add(name, seconds, items)
+
+    def add(self, name, seconds, items=1):
+        """Adds a measurement taken elsewhere to the counters of a stage."""
+        with self._lock:
+            stats = self._stages.get(name)
+            if stats is None:
+                stats = self._stages[name] = StageStats()
+            stats.calls += 1
+            stats.items += items
+            stats.seconds += seconds
+            stats.max_seconds = max(stats.max_seconds, seconds)
+
+    def count(self, name, n=1):
+        """Increments a plain event counter (e.g. how many images took each decode path)."""
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    # --- File report --------------------------------------------------------
+    def file_failed(self, path, error, timings=None):
+        """Records a file that could not be loaded; the stage is the last one that was entered."""
+        stage = next(reversed(timings), None) if timings else None
+        entry = {"path": path, "stage": stage, "error": f"{type(error).__name__}: {error}"}
+        with self._lock:
+            self._failed_count += 1
+            if len(self._failed) < self.max_files:
+                self._failed.append(entry)
+
+    def file_done(self, path, timings):
+        """Records the per-stage times of a file if they add up to more than `slow_seconds`."""
+        seconds = sum(timings.values())
+        if seconds < self.slow_seconds:
+            return
+        entry = {"path": path, "seconds": round(seconds, 4),
+                 "stages": {name: round(value, 4) for name, value in timings.items()}}
+        with self._lock:
+            self._slow_count += 1
+            item = (seconds, self._slow_count, entry)
+            if len(self._slow) < self.max_files:
+                heapq.heappush(self._slow, item)
+            else:
+                heapq.heappushpop(self._slow, item)
+
+    # --- Reporting ----------------------------------------------------------
+    def snapshot(self):
+        """Returns the counters and the file report as a JSON-serializable dict."""
+        with self._lock:
+            return {
+                "stages": {name: stats.as_dict() for name, stats in self._stages.items()},
+                "counters": dict(self._counters),
+                "failed_files": list(self._failed),
+                "failed_count": self._failed_count,
+                "slow_files": [entry for _, _, entry in sorted(self._slow, reverse=True)],
+                "slow_count": self._slow_count,
+                "slow_threshold_s": self.slow_seconds,
+            }
+
+    def reset(self):
+        with self._lock:
+            self._stages.clear()
+            self._counters.clear()
+            self._failed.clear()
+            self._failed_count = 0
+            self._slow.clear()
+            self._slow_count = 0
+
+def torch_profiler_hook(stage):
+    """Profiler hook labelling every stage in torch.profiler traces as snapseek.<stage>."""
+    import torch
+    return torch.profiler.record_function(f"snapseek.{stage}")
+
+def format_stages(snapshot):
+    """Renders the stage counters of a snapshot as a plain-text table."""
+    lines = [f"{'stage':<12} {'calls':>8} {'total s':>9} {'mean ms':>9} {'per item ms':>12} {'max ms':>9}"]
+    for name, stats in snapshot["stages"].items():
+        per_item = f"{stats['per_item_ms']:.2f}" if stats["per_item_ms"] is not None else "-"
+        lines.append(f"{name:<12} {stats['calls']:>8} {stats['total_s']:>9.2f} "
+                     f"{stats['mean_ms']:>9.2f} {per_item:>12} {stats['max_ms']:>9.2f}")
+    if snapshot.get("counters"):
+        lines.append(", ".join(f"{name}: {value}" for name, value in sorted(snapshot["counters"].items())))
+    lines.append(f"{snapshot['failed_count']} failed file(s), "
+                 f"{snapshot['slow_count']} slow file(s) (> {snapshot['slow_threshold_s']:g}s)")
+    return "\n".join(lines)
@@ -0,0 +1,130 @@
+"""
+Compact embedding formats for SnapSeek.
+
+An EmbeddingStore can keep its embeddings in one of these formats (see the
+`dtype` argument of EmbeddingStore and main.index_images):
+  - "float32": 4 bytes per dimension, 2 KB per ViT-B/32 embedding
+  - "float16": 2 bytes per dimension
+  - "int8":    1 byte per dimension plus a float32 scale per vector (scalar
+               quantization: x ~= codes * scale with scale = max|x| / 127)
+  - "binary":  the int8 codes plus the signs of the embedding packed into bits
+               (64 bytes per vector). A query first ranks the bit codes by Hamming
+               distance, then re-ranks the best candidates with the int8 codes,
+               so a full scan only reads the bits.
+
+Queries are scored on the compact form directly, chunk by chunk, without
+decoding the whole matrix.
+
+Run this file on an indexed folder to compare recall@k, latency and size of
+every format against float32:
+    python quantize.py "D:/Photos" --k 10
+"""
+import time
+import argparse
+import numpy as np
+
+# Storage formats, and the dtype of the matrix each one keeps
+FORMATS = ("float32", "float16", "int8", "binary")
+CODE_DTYPES = {"float32": np.float32, "float16": np.float16, "int8": np.int8, "binary": np.int8}
+
+# Per-vector arrays the quantized formats keep next to the codes
+QUANTIZATION_COLUMNS = {"scale": np.float32, "bits": np.uint8}
+
+INT8_MAX = 127
+
+def format_name(dtype):
+    """Returns the format name for a format name or a NumPy dtype (np.float16 -> "float16")."""
+    name = dtype if dtype in FORMATS else np.dtype(dtype).name
+    if name not in FORMATS:
+        raise ValueError(f"Unsupported embedding format: {name}")
+    return name
+
+def quantize_int8(x):
+    """Returns the (N, D) int8 codes and (N,) float32 scales of the rows of x."""
+    x = np.asarray(x, dtype=np.float32)
+    if x.ndim == 1:
+        x = x[None]
+    scales = np.abs(x).max(axis=1, initial=0.0) / INT8_MAX
+    safe = np.where(scales > 0, scales, 1.0)
+    codes = np.clip(np.rint(x / safe[:, None]), -INT8_MAX, INT8_MAX).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+def dequantize_int8(codes, scales):
+    """float32 rows from int8 codes and their scales."""
+    return np.asarray(codes, dtype=np.float32) * np.asarray(scales, dtype=np.float32)[:, None]
+
+def pack_signs(x):
+    """Packs the signs of the rows of x (or of their int8 codes) into (N, D / 8) bytes."""
+    return np.packbits(np.asarray(x) > 0, axis=1)
+
+def hamming_scores(bits, query_bits):
+    """
+    Estimated similarity of every row of `bits` to the packed signs of a query:
+    1 - 2 * hamming distance / dimensions, the cosine of the two sign vectors.
+    """
+    bits = np.asarray(bits)
+    distances = np.bitwise_count(bits ^ query_bits).sum(axis=1, dtype=np.int32)
+    return 1.0 - 2.0 * distances.astype(np.float32) / (8 * bits.shape[1])
+
+def bytes_per_vector(name, dim):
+    """In-memory and on-disk size of one embedding in a format."""
+    if name == "binary":
+        return dim + 4 + dim // 8
+    if name == "int8":
+        return dim + 4
+    return dim * np.dtype(CODE_DTYPES[name]).itemsize
+
+# ----------------------------------------------------
+#               Recall report
+# ----------------------------------------------------
+def recall_report(embedding_store, queries, k=10, formats=FORMATS, rerank=None):
+    """
+    Rebuilds the store in every format and compares its results with an exact
+    float32 search. Returns one dict per format with recall@k (share of the float32
+    top k it also returned), the mean query latency in ms and the bytes per vector.
+    """
+    import store
+
+    queries = np.asarray(queries, dtype=np.float32)
+    vectors = np.asarray(embedding_store.vectors[:len(embedding_store)], dtype=np.float32)
+    columns = {name: values for name, values in embedding_store.columns.items() if name not in QUANTIZATION_COLUMNS}
+    reference = store.EmbeddingStore(embedding_store.paths, vectors, dtype="float32", columns=columns)
+    truth = [{path for path, _ in reference.top_k(query, k, exact=True)} for query in queries]
+
+    report = []
+    for name in formats:
+        compact = reference if name == "float32" else store.EmbeddingStore(
+            embedding_store.paths, vectors, dtype=name, columns=columns
+        )
+        hits, seconds = 0, 0.0
+        for query, expected in zip(queries, truth):
+            start = time.perf_counter()
+            found = compact.top_k(query, k, rerank=rerank)
+            seconds += time.perf_counter() - start
+            hits += len(expected & {path for path, _ in found})
+        report.append({
+            "format": name,
+            "recall": hits / max(1, sum(len(t) for t in truth)),
+            "query_ms": 1000 * seconds / max(1, len(queries)),
+            "bytes_per_vector": bytes_per_vector(name, vectors.shape[1]),
+        })
+    return report
+
+if __name__ == "__main__":
+    import store
+    from ann import sample_queries
+
+    parser = argparse.ArgumentParser(description="Recall@k of every embedding format against float32.")
+    parser.add_argument("folder", help="An indexed image folder")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--rerank", type=int, default=None, help="Binary candidates re-ranked with int8 codes")
+    args = parser.parse_args()
+
+    embedding_store = store.open_index(args.folder)
+    if embedding_store is None:
+        raise SystemExit(f"No saved index for {args.folder}")
+    queries = sample_queries(embedding_store, args.queries)
+    print(f"{'format':>8} {'recall@' + str(args.k):>10} {'query ms':>9} {'bytes/vec':>10}")
+    for row in recall_report(embedding_store, queries, args.k, rerank=args.rerank):
+        print(f"{row['format']:>8} {row['recall']:>10.3f} {row['query_ms']:>9.2f} {row['bytes_per_vector']:>10}")
@@ -0,0 +1,140 @@
+"""
+Recursive image discovery for SnapSeek.
+
+scan_images walks a folder tree with os.scandir and yields every image as soon as
+its directory has been listed, so indexing can start long before a large tree has
+been fully walked. Directories are listed on a small thread pool, which mostly
+helps on network shares where each listing waits on the server.
+"""
+import os
+import re
+import fnmatch
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# Supported image extensions
+VALID_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".gif")
+
+# Files and directories skipped by default: hidden entries, NAS thumbnail folders
+# and Windows system folders
+DEFAULT_EXCLUDE = (".*", "@eaDir", "$RECYCLE.BIN", "System Volume Information")
+
+# Directories listed in parallel
+DEFAULT_SCAN_WORKERS = 8
+
+def _compile_patterns(patterns):
+    """Combines glob patterns into a single case-insensitive regex (None if there are none)."""
+    if not patterns:
+        return None
+    return re.compile("|".join(fnmatch.translate(p) for p in patterns), re.IGNORECASE)
+
+class _Rules:
+    """Include/exclude matching shared by all directory listings of one scan."""
+
+    def __init__(self, root, include, exclude):
+        self.root = root
+        self.include = _compile_patterns(include)
+        self.exclude = _compile_patterns(exclude)
+        self.extensions = frozenset(VALID_EXTENSIONS)
+
+    def excluded(self, entry):
+        return self.excluded_path(entry.path, entry.name)
+
+    def excluded_path(self, path, name):
+        if self.exclude is None:
+            return False
+        # Patterns can name an entry ("@eaDir") or a path below the root ("Backups/*")
+        relative = os.path.relpath(path, self.root).replace(os.sep, "/")
+        return bool(self.exclude.match(name) or self.exclude.match(relative))
+
+    def accepts(self, path, is_dir=False):
+        """True if a scan of the root would reach `path` (an image file, or a directory with `is_dir`)."""
+        relative = os.path.relpath(path, self.root)
+        if relative == os.curdir:
+            return is_dir
+        if relative.startswith(os.pardir + os.sep) or relative == os.pardir:
+            return False
+        # Every directory on the way down must have been entered too
+        current = self.root
+        for part in relative.split(os.sep):
+            current = os.path.join(current, part)
+            if self.excluded_path(current, part):
+                return False
+        return is_dir or self.included(os.path.basename(path))
+
+    def included(self, name):
+        if self.include is not None:
+            return bool(self.include.match(name))
+        return os.path.splitext(name)[1].lower() in self.extensions
+
+def _list_directory(path, rules, follow_symlinks):
+    """Lists one directory; returns ([(file path, stat)], [subdirectory paths])."""
+    files, subdirs = [], []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    if rules.excluded(entry):
+                        continue
+                    if entry.is_dir(follow_symlinks=follow_symlinks):
+                        subdirs.append(entry.path)
+                    elif rules.included(entry.name) and entry.is_file(follow_symlinks=follow_symlinks):
+                        files.append((entry.path, entry.stat(follow_symlinks=follow_symlinks)))
+                except OSError as e:
+                    print(f"Error scanning {entry.path}: {e}")
+    except OSError as e:
+        print(f"Error scanning {path}: {e}")
+    return files, subdirs
+
+def path_filter(root, include=None, exclude=DEFAULT_EXCLUDE):
+    """
+    Returns accepts(path, is_dir=False): whether scan_images(root, include=include,
+    exclude=exclude) would yield that file, or enter that directory. Used to match
+    single paths, e.g. filesystem change events, against the scan rules.
+    """
+    return _Rules(root, include, exclude).accepts
+
+def scan_images(root, recursive=True, include=None, exclude=DEFAULT_EXCLUDE,
+                follow_symlinks=False, num_workers=DEFAULT_SCAN_WORKERS):
+    """
+    Yields (path, os.stat_result) for every image under `root`, as directories are listed.
+
+    `include` is a list of glob patterns for file names (default: the supported
+    image extensions); `exclude` patterns skip files and whole directories, matched
+    against either their name or their path relative to the root.
+    Every directory is visited at most once, even through symlinks or junctions
+    that point back up the tree.
+    """
+    rules = _Rules(root, include, exclude)
+    if not recursive:
+        files, _ = _list_directory(root, rules, follow_symlinks)
+        yield from files
+        return
+
+    # Directories already queued, by (device, inode), to break symlink loops
+    visited = set()
+
+    def first_visit(path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        key = (stat.st_dev, stat.st_ino)
+        # Some filesystems report no inode numbers; fall back to the resolved path
+        if not stat.st_ino:
+            key = os.path.realpath(path)
+        if key in visited:
+            return False
+        visited.add(key)
+        return True
+
+    first_visit(root)
+    with ThreadPoolExecutor(max_workers=max(1, num_workers)) as executor:
+        running = {executor.submit(_list_directory, root, rules, follow_symlinks)}
+        while running:
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, subdirs = future.result()
+                for subdir in subdirs:
+                    if first_visit(subdir):
+                        running.add(executor.submit(_list_directory, subdir, rules, follow_symlinks))
+                yield from files
@@ -0,0 +1,215 @@
+"""
+Local HTTP query server for SnapSeek.
+
+Loads the CLIP model and a folder's saved index once and answers search requests
+from other local tools, so they all share one warm process:
+
+    GET /search?q=a+boy+wearing+a+hat&k=10   -> {"query", "results": [{"path", "score"}], "took_ms"}
+        &collapse=1 groups identical files ("alternates" lists the other copies),
+        &near=1 resized or re-encoded copies as well
+        &offset=20 returns the next page; &threshold=0.25 drops lower scores, and the
+        cut-offs of calibration.py end the results adaptively: &z=2 (z-score),
+        &gap=0.03 (score drop), &margin=0.05 (distance to the best score)
+        q may hold filter terms, e.g. q=beach+after:2023-06-01+type:jpg (see filters.py)
+    GET /similar?path=D:/Photos/a.jpg&k=10   -> the same, for images similar to an indexed or other image
+        &q=at+night mixes in a text query (&w=0.5 its weight), &collapse/&near as above
+    GET /stats                               -> size of the loaded index
+    GET /metrics                             -> per-stage timings (see profiling.py)
+    GET /health                              -> {"status": "ok"}
+
+With `watch` the folder is followed by a FolderWatcher (see watcher.py): added,
+changed and deleted photos show up in the results without restarting the server.
+
+Requests are handled on a thread pool. Text queries that arrive at about the same
+time are micro-batched: QueryBatcher waits a few milliseconds for more queries and
+then runs all of them through the text encoder in a single forward pass.
+"""
+import json
+import time
+import queue
+import threading
+from concurrent.futures import Future
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import main
+import filters
+from calibration import Cutoff
+from watcher import FolderWatcher
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+
+# Micro-batching: longest wait for more queries, and largest batch
+BATCH_WAIT_SECONDS = 0.005
+MAX_BATCH_SIZE = 64
+
+class QueryBatcher:
+    """Collects concurrent text queries and encodes them together with main.encode_texts."""
+
+    def __init__(self, max_wait=BATCH_WAIT_SECONDS, max_batch=MAX_BATCH_SIZE):
+        self.max_wait = max_wait
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="query-batcher", daemon=True)
+        self._thread.start()
+
+    def encode(self, query):
+        """Returns the normalized embedding of one query (blocks until its batch is encoded)."""
+        future = Future()
+        self._queue.put((query, future))
+        return future.result()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            try:
+                embeddings = main.encode_texts([query for query, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), embedding in zip(batch, embeddings):
+                future.set_result(embedding)
+
+class SearchHandler(BaseHTTPRequestHandler):
+    """Request handler; the server object carries the index and the batcher."""
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        try:
+            if url.path == "/search":
+                self._send(200, self._search(params))
+            elif url.path == "/similar":
+                self._send(200, self._similar(params))
+            elif url.path == "/stats":
+                self._send(200, {"folder": self.server.folder, "images": len(self.server.embeddings)})
+            elif url.path == "/metrics":
+                self._send(200, main.metrics.snapshot())
+            elif url.path == "/health":
+                self._send(200, {"status": "ok"})
+            else:
+                self._send(404, {"error": f"Unknown endpoint: {url.path}"})
+        except ValueError as e:
+            self._send(400, {"error": str(e)})
+        except Exception as e:
+            self._send(500, {"error": str(e)})
+
+    def _search(self, params):
+        query = params.get("q", [""])[0].strip()
+        if not query:
+            raise ValueError("Missing query parameter 'q'")
+        top_k = int(params.get("k", ["10"])[0])
+        near_duplicates = params.get("near", ["0"])[0] == "1"
+        collapse = near_duplicates or params.get("collapse", ["0"])[0] == "1"
+        start = time.perf_counter()
+        text, where = filters.split_query(query)
+        embedding = self.server.batcher.encode(text)
+        results = main.search_by_embedding(embedding, self.server.embeddings, top_k, threshold=self._threshold(params),
+                                           collapse=collapse, near_duplicates=near_duplicates, where=where or None,
+                                           cutoff=self._cutoff(params), offset=self._offset(params))
+        return self._payload(query, results, collapse, start)
+
+    def _similar(self, params):
+        path = params.get("path", [""])[0].strip()
+        if not path:
+            raise ValueError("Missing query parameter 'path'")
+        top_k = int(params.get("k", ["10"])[0])
+        near_duplicates = params.get("near", ["0"])[0] == "1"
+        collapse = near_duplicates or params.get("collapse", ["0"])[0] == "1"
+        start = time.perf_counter()
+        results = main.search_similar(path, self.server.embeddings, top_k, text=params.get("q", [""])[0].strip(),
+                                      text_weight=float(params.get("w", ["0.5"])[0]),
+                                      collapse=collapse, near_duplicates=near_duplicates,
+                                      threshold=self._threshold(params), cutoff=self._cutoff(params),
+                                      offset=self._offset(params))
+        return self._payload(path, results, collapse, start)
+
+    @staticmethod
+    def _offset(params):
+        offset = int(params.get("offset", ["0"])[0])
+        if offset < 0:
+            raise ValueError("'offset' must not be negative")
+        return offset
+
+    @staticmethod
+    def _threshold(params):
+        return float(params.get("threshold", [str(main.SEARCH_THRESHOLD)])[0])
+
+    @staticmethod
+    def _cutoff(params):
+        """The Cutoff of the z, gap and margin parameters (each optional)."""
+        def value(name):
+            return float(params[name][0]) if name in params else None
+        return Cutoff(min_z=value("z"), max_gap=value("gap"), top_margin=value("margin"))
+
+    def _payload(self, query, results, collapse, start):
+        if collapse:
+            results = [{"path": path, "score": score, "alternates": alternates}
+                       for path, score, alternates in results]
+        else:
+            results = [{"path": path, "score": score} for path, score in results]
+        return {
+            "query": query,
+            "results": results,
+            "took_ms": round(1000 * (time.perf_counter() - start), 2),
+        }
+
+    def _send(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Keep the console quiet; errors are returned to the client
+        pass
+
+class SearchServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, folder, embeddings, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        super().__init__((host, port), SearchHandler)
+        self.folder = folder
+        self.embeddings = embeddings
+        self.batcher = QueryBatcher()
+
+def serve(folder, host=DEFAULT_HOST, port=DEFAULT_PORT, embeddings=None, watch=True, isolate=False):
+    """
+    Loads the model and the folder's index, then serves requests until interrupted.
+    With `watch`, changes to the folder are applied to the served index as they happen.
+    `isolate` decodes in worker processes while indexing (see main.index_images).
+    """
+    if embeddings is None:
+        embeddings = main.index_images(folder, isolate=isolate)
+    main.check_encoder(embeddings)
+    main.load_model()
+    server = SearchServer(folder, embeddings, host, port)
+    watcher = None
+    if watch:
+        # Requests read server.embeddings once, so swapping it is enough
+        def swap(updated, paths):
+            server.embeddings = updated
+        watcher = FolderWatcher(folder, embeddings, on_update=swap).start()
+    print(f"Serving {len(embeddings)} image(s) from {folder} on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if watcher is not None:
+            watcher.stop()
+        server.server_close()
+        main.text_cache.save()
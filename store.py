@@ -0,0 +1,999 @@
+"""
+Embedding storage for SnapSeek.
+
+EmbeddingStore keeps the embeddings of an index in memory as one contiguous
+matrix and scores queries against it.
+
+Every indexed folder gets its own directory under ~/.snapseek/indexes holding:
+  - manifest.json       : format version, source folder, row count, encoder and current file names
+  - embeddings.<g>.npy  : (N, D) float32 (or float16, or int8) matrix of normalized image embeddings
+  - scale/bits.<g>.npy  : per-vector scales of int8 codes and packed sign bits (see quantize.py)
+  - paths.<g>.bin       : the image paths as one UTF-8 blob, with path_offsets.<g>.npy
+  - size/mtime/hash/phash.<g>.npy : per-file size, mtime, content hash and perceptual hash columns
+  - taken/camera.<g>.npy : per-file EXIF capture time and camera, for filtered searches (see filters.py)
+  - checkpoint.<n>.npz  : rows encoded by an index run that did not finish, until the next save
+                          (see save_checkpoint)
+
+All arrays are plain .npy files, so an index can be memory-mapped and searched
+without loading it (see open_index).
+
+The size/mtime pair lets a re-index skip unchanged files without reading them,
+and the content hash lets touched-but-identical or renamed files reuse their
+previous embedding instead of being encoded again. The hashes also group
+duplicates in search results (see EmbeddingStore.top_k_groups): byte-identical
+copies share a content hash, near-duplicates have close perceptual hashes.
+"""
+import os
+import re
+import json
+import hashlib
+import zipfile
+import threading
+from collections import deque
+from collections.abc import Mapping, Sequence
+import numpy as np
+from ann import IVFIndex, DEFAULT_NPROBE
+from calibration import ScoreMoments
+from quantize import (CODE_DTYPES, QUANTIZATION_COLUMNS, format_name, quantize_int8, dequantize_int8,
+                      pack_signs, hamming_scores)
+
+# Where the per-folder indexes live
+INDEX_ROOT = os.path.join(os.path.expanduser("~"), ".snapseek", "indexes")
+
+# Bump whenever the on-disk layout changes; older indexes are then rebuilt
+INDEX_VERSION = 2
+
+# Per-file bookkeeping and metadata columns saved next to the embeddings, with their dtypes.
+# "taken" is the EXIF capture time (seconds since the epoch, 0 if unknown) and "camera"
+# the lowercased EXIF make and model (b"" if unknown)
+FILE_COLUMNS = {"size": np.int64, "mtime": np.float64, "hash": "S32", "phash": np.uint64,
+                "taken": np.float64, "camera": "S48"}
+
+# Columns that only depend on the bytes of a file, so copies with the same content hash share them
+CONTENT_COLUMNS = ("phash", "taken", "camera")
+
+# Columns an index saved by an older release may lack; they load as zeros (unknown)
+OPTIONAL_COLUMNS = ("phash", "taken", "camera")
+
+# Dtypes of every per-row column a store may hold
+COLUMN_DTYPES = dict(FILE_COLUMNS, **QUANTIZATION_COLUMNS)
+
+# Matrix dtypes an index may be saved with
+STORE_DTYPES = (np.float32, np.float16, np.int8)
+
+# Rows scored per step when the matrix is memory-mapped
+SCORE_CHUNK_ROWS = 65536
+
+# Rows upcast to float32 per step when scoring float16 or int8 rows: the upcast block
+# is reused and stays small enough to be in cache when the product reads it
+SCORE_UPCAST_ROWS = 4096
+
+# Paths compared per step by PathList.startswith/endswith
+PATH_MATCH_CHUNK_ROWS = 65536
+
+# A filtered search on a store with an ANN index scans the matching rows exactly when
+# at most this share of the store matches (cheaper than probing clusters for them)
+FILTER_EXACT_SHARE = 0.1
+
+# When more than this share of the store matches a filter, every row is scored and the
+# scores of the matching rows are picked out (cheaper than gathering their embeddings)
+FILTER_GATHER_SHARE = 0.5
+
+# Perceptual hashes at most this many bits apart (out of 64) mark near-duplicates
+PHASH_MAX_DISTANCE = 6
+
+# Near-duplicates look alike to CLIP too, so a result is only compared with the
+# groups scoring within this much of it
+NEAR_DUPLICATE_SCORE_GAP = 0.03
+
+class PathList(Sequence):
+    """
+    Image paths stored as a single UTF-8 blob plus an array of offsets.
+    Both parts can be memory-mapped, so opening an index of millions of images does not
+    decode every path up front; a path is only decoded when it is accessed.
+    """
+
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    @classmethod
+    def from_paths(cls, paths):
+        if isinstance(paths, cls):
+            return paths
+        encoded = [path.encode("utf-8") for path in paths]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(e) for e in encoded], out=offsets[1:])
+        return cls(np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets)
+
+    @classmethod
+    def load(cls, directory, files, mmap=True):
+        """Loads the blob and offsets saved under the names in an index manifest."""
+        offsets = np.load(os.path.join(directory, files["path_offsets"]), mmap_mode="r" if mmap else None)
+        blob_path = os.path.join(directory, files["paths"])
+        if os.path.getsize(blob_path) == 0:
+            # np.memmap refuses empty files
+            blob = np.empty(0, dtype=np.uint8)
+        elif mmap:
+            blob = np.memmap(blob_path, dtype=np.uint8, mode="r")
+        else:
+            blob = np.fromfile(blob_path, dtype=np.uint8)
+        return cls(blob, offsets)
+
+    def save(self, directory, generation):
+        """Writes the blob and offsets; returns their file names for the manifest."""
+        files = {"paths": f"paths.{generation}.bin", "path_offsets": f"path_offsets.{generation}.npy"}
+        _atomic_write(os.path.join(directory, files["paths"]), lambda f: f.write(self.blob.tobytes()))
+        _atomic_write(os.path.join(directory, files["path_offsets"]), lambda f: np.save(f, self.offsets))
+        return files
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def startswith(self, prefix, ignore_case=False):
+        """
+        (N,) boolean mask of the paths starting with `prefix`, compared on the encoded
+        bytes (ASCII case-insensitively with `ignore_case`).
+        """
+        return self._match(prefix, self.offsets[:-1], from_end=False, ignore_case=ignore_case)
+
+    def endswith(self, suffix, ignore_case=False):
+        """(N,) boolean mask of the paths ending with `suffix` (ASCII case-insensitively with `ignore_case`)."""
+        return self._match(suffix, self.offsets[1:], from_end=True, ignore_case=ignore_case)
+
+    def find(self, path):
+        """Position of `path`, or None; a vectorized scan, so no path has to be decoded."""
+        lengths = np.diff(self.offsets)
+        rows = np.flatnonzero(self.startswith(path) & (lengths == len(path.encode("utf-8"))))
+        return int(rows[0]) if len(rows) else None
+
+    def _match(self, text, anchors, from_end, ignore_case=False):
+        pattern = np.frombuffer(text.encode("utf-8"), dtype=np.uint8)
+        if ignore_case:
+            pattern = _ascii_lower(pattern)
+        lengths = np.diff(self.offsets)
+        mask = lengths >= len(pattern)
+        if not len(pattern):
+            return mask
+        candidates = np.flatnonzero(mask)
+        offsets = np.arange(len(pattern))
+        # Gather the bytes to compare for a chunk of paths at a time, straight from the blob
+        for start in range(0, len(candidates), PATH_MATCH_CHUNK_ROWS):
+            rows = candidates[start:start + PATH_MATCH_CHUNK_ROWS]
+            first = np.asarray(anchors[rows], dtype=np.int64) - (len(pattern) if from_end else 0)
+            window = np.asarray(self.blob[first[:, None] + offsets])
+            if ignore_case:
+                window = _ascii_lower(window)
+            mask[rows] = (window == pattern).all(axis=1)
+        return mask
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("path index out of range")
+        start, end = int(self.offsets[i]), int(self.offsets[i + 1])
+        return self.blob[start:end].tobytes().decode("utf-8")
+
+def _ascii_lower(codes):
+    return np.where((codes >= 65) & (codes <= 90), codes + 32, codes).astype(np.uint8)
+
+class EmbeddingStore(Mapping):
+    """
+    Holds all image embeddings of an index in one contiguous (N, D) matrix with a
+    parallel list of image paths, so a query is scored with a single
+    matrix-vector product instead of a Python loop over per-image arrays.
+
+    The matrix may be a memory-mapped index file (see open_index); it is then scored
+    in chunks so only the pages being scored are touched.
+
+    When an IVFIndex is attached as `ann`, top_k only scores the clusters probed
+    by the index (see ann.py) unless an exact search is requested.
+
+    `columns` holds optional per-row arrays aligned with the matrix, such as the
+    file columns of a saved index (size, mtime, hash, phash).
+
+    `dtype` is the storage format (see quantize.py): np.float32, np.float16,
+    "int8" (the matrix holds int8 codes, with a "scale" column) or "binary" (int8
+    codes plus a "bits" column of packed signs, scanned first). Float embeddings
+    are quantized on the way in; int8 embeddings are taken as codes and need their
+    "scale" column. `vectors` gives the rows as float32 in every format.
+
+    `encoder` is the Encoder.info() of the encoder that computed the embeddings
+    (see encoders.py), or None if it is not known (indexes saved before it was recorded).
+
+    Searches can be restricted to the rows matching a filters.Filter (`where`),
+    evaluated as a mask over the columns and paths before anything is scored.
+    Their results can be cut off adaptively (a calibration.Cutoff) and paged
+    through with `offset`.
+
+    The store behaves like the old {path: (1, D) embedding} dictionary
+    (len, iteration, items(), store[path]), so existing callers keep working.
+    """
+
+    def __init__(self, paths=(), embeddings=None, dtype=np.float32, ann=None, columns=None, encoder=None):
+        self.format = format_name(dtype)
+        self.encoder = encoder
+        self.paths = paths if isinstance(paths, PathList) else list(paths)
+        if embeddings is None:
+            embeddings = np.empty((0, 0))
+        if not isinstance(embeddings, np.ndarray):
+            embeddings = np.asarray(embeddings)
+        columns = dict(columns or {})
+        if embeddings.dtype == np.int8 and "scale" not in columns:
+            raise ValueError("int8 embeddings need their scale column")
+        if self.format in ("int8", "binary"):
+            if embeddings.dtype != np.int8:
+                embeddings, columns["scale"] = quantize_int8(embeddings)
+            if self.format == "binary" and "bits" not in columns:
+                columns["bits"] = pack_signs(embeddings)
+        elif embeddings.dtype == np.int8:
+            embeddings = dequantize_int8(embeddings, columns["scale"])
+        for name in QUANTIZATION_COLUMNS:
+            if name not in self._format_columns:
+                columns.pop(name, None)
+        self.mapped = isinstance(embeddings, np.memmap)
+        if self.mapped and embeddings.dtype == np.dtype(CODE_DTYPES[self.format]):
+            # Keep the mapping instead of copying the whole file into memory
+            self._buffer = embeddings
+        else:
+            self._buffer = np.ascontiguousarray(embeddings, dtype=CODE_DTYPES[self.format])
+            self.mapped = False
+        if self._buffer.shape[0] != len(self.paths):
+            raise ValueError(
+                f"Got {len(self.paths)} paths for {self._buffer.shape[0]} embeddings"
+            )
+        self._column_buffers = {}
+        for name, values in columns.items():
+            values = np.asarray(values, dtype=COLUMN_DTYPES.get(name))
+            if len(values) != len(self.paths):
+                raise ValueError(f"Column {name} has {len(values)} rows for {len(self.paths)} paths")
+            self._column_buffers[name] = values
+        self.ann = ann
+        # Optional columns an index saved by an older release lacked (they hold zeros)
+        self.unknown_columns = ()
+        self._row_index = None
+        self._copies = None
+        self._path_list = None
+        self._moments = None
+        self._upcast = None
+
+    @property
+    def _format_columns(self):
+        # The quantization columns this store's format keeps
+        return {"int8": ("scale",), "binary": ("scale", "bits")}.get(self.format, ())
+
+    @property
+    def matrix(self):
+        """The stored (N, D) matrix: the embeddings, or their int8 codes in the quantized formats."""
+        # The buffer may have spare rows at the end after append()
+        return self._buffer[:len(self.paths)]
+
+    @property
+    def vectors(self):
+        """The (N, D) embeddings as float32 rows (decoded on access in the quantized formats)."""
+        if self.format in ("int8", "binary"):
+            return DequantizedRows(self.matrix, self.column("scale"))
+        return self.matrix
+
+    @property
+    def columns(self):
+        """The per-row columns, as {name: (N,) array}."""
+        return {name: values[:len(self.paths)] for name, values in self._column_buffers.items()}
+
+    def column(self, name):
+        """Returns the (N,) array of one column, or None if the store does not have it."""
+        values = self._column_buffers.get(name)
+        return None if values is None else values[:len(self.paths)]
+
+    def append(self, paths, embeddings, columns=None):
+        """
+        Adds rows at the end of the store, with their values of the per-row `columns`
+        (a column the store has but `columns` lacks is filled with zeros).
+        The backing buffer grows geometrically, so a store filled batch by batch is
+        not copied on every append.
+        Any attached ANN index is dropped since it does not cover the new rows.
+        """
+        if self.mapped or isinstance(self.paths, PathList):
+            raise ValueError("A store opened from disk is read-only")
+        paths = list(paths)
+        columns = dict(columns or {})
+        if self.format in ("int8", "binary"):
+            embeddings, columns["scale"] = quantize_int8(np.reshape(embeddings, (len(paths), -1)))
+            if self.format == "binary":
+                columns["bits"] = pack_signs(embeddings)
+        embeddings = np.asarray(embeddings, dtype=self._buffer.dtype).reshape(len(paths), -1)
+        count, needed = len(self.paths), len(self.paths) + len(paths)
+        if count == 0 and self._buffer.shape[1] != embeddings.shape[1]:
+            self._buffer = np.empty((0, embeddings.shape[1]), dtype=self._buffer.dtype)
+            # Columns sized for the old embedding width (the sign bits) start over too
+            for name in columns:
+                self._column_buffers.pop(name, None)
+        if needed > len(self._buffer):
+            grown = np.empty((max(needed, 2 * len(self._buffer), 1024), self._buffer.shape[1]), dtype=self._buffer.dtype)
+            grown[:count] = self._buffer[:count]
+            self._buffer = grown
+        for name in set(columns) | set(self._column_buffers):
+            values = self._column_buffers.get(name)
+            if values is None or len(values) < len(self._buffer):
+                if values is not None:
+                    dtype, shape = values.dtype, values.shape[1:]
+                else:
+                    dtype = COLUMN_DTYPES.get(name, np.asarray(columns[name]).dtype)
+                    shape = np.shape(columns[name])[1:]
+                grown = np.zeros((len(self._buffer),) + shape, dtype=dtype)
+                if values is not None:
+                    grown[:count] = values[:count]
+                self._column_buffers[name] = values = grown
+            values[count:needed] = columns[name] if name in columns else 0
+        # Rows are written before the paths are extended, so a concurrent snapshot()
+        # never sees a path without its embedding
+        self._buffer[count:needed] = embeddings
+        self.paths.extend(paths)
+        if self._row_index is not None:
+            self._row_index.update((path, count + i) for i, path in enumerate(paths))
+        self.ann = None
+        self._moments = None
+        self._upcast = None
+
+    def snapshot(self):
+        """
+        Returns a store over the rows added so far that later appends do not affect.
+        It shares the embedding buffer, so taking one costs a copy of the path list only.
+        """
+        count = len(self.paths)
+        columns = {name: values[:count] for name, values in self._column_buffers.items()}
+        return EmbeddingStore(self.paths[:count], self._buffer[:count], dtype=self.format, ann=self.ann,
+                              columns=columns, encoder=self.encoder)
+
+    def without(self, paths):
+        """
+        Returns a copy of the store, held in memory so it can be appended to, with
+        the rows of `paths` left out (paths that are not in the store are ignored).
+        The ANN index is not carried over since its lists point at the old rows.
+        """
+        keep = np.ones(len(self), dtype=bool)
+        for path in paths:
+            i = self._rows.get(path)
+            if i is not None:
+                keep[i] = False
+        kept_paths = [path for path, kept in zip(self.paths, keep) if kept]
+        columns = {name: values[keep] for name, values in self.columns.items()}
+        return EmbeddingStore(kept_paths, self.matrix[keep], dtype=self.format, columns=columns,
+                              encoder=self.encoder)
+
+    def row(self, path):
+        """Returns the row of `path`, or None if it is not in the store."""
+        return self._rows.get(path)
+
+    def vector(self, path):
+        """
+        Returns the stored embedding of `path` as a float32 (D,) array, or None if it
+        is not in the store. On a store opened from disk the path is looked up with a
+        vectorized scan of the path blob instead of building the path -> row map.
+        """
+        if self._row_index is None and isinstance(self.paths, PathList):
+            i = self.paths.find(path)
+        else:
+            i = self._rows.get(path)
+        return None if i is None else np.array(self.vectors[i], dtype=np.float32)
+
+    @property
+    def moments(self):
+        """ScoreMoments of the embeddings, for z-score cut-offs (estimated on first use); None if empty."""
+        if self._moments is None and len(self):
+            self._moments = ScoreMoments.estimate(self.vectors)
+        return self._moments
+
+    @property
+    def path_list(self):
+        """The paths as a PathList (built once for paths held in a list), for vectorized path matching."""
+        if isinstance(self.paths, PathList):
+            return self.paths
+        if self._path_list is None or len(self._path_list) != len(self.paths):
+            self._path_list = PathList.from_paths(self.paths)
+        return self._path_list
+
+    @property
+    def _rows(self):
+        # Built on first lookup by path, so a mapped index never decodes every path just to open
+        if self._row_index is None:
+            self._row_index = {path: i for i, path in enumerate(self.paths)}
+        return self._row_index
+
+    @classmethod
+    def from_dict(cls, image_embeddings, dtype=np.float32):
+        """Builds a store from a {path: embedding} dictionary."""
+        if isinstance(image_embeddings, cls):
+            return image_embeddings
+        paths = list(image_embeddings)
+        if not paths:
+            return cls(dtype=dtype)
+        matrix = np.concatenate([np.reshape(image_embeddings[p], (1, -1)) for p in paths])
+        return cls(paths, matrix, dtype=dtype)
+
+    # --- Mapping interface -------------------------------------------------
+    def __len__(self):
+        return len(self.paths)
+
+    def __iter__(self):
+        return iter(self.paths)
+
+    def __getitem__(self, path):
+        i = self._rows[path]
+        # Keep the (1, D) shape of the single-image embeddings
+        return self.vectors[i:i + 1]
+
+    def __contains__(self, path):
+        return path in self._rows
+
+    # --- Scoring -----------------------------------------------------------
+    @property
+    def dim(self):
+        return self.matrix.shape[1]
+
+    def scores(self, query, rows=None):
+        """
+        Returns the (N,) cosine similarities between a normalized query vector and every
+        row, or only the given (sorted) `rows`.
+
+        Float32 rows in memory are scored with one product. A float16 store in memory
+        keeps a float32 copy of its rows for scoring, made on the first query (twice
+        the store's size in RAM, but float32 speed afterwards). Mapped float16 rows
+        are upcast block by block on every query, which NumPy does slowly: such a
+        search takes about ten times as long as on float32. int8 codes are upcast
+        the same way at about twice the cost of float32.
+        """
+        query = np.asarray(query, dtype=np.float32).reshape(-1)
+        matrix = self.matrix
+        if matrix.dtype == np.float16 and not self.mapped:
+            if self._upcast is None or len(self._upcast) != len(matrix):
+                self._upcast = matrix.astype(np.float32)
+            matrix = self._upcast
+        if matrix.dtype == np.float32 and not self.mapped:
+            return (matrix if rows is None else matrix[rows]) @ query
+        # NumPy has no fast half-precision or int8 matmul, and a mapped matrix should be
+        # streamed rather than pulled in at once, so score one block at a time
+        scales = self.column("scale")
+        count = len(self) if rows is None else len(rows)
+        scores = np.empty(count, dtype=np.float32)
+        step = SCORE_CHUNK_ROWS if matrix.dtype == np.float32 else SCORE_UPCAST_ROWS
+        block = None if matrix.dtype == np.float32 else np.empty((min(step, count), matrix.shape[1]), dtype=np.float32)
+        for start in range(0, count, step):
+            selection = slice(start, start + step) if rows is None else rows[start:start + step]
+            if block is None:
+                chunk = np.asarray(matrix[selection])
+            else:
+                codes = matrix[selection]
+                chunk = block[:len(codes)]
+                np.copyto(chunk, codes, casting="unsafe")
+            np.matmul(chunk, query, out=scores[start:start + len(chunk)])
+            if scales is not None:
+                # (codes * scale) . q == (codes . q) * scale
+                scores[start:start + len(chunk)] *= scales[selection]
+        return scores
+
+    def hamming_scores(self, query, rows=None):
+        """
+        Returns the (N,) similarities estimated from the sign bits of a "binary" store
+        (see quantize.py), for every row or only the given (sorted) `rows`.
+        """
+        bits = self.column("bits")
+        query_bits = pack_signs(np.reshape(query, (1, -1)))[0]
+        count = len(self) if rows is None else len(rows)
+        scores = np.empty(count, dtype=np.float32)
+        for start in range(0, count, SCORE_CHUNK_ROWS):
+            selection = slice(start, start + SCORE_CHUNK_ROWS) if rows is None else rows[start:start + SCORE_CHUNK_ROWS]
+            chunk = bits[selection]
+            scores[start:start + len(chunk)] = hamming_scores(chunk, query_bits)
+        return scores
+
+    def top_k(self, query, k, threshold=None, nprobe=DEFAULT_NPROBE, rerank=None, exact=False, where=None,
+              cutoff=None, offset=0):
+        """
+        Returns up to k (path, similarity) pairs sorted by descending similarity.
+        Only scores above `threshold` are kept when one is given. A calibration.Cutoff
+        ends the ranking earlier for this query: its z-score floor is applied with the
+        threshold, its gap and margin to the sorted results.
+        With `offset`, the results ranked offset to offset + k are returned (a page);
+        only offset + k results are selected and sorted.
+
+        With an ANN index attached, only the `nprobe` nearest clusters are scored and,
+        for PQ indexes, the best `rerank` candidates (default max(10 * k, 100)) are re-scored
+        exactly; `exact` forces a full scan instead. A "binary" store likewise ranks
+        every row by its sign bits and re-scores the best `rerank` with the int8 codes.
+
+        With a filters.Filter as `where`, only the rows it matches are scored. When it
+        matches few rows (FILTER_EXACT_SHARE) they are scanned exactly, ANN index or not.
+        """
+        if cutoff:
+            threshold = cutoff.floor(query, self.moments, threshold)
+        rows, scores = self._top_rows(query, offset + k, threshold, nprobe, rerank, exact, where)
+        end = cutoff.head(scores) if cutoff else len(rows)
+        return [(self.paths[i], float(score)) for i, score in zip(rows[offset:end], scores[offset:end])]
+
+    def _top_rows(self, query, k, threshold, nprobe, rerank, exact, where=None):
+        """Rows and scores of the top k results (see top_k), best first."""
+        empty = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        if len(self) == 0 or k <= 0:
+            return empty
+        query = np.asarray(query, dtype=np.float32).reshape(-1)
+        rerank = max(10 * k, 100) if rerank is None else rerank
+        # Rows matching the filter (None: every row)
+        mask = where.mask(self) if where is not None else None
+        subset = np.flatnonzero(mask) if mask is not None else None
+        if subset is not None:
+            if not len(subset):
+                return empty
+            if len(subset) == len(self):
+                subset = None
+        rows = scores = None
+        if self.ann is not None and not exact and (subset is None or len(subset) > FILTER_EXACT_SHARE * len(self)):
+            rows, scores = self.ann.search(self.vectors, query, nprobe=nprobe, rerank=rerank)
+            if subset is not None:
+                keep = mask[rows]
+                rows, scores = rows[keep], scores[keep]
+                if len(rows) < k:
+                    # Too few of the probed images match: scan the matching ones instead
+                    rows = None
+        # A filter matching most rows picks its scores out of a full scan
+        gather = subset is not None and len(subset) > FILTER_GATHER_SHARE * len(self)
+        if rows is None and self.format == "binary" and not exact:
+            rows = np.arange(len(self)) if subset is None else subset
+            scores = self.hamming_scores(query)[subset] if gather else self.hamming_scores(query, subset)
+            if rerank:
+                # Re-score the shortlist (read in file order) with the int8 codes
+                if rerank < len(rows):
+                    rows = rows[np.sort(np.argpartition(-scores, rerank - 1)[:rerank])]
+                scores = self.vectors[rows] @ query
+        elif rows is None:
+            rows = np.arange(len(self)) if subset is None else subset
+            scores = self.scores(query)[subset] if gather else self.scores(query, subset)
+        best = select_top_k(scores, k, threshold)
+        return rows[best], scores[best]
+
+    # --- Duplicate groups --------------------------------------------------
+    def top_k_groups(self, query, k, threshold=None, nprobe=DEFAULT_NPROBE, rerank=None, exact=False,
+                     near_duplicates=False, max_distance=PHASH_MAX_DISTANCE, where=None, cutoff=None, offset=0):
+        """
+        Like top_k, but with one result per group of duplicates: returns up to k
+        (path, similarity, alternate paths) triples, the path being the best-scoring
+        member of its group.
+
+        Byte-identical files (same content hash) always form one group, whose
+        alternates are all the other copies in the index. With `near_duplicates`,
+        results whose perceptual hashes differ in at most `max_distance` bits join
+        the group too. A store without a "hash" column returns ungrouped results.
+        With `where`, results are limited to the files matching the filter (their
+        alternates may not match it). `cutoff` and `offset` apply to the groups as
+        they do to the results of top_k.
+        """
+        if cutoff:
+            threshold = cutoff.floor(query, self.moments, threshold)
+        groups = self._top_group_rows(query, offset + k, threshold, nprobe, rerank, exact,
+                                      near_duplicates, max_distance, where)
+        end = cutoff.head([score for score, _ in groups]) if cutoff else len(groups)
+        return [
+            (self.paths[rows[0]], score, [self.paths[row] for row in rows[1:]])
+            for score, rows in groups[offset:end]
+        ]
+
+    def _top_group_rows(self, query, k, threshold=None, nprobe=DEFAULT_NPROBE, rerank=None, exact=False,
+                        near_duplicates=False, max_distance=PHASH_MAX_DISTANCE, where=None):
+        """The top k groups (see top_k_groups) as [(best score, [rows, best first])]."""
+        fetch = k
+        while True:
+            rows, scores = self._top_rows(query, fetch, threshold, nprobe, rerank, exact, where)
+            hashes = self.column("hash")
+            if hashes is None:
+                return [(float(score), [int(row)]) for row, score in zip(rows, scores)]
+            phashes = self.column("phash") if near_duplicates else None
+            groups = group_duplicates(
+                [(score, hashes[row], phashes[row] if phashes is not None else 0) for row, score in zip(rows, scores)],
+                max_distance,
+            )
+            # Duplicates take up places in the ranking, so look further down until there are k groups
+            if len(groups) >= k or len(rows) < fetch:
+                break
+            fetch *= 4
+
+        results = []
+        for members in groups[:k]:
+            score = float(scores[members[0]])
+            members = [int(rows[i]) for i in members]
+            # Add the copies of each member that did not make it into the ranking
+            seen = set(members)
+            for row in list(members):
+                members.extend(r for r in self._copy_rows.get(hashes[row], ()) if r not in seen and not seen.add(r))
+            results.append((score, members))
+        return results
+
+    @property
+    def _copy_rows(self):
+        # Content hash -> rows, only for hashes shared by several rows; built on first use
+        if self._copies is None:
+            self._copies = {}
+            hashes = self.column("hash")
+            if hashes is not None and len(hashes):
+                _, inverse, counts = np.unique(hashes, return_inverse=True, return_counts=True)
+                for row in np.flatnonzero(counts[inverse] > 1):
+                    if hashes[row]:
+                        self._copies.setdefault(hashes[row], []).append(int(row))
+        return self._copies
+
+class DequantizedRows:
+    """
+    Read-only view of int8 codes as float32 rows (codes * scale), decoded only for
+    the rows that are indexed, e.g. view[rows] or view[start:stop].
+    """
+
+    def __init__(self, codes, scales):
+        self.codes = codes
+        self.scales = scales
+
+    @property
+    def shape(self):
+        return self.codes.shape
+
+    @property
+    def dtype(self):
+        return np.dtype(np.float32)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, rows):
+        codes = np.asarray(self.codes[rows], dtype=np.float32)
+        scales = np.asarray(self.scales[rows], dtype=np.float32)
+        return codes * scales[..., None] if codes.ndim > 1 else codes * scales
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self[:], dtype=dtype)
+
+class ConcatenatedRows:
+    """
+    The rows of several (N_i, D) matrices one after the other, each optionally
+    limited to the rows of a boolean mask, without joining them in memory: the parts
+    (e.g. a memory-mapped index and the rows added to it) are read one block at a
+    time. save_index writes it like a matrix.
+    """
+
+    def __init__(self, parts):
+        # [(matrix, keep mask or None)], leaving out empty parts
+        self.parts = [(matrix, keep) for matrix, keep in parts if len(matrix)]
+
+    @property
+    def shape(self):
+        count = sum(len(matrix) if keep is None else int(np.count_nonzero(keep)) for matrix, keep in self.parts)
+        return (count, self.parts[0][0].shape[1] if self.parts else 0)
+
+    @property
+    def dtype(self):
+        return self.parts[0][0].dtype if self.parts else np.dtype(np.float32)
+
+    @property
+    def ndim(self):
+        return 2
+
+    def blocks(self, rows=SCORE_UPCAST_ROWS):
+        """Yields the rows in order, at most `rows` of them at a time."""
+        for matrix, keep in self.parts:
+            for start in range(0, len(matrix), rows):
+                block = np.asarray(matrix[start:start + rows], dtype=self.dtype)
+                yield block if keep is None else block[keep[start:start + rows]]
+
+    def write_npy(self, f):
+        """Writes the rows to an open file in .npy format."""
+        header = {"descr": np.lib.format.dtype_to_descr(self.dtype), "fortran_order": False, "shape": self.shape}
+        np.lib.format.write_array_header_1_0(f, header)
+        for block in self.blocks():
+            f.write(np.ascontiguousarray(block).tobytes())
+
+def hamming_distance(a, b):
+    """Number of differing bits between two 64-bit perceptual hashes."""
+    return bin(int(a) ^ int(b)).count("1")
+
+def group_duplicates(results, max_distance=PHASH_MAX_DISTANCE):
+    """
+    Groups search results given best first as (score, content hash, perceptual hash)
+    and returns the groups as lists of positions in `results`, best first.
+
+    Results with the same (non-empty) content hash share a group. A result whose
+    perceptual hash is within `max_distance` bits of the best member of a group
+    scoring at most NEAR_DUPLICATE_SCORE_GAP higher joins that group as well; a
+    perceptual hash of 0 means unknown and never matches.
+    """
+    groups = []
+    best = []  # (score, perceptual hash) of the first member of each group
+    group_by_hash = {}
+    recent = deque()  # groups scoring within NEAR_DUPLICATE_SCORE_GAP of the current result
+    for i, (score, digest, phash) in enumerate(results):
+        group = group_by_hash.get(digest) if digest else None
+        if group is None and phash:
+            while recent and best[recent[0]][0] - score > NEAR_DUPLICATE_SCORE_GAP:
+                recent.popleft()
+            for candidate in recent:
+                other = best[candidate][1]
+                if other and hamming_distance(phash, other) <= max_distance:
+                    group = candidate
+                    break
+        if group is None:
+            group = len(groups)
+            groups.append([i])
+            best.append((score, phash))
+            recent.append(group)
+        else:
+            groups[group].append(i)
+        if digest:
+            group_by_hash.setdefault(digest, group)
+    return groups
+
+def select_top_k(scores, k, threshold=None):
+    """
+    Returns the positions of the (at most) k highest scores above `threshold`,
+    ordered by descending score, without sorting the whole array.
+    """
+    candidates = np.flatnonzero(scores > threshold) if threshold is not None else np.arange(len(scores))
+    k = min(k, len(candidates))
+    if k <= 0:
+        return candidates[:0]
+    candidate_scores = scores[candidates]
+    # Select the k best with argpartition, then sort just those
+    if k < len(candidates):
+        best = np.argpartition(-candidate_scores, k - 1)[:k]
+    else:
+        best = np.arange(len(candidates))
+    best = best[np.argsort(-candidate_scores[best], kind="stable")]
+    return candidates[best]
+
+def index_dir(folder, root=INDEX_ROOT):
+    """Returns the directory holding the index for the given image folder."""
+    folder = os.path.normcase(os.path.abspath(folder))
+    key = hashlib.sha1(folder.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(root, key)
+
+def content_hash(data):
+    """Hashes the raw bytes of a file (used to recognise unchanged or moved images)."""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def _atomic_write(path, write):
+    """Writes through a temporary file so a crash never leaves a half-written file."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+def _read_manifest(directory):
+    """Returns the manifest of an index directory, or None if there is no usable one."""
+    try:
+        with open(os.path.join(directory, "manifest.json"), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return manifest if manifest.get("version") == INDEX_VERSION else None
+
+def load_index(folder, root=INDEX_ROOT, mmap=True):
+    """
+    Loads the saved index of a folder.
+    Returns (paths, columns, embeddings, ann): a PathList, a dict of per-file "size",
+    "mtime", "hash" and "phash" arrays (plus "scale" and "bits" for quantized indexes),
+    the matching (N, D) embedding matrix and the saved IVFIndex (None if the index was
+    built without one).
+    With `mmap` the arrays are memory-mapped rather than read into memory.
+    Returns None if there is no usable index.
+    """
+    directory = index_dir(folder, root)
+    manifest = _read_manifest(directory)
+    if manifest is None:
+        return None
+    mmap_mode = "r" if mmap else None
+    files = manifest["files"]
+    try:
+        paths = PathList.load(directory, files, mmap=mmap)
+        columns = {
+            name: np.load(os.path.join(directory, files[name]), mmap_mode=mmap_mode)
+            if name in files or name not in OPTIONAL_COLUMNS
+            else np.zeros(manifest["count"], dtype=dtype)
+            for name, dtype in FILE_COLUMNS.items()
+        }
+        for name in QUANTIZATION_COLUMNS:
+            if name in files:
+                columns[name] = np.load(os.path.join(directory, files[name]), mmap_mode=mmap_mode)
+        embeddings = np.load(os.path.join(directory, files["embeddings"]), mmap_mode=mmap_mode)
+        ann = None
+        if manifest.get("ann"):
+            ann = IVFIndex.from_arrays({
+                name: np.load(os.path.join(directory, file_name), mmap_mode=mmap_mode)
+                for name, file_name in files.items() if name.startswith("ann_")
+            })
+    except (OSError, KeyError, ValueError):
+        return None
+
+    count = manifest.get("count")
+    if len(paths) != count or embeddings.shape[0] != count or any(len(c) != count for c in columns.values()):
+        return None
+    return paths, columns, embeddings, ann
+
+def index_info(folder, root=INDEX_ROOT):
+    """Returns a summary of the saved index of a folder (None if there is none)."""
+    directory = index_dir(folder, root)
+    manifest = _read_manifest(directory)
+    if manifest is None:
+        return None
+    size = 0
+    for file_name in manifest["files"].values():
+        try:
+            size += os.path.getsize(os.path.join(directory, file_name))
+        except OSError:
+            pass
+    return {
+        "folder": manifest["folder"],
+        "images": manifest["count"],
+        "dim": manifest["dim"],
+        "dtype": manifest["dtype"],
+        "format": manifest.get("format", manifest["dtype"]),
+        "encoder": manifest.get("encoder"),
+        "ann": manifest.get("ann"),
+        "generation": manifest["generation"],
+        "bytes": size,
+        "location": directory,
+    }
+
+def open_index(folder, root=INDEX_ROOT):
+    """
+    Opens the saved index of a folder for searching without reading it into memory.
+    Returns a memory-mapped EmbeddingStore, or None if the folder has no usable index.
+    """
+    loaded = load_index(folder, root, mmap=True)
+    if loaded is None:
+        return None
+    paths, columns, embeddings, ann = loaded
+    manifest = _read_manifest(index_dir(folder, root)) or {}
+    embedding_store = EmbeddingStore(paths, embeddings, dtype=saved_format(embeddings, columns), ann=ann,
+                                     columns=columns, encoder=manifest.get("encoder"))
+    embedding_store.unknown_columns = tuple(name for name in OPTIONAL_COLUMNS if name not in manifest.get("files", {}))
+    return embedding_store
+
+def _checkpoint_files(directory):
+    """[(number, file name)] of the checkpoint files in an index directory, oldest first."""
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return []
+    matches = (re.fullmatch(r"checkpoint\.(\d+)\.npz", name) for name in names)
+    return sorted((int(match.group(1)), match.group(0)) for match in matches if match)
+
+# Index directory -> lock held while saving into it (see _save_lock)
+_save_locks = {}
+_save_locks_guard = threading.Lock()
+
+def _save_lock(directory):
+    """The lock serializing the saves of one index directory within this process."""
+    with _save_locks_guard:
+        return _save_locks.setdefault(os.path.normcase(os.path.abspath(directory)), threading.Lock())
+
+def save_checkpoint(folder, paths, columns, embeddings, root=INDEX_ROOT, encoder=None):
+    """
+    Saves rows that an index run has encoded but not saved yet: the paths, their file
+    columns and their embeddings (as float32), as the next checkpoint file of the
+    folder's index. Each checkpoint only holds the rows given, so a long run writes
+    a series of small files rather than the whole index every time.
+
+    If the run is interrupted (a crash, a killed process), load_checkpoint gives the
+    next run its rows back. save_index removes the checkpoint files, since the index
+    it saves supersedes them.
+    """
+    directory = index_dir(folder, root)
+    os.makedirs(directory, exist_ok=True)
+    arrays = {name: np.asarray(columns[name], dtype=dtype) for name, dtype in FILE_COLUMNS.items()}
+    arrays["paths"] = np.array(list(paths), dtype=str)
+    arrays["embeddings"] = np.asarray(embeddings, dtype=np.float32)
+    arrays["encoder"] = np.array(json.dumps(encoder))
+    with _save_lock(directory):
+        number = max((number for number, _ in _checkpoint_files(directory)), default=0) + 1
+        _atomic_write(os.path.join(directory, f"checkpoint.{number}.npz"), lambda f: np.savez(f, **arrays))
+
+def load_checkpoint(folder, root=INDEX_ROOT):
+    """
+    Returns the rows of the folder's checkpoint files as an in-memory EmbeddingStore
+    (the latest row of a path wins), or None if there are none. Only the files written
+    with the encoder of the latest one are used; unreadable files are skipped.
+    """
+    directory = index_dir(folder, root)
+    chunks = []
+    for _, file_name in _checkpoint_files(directory):
+        try:
+            with np.load(os.path.join(directory, file_name)) as data:
+                chunks.append((json.loads(str(data["encoder"])), {name: data[name] for name in data.files}))
+        except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+            continue
+    if not chunks:
+        return None
+    encoder = chunks[-1][0]
+    chunks = [arrays for chunk_encoder, arrays in chunks if chunk_encoder == encoder]
+    merged = {name: np.concatenate([arrays[name] for arrays in chunks]) for name in chunks[0] if name != "encoder"}
+    paths = merged.pop("paths").tolist()
+    embeddings = merged.pop("embeddings")
+    # A file encoded again by a later run keeps its latest row
+    keep = np.zeros(len(paths), dtype=bool)
+    seen = set()
+    for i in range(len(paths) - 1, -1, -1):
+        if paths[i] not in seen:
+            seen.add(paths[i])
+            keep[i] = True
+    return EmbeddingStore([path for path, kept in zip(paths, keep) if kept], embeddings[keep],
+                          columns={name: values[keep] for name, values in merged.items()}, encoder=encoder)
+
+def saved_format(embeddings, columns):
+    """The storage format of a loaded index: its matrix dtype, or "binary" when it has sign bits."""
+    return "binary" if "bits" in columns else embeddings.dtype.name
+
+def save_index(folder, paths, columns, embeddings, ann=None, root=INDEX_ROOT, encoder=None):
+    """
+    Saves the paths, their per-file "size"/"mtime"/"hash"/"phash" columns, the (N, D)
+    embedding matrix of a folder and, optionally, its IVFIndex. The matrix of a
+    quantized store (EmbeddingStore.matrix) is saved as is, with its "scale" and
+    "bits" columns. `encoder` (Encoder.info()) is recorded in the manifest.
+    `embeddings` may also be ConcatenatedRows, which are written block by block.
+
+    Every save writes a new generation of files and then switches the manifest over
+    to it, so readers that still have the previous generation memory-mapped are not
+    disturbed and a crash never leaves a mix of old and new files behind. Checkpoint
+    files (see save_checkpoint) are removed along with the previous generation.
+    Saves of the same index from several threads of this process take turns.
+    """
+    directory = index_dir(folder, root)
+    os.makedirs(directory, exist_ok=True)
+
+    if not isinstance(embeddings, ConcatenatedRows):
+        embeddings = np.asarray(embeddings)
+        if embeddings.dtype not in [np.dtype(t) for t in STORE_DTYPES]:
+            embeddings = embeddings.astype(np.float32)
+    # Another thread may be saving the same index (an index run and a folder watcher)
+    with _save_lock(directory):
+        previous = _read_manifest(directory)
+        generation = previous["generation"] + 1 if previous else 1
+
+        files = {}
+        def write_array(name, array):
+            files[name] = f"{name}.{generation}.npy"
+            write = array.write_npy if isinstance(array, ConcatenatedRows) else lambda f: np.save(f, array)
+            _atomic_write(os.path.join(directory, files[name]), write)
+
+        write_array("embeddings", embeddings)
+        for name, dtype in FILE_COLUMNS.items():
+            write_array(name, np.asarray(columns[name], dtype=dtype))
+        for name, dtype in QUANTIZATION_COLUMNS.items():
+            if name in columns:
+                write_array(name, np.asarray(columns[name], dtype=dtype))
+        files.update(PathList.from_paths(paths).save(directory, generation))
+        if ann is not None:
+            for name, array in ann.arrays().items():
+                write_array(name, array)
+
+        manifest = {
+            "version": INDEX_VERSION,
+            "generation": generation,
+            "folder": os.path.abspath(folder),
+            "count": len(paths),
+            "dim": int(embeddings.shape[1]) if embeddings.ndim == 2 else 0,
+            "dtype": str(embeddings.dtype),
+            "format": saved_format(embeddings, columns),
+            "encoder": encoder,
+            "ann": ann.params() if ann is not None else None,
+            "files": files,
+        }
+        _atomic_write(
+            os.path.join(directory, "manifest.json"),
+            lambda f: f.write(json.dumps(manifest, indent=2).encode("utf-8")),
+        )
+
+        # Drop older generations; files still mapped by another reader (Windows) stay until next time
+        for name in os.listdir(directory):
+            if name != "manifest.json" and name not in files.values():
+                try:
+                    os.remove(os.path.join(directory, name))
+                except OSError:
+                    pass
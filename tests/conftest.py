@@ -0,0 +1,86 @@
+"""
+Shared helpers of the tests. The modules live at the top of the repository, so it
+is put on the path; none of the tests needs the CLIP model (see FakeEncoder).
+"""
+import os
+import sys
+import numpy as np
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import store
+import encoders
+
+# Colours of the test images, also understood as text queries by FakeEncoder
+COLOURS = {"red": (220, 30, 30), "green": (30, 200, 40), "blue": (30, 40, 220),
+           "yellow": (230, 220, 40), "white": (250, 250, 250), "black": (5, 5, 5)}
+
+class FakeEncoder(encoders.Encoder):
+    """
+    Encoder without a model: an image is embedded as its mean colour around mid-grey,
+    and a text query naming a colour of COLOURS as that colour. `encoded` counts the
+    images encoded.
+    """
+
+    backend = "fake"
+
+    def __init__(self, model="fake"):
+        super().__init__(model)
+        self.encoded = 0
+
+    def _load(self):
+        self.dim = 3
+
+    def preprocess(self, image):
+        return np.asarray(image, dtype=np.float32).reshape(-1, 3).mean(axis=0) / 255 - 0.5
+
+    def encode_images(self, inputs):
+        self.encoded += len(inputs)
+        return encoders._normalize(np.stack(inputs))
+
+    def encode_texts(self, texts):
+        return encoders._normalize([np.array(COLOURS[text], dtype=np.float32) / 255 - 0.5 for text in texts])
+
+def random_embeddings(count, dim=32, seed=0):
+    """(count, dim) normalized float32 rows."""
+    rng = np.random.default_rng(seed)
+    x = rng.normal(size=(count, dim)).astype(np.float32)
+    return x / np.linalg.norm(x, axis=1, keepdims=True)
+
+def file_columns(count, **values):
+    """The FILE_COLUMNS of `count` rows: zeros, except for the columns given."""
+    columns = {name: np.zeros(count, dtype=dtype) for name, dtype in store.FILE_COLUMNS.items()}
+    for name, column in values.items():
+        columns[name] = np.asarray(column, dtype=store.FILE_COLUMNS[name])
+    return columns
+
+def write_image(path, colour, size=(64, 48)):
+    """Saves a solid image of one of COLOURS (or an RGB tuple) and returns its path."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    Image.new("RGB", size, COLOURS.get(colour, colour)).save(path)
+    return path
+
+@pytest.fixture
+def index_root(tmp_path):
+    """A directory for saved indexes, instead of ~/.snapseek/indexes."""
+    return str(tmp_path / "indexes")
+
+@pytest.fixture
+def fake_encoder(tmp_path, monkeypatch):
+    """
+    Makes a FakeEncoder the active encoder of main.py, with the indexes saved under
+    the default root and the query cache going to a temporary directory instead.
+    """
+    import main
+    root = str(tmp_path / "indexes")
+    monkeypatch.setattr(main.text_cache, "path", str(tmp_path / "text_cache.npz"))
+    index_dir = store.index_dir
+    monkeypatch.setattr(store, "index_dir",
+                        lambda folder, given=store.INDEX_ROOT: index_dir(folder, root if given == store.INDEX_ROOT else given))
+    previous = main.get_encoder()
+    encoder = FakeEncoder()
+    main.set_encoder(encoder)
+    yield encoder
+    main.set_encoder(previous)
@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+
+import store
+from ann import IVFIndex
+from conftest import random_embeddings, file_columns
+
+@pytest.fixture
+def matrix():
+    return random_embeddings(2000, dim=32, seed=3)
+
+def test_probing_every_list_is_exact(matrix):
+    index = IVFIndex.train(matrix, n_lists=16).add(matrix)
+    assert sorted(index.list_rows.tolist()) == list(range(len(matrix)))
+    rows, scores = index.search(matrix, matrix[0], nprobe=16)
+    np.testing.assert_allclose(scores[np.argsort(rows)], matrix @ matrix[0], atol=1e-5)
+
+def test_approximate_search_finds_the_query_row(matrix):
+    index = IVFIndex.train(matrix, n_lists=16, pq_subspaces=8).add(matrix)
+    embedding_store = store.EmbeddingStore([f"/photos/{i}.jpg" for i in range(len(matrix))], matrix, ann=index)
+    hits = sum(embedding_store.top_k(matrix[i], 1, nprobe=2, rerank=50)[0][0] == f"/photos/{i}.jpg"
+               for i in range(50))
+    assert hits >= 45
+    assert embedding_store.top_k(matrix[0], 5, exact=True) == store.EmbeddingStore(embedding_store.paths, matrix).top_k(matrix[0], 5)
+
+def test_pq_subspaces_must_divide_the_dimension(matrix):
+    with pytest.raises(ValueError):
+        IVFIndex.train(matrix, pq_subspaces=5)
+
+def test_saved_index_keeps_the_ann(index_root, matrix):
+    index = IVFIndex.train(matrix, n_lists=16, pq_subspaces=8).add(matrix)
+    paths = [f"/photos/{i}.jpg" for i in range(len(matrix))]
+    store.save_index("/photos", paths, file_columns(len(matrix)), matrix, ann=index, root=index_root)
+
+    opened = store.open_index("/photos", root=index_root)
+    assert opened.ann.params() == {"n_lists": 16, "pq_subspaces": 8}
+    original = store.EmbeddingStore(paths, matrix, ann=index)
+    assert opened.top_k(matrix[3], 10, nprobe=4) == original.top_k(matrix[3], 10, nprobe=4)
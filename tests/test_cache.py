@@ -0,0 +1,49 @@
+import numpy as np
+
+from cache import TextEmbeddingCache
+from conftest import random_embeddings
+
+def test_round_trip_with_models_of_different_sizes(tmp_path):
+    path = str(tmp_path / "cache" / "text_cache.npz")
+    cache = TextEmbeddingCache(path=path)
+    small, large = random_embeddings(2, dim=512), random_embeddings(1, dim=768)
+    cache.put("ViT-B/32", "a dog", small[0])
+    cache.put("ViT-L/14", "a dog", large[0])
+    cache.put("ViT-B/32", "a cat", small[1])
+    cache.save()
+
+    loaded = TextEmbeddingCache(path=path)
+    assert len(loaded) == 3
+    np.testing.assert_array_equal(loaded.get("ViT-B/32", "a dog"), small[0])
+    np.testing.assert_array_equal(loaded.get("ViT-L/14", "a dog"), large[0])
+    np.testing.assert_array_equal(loaded.get("ViT-B/32", "a cat"), small[1])
+    assert loaded.get("ViT-L/14", "a cat") is None
+
+def test_lru_order_survives_a_restart(tmp_path):
+    path = str(tmp_path / "text_cache.npz")
+    cache = TextEmbeddingCache(max_entries=2, path=path)
+    embeddings = random_embeddings(3)
+    cache.put("m", "first", embeddings[0])
+    cache.put("m", "second", embeddings[1])
+    cache.get("m", "first")
+    cache.save()
+
+    loaded = TextEmbeddingCache(max_entries=2, path=path)
+    loaded.put("m", "third", embeddings[2])
+    assert loaded.get("m", "second") is None
+    assert loaded.get("m", "first") is not None
+
+def test_loads_files_of_the_previous_layout(tmp_path):
+    path = str(tmp_path / "text_cache.npz")
+    embeddings = random_embeddings(2)
+    np.savez(path, models=np.array(["m", "m"]), queries=np.array(["a", "b"]), embeddings=embeddings)
+    loaded = TextEmbeddingCache(path=path)
+    np.testing.assert_array_equal(loaded.get("m", "b"), embeddings[1])
+
+def test_failed_save_is_not_fatal(tmp_path, capsys):
+    blocker = tmp_path / "file"
+    blocker.write_text("")
+    cache = TextEmbeddingCache(path=str(blocker / "text_cache.npz"))
+    cache.put("m", "a", random_embeddings(1)[0])
+    cache.save()
+    assert "Could not save the query cache" in capsys.readouterr().out
@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+
+import store
+from calibration import Cutoff, ScoreMoments
+from library import Library
+from conftest import random_embeddings
+
+@pytest.fixture
+def embedding_store():
+    vectors = random_embeddings(3000, dim=64, seed=1)
+    return store.EmbeddingStore([f"/photos/{i}.jpg" for i in range(len(vectors))], vectors)
+
+def query_of(embedding_store):
+    query = embedding_store.vectors[0] + 0.5 * embedding_store.vectors[1]
+    return query / np.linalg.norm(query)
+
+def test_head_stops_at_margin_and_gap():
+    scores = [0.40, 0.39, 0.37, 0.30, 0.29]
+    assert Cutoff().head(scores) == 5
+    assert Cutoff(top_margin=0.05).head(scores) == 3
+    assert Cutoff(max_gap=0.05).head(scores) == 3
+    assert Cutoff(max_gap=0.015).head(scores) == 2
+    assert Cutoff(max_gap=0.05).head([]) == 0
+
+def test_floor_combines_threshold_and_z_score():
+    moments = ScoreMoments(10, np.array([0.1, 0.0], dtype=np.float32), np.diag([0.02, 0.01]).astype(np.float32))
+    query = np.array([1.0, 0.0], dtype=np.float32)
+    mean, std = moments.score_stats(query)
+    assert mean == pytest.approx(0.1)
+    assert std == pytest.approx(0.1)
+    assert Cutoff(min_z=2).floor(query, moments) == pytest.approx(0.3)
+    assert Cutoff(min_z=2).floor(query, moments, threshold=0.5) == 0.5
+    assert Cutoff(max_gap=0.1).floor(query, moments, threshold=0.2) == 0.2
+    assert Cutoff(min_z=2).floor(query, None, threshold=0.2) == 0.2
+
+def test_moments_match_the_scores(embedding_store):
+    query = query_of(embedding_store)
+    scores = embedding_store.scores(query)
+    mean, std = embedding_store.moments.score_stats(query)
+    assert mean == pytest.approx(float(scores.mean()), abs=1e-5)
+    assert std == pytest.approx(float(scores.std()), rel=1e-3)
+
+def test_combined_moments_match_the_union(embedding_store):
+    halves = [ScoreMoments.estimate(embedding_store.vectors[:1000]), ScoreMoments.estimate(embedding_store.vectors[1000:])]
+    combined = ScoreMoments.combine(halves + [None])
+    whole = ScoreMoments.estimate(embedding_store.vectors)
+    assert combined.count == len(embedding_store)
+    np.testing.assert_allclose(combined.mean, whole.mean, atol=1e-6)
+    np.testing.assert_allclose(combined.second, whole.second, atol=1e-6)
+    assert ScoreMoments.combine([]) is None
+
+def test_z_score_cutoff_keeps_outstanding_results(embedding_store):
+    query = query_of(embedding_store)
+    scores = embedding_store.scores(query)
+    results = embedding_store.top_k(query, 100, cutoff=Cutoff(min_z=3))
+    assert len(results) == np.count_nonzero(scores > scores.mean() + 3 * scores.std())
+    assert [path for path, _ in results[:2]] == ["/photos/0.jpg", "/photos/1.jpg"]
+
+@pytest.mark.parametrize("cutoff", [None, Cutoff(min_z=2), Cutoff(max_gap=0.02), Cutoff(top_margin=0.5)])
+def test_pages_add_up_to_the_ranking(embedding_store, cutoff):
+    query = query_of(embedding_store)
+    ranking = embedding_store.top_k(query, 30, threshold=0.0, cutoff=cutoff)
+    pages = [embedding_store.top_k(query, 10, threshold=0.0, cutoff=cutoff, offset=offset) for offset in (0, 10, 20)]
+    assert sum(pages, []) == ranking
+
+def test_library_pages_add_up_to_the_ranking(embedding_store):
+    library = Library(path=None)
+    vectors = np.asarray(embedding_store.vectors)
+    for i, folder in enumerate(("/photos/a", "/photos/b", "/photos/c")):
+        rows = slice(1000 * i, 1000 * (i + 1))
+        library.folders.append(folder)
+        library.set_shard(folder, store.EmbeddingStore(embedding_store.paths[rows], vectors[rows]))
+    query = query_of(embedding_store)
+    cutoff = Cutoff(min_z=1)
+    ranking = library.top_k(query, 24, cutoff=cutoff)
+    assert ranking == embedding_store.top_k(query, 24, cutoff=cutoff)
+    pages = [library.top_k(query, 8, cutoff=cutoff, offset=offset) for offset in (0, 8, 16)]
+    assert sum(pages, []) == ranking
+
+def test_group_pages_add_up_to_the_ranking():
+    vectors = random_embeddings(200, seed=2)
+    vectors[1::2] = vectors[0::2]
+    hashes = np.array([b"%032d" % (i // 2) for i in range(200)], dtype="S32")
+    embedding_store = store.EmbeddingStore([f"/photos/{i}.jpg" for i in range(200)], vectors, columns={"hash": hashes})
+    query = vectors[0]
+    ranking = embedding_store.top_k_groups(query, 12, threshold=-1.0)
+    assert len(ranking) == 12
+    assert all(len(alternates) == 1 for _, _, alternates in ranking)
+    pages = [embedding_store.top_k_groups(query, 4, threshold=-1.0, offset=offset) for offset in (0, 4, 8)]
+    assert sum(pages, []) == ranking
@@ -0,0 +1,53 @@
+import os
+import json
+import shutil
+import pytest
+
+import cli
+import main
+from conftest import write_image
+
+@pytest.fixture
+def photos(tmp_path, fake_encoder, monkeypatch):
+    # The commands use the fake encoder instead of the one their options select
+    monkeypatch.setattr(cli, "set_encoder", lambda args: None)
+    folder = str(tmp_path / "photos")
+    for colour in ("red", "green", "blue"):
+        write_image(os.path.join(folder, f"{colour}.png"), colour)
+    shutil.copy(os.path.join(folder, "red.png"), os.path.join(folder, "red copy.png"))
+    return folder
+
+def run_json(capsys, *argv):
+    capsys.readouterr()
+    cli.run(list(argv) + ["--json"])
+    return json.loads(capsys.readouterr().out)
+
+def test_index_search_and_similar(photos, capsys):
+    cli.run(["index", photos, "--quiet", "--workers", "1"])
+    assert "Indexed 4 image(s)" in capsys.readouterr().out
+
+    results = run_json(capsys, "search", photos, "blue", "-k", "1")
+    assert [os.path.basename(result["path"]) for result in results] == ["blue.png"]
+    grouped = run_json(capsys, "search", photos, "red", "-k", "1", "--collapse")
+    assert len(grouped) == 1 and len(grouped[0]["alternates"]) == 1
+    assert run_json(capsys, "search", photos, "red", "-k", "1", "--offset", "1")[0]["path"] == grouped[0]["alternates"][0]
+
+    similar = run_json(capsys, "similar", photos, os.path.join(photos, "red.png"), "-k", "3", "--threshold", "-1")
+    assert sorted(os.path.basename(result["path"]) for result in similar) == ["blue.png", "green.png"]
+
+    cli.run(["stats", photos, "--json"])
+    assert json.loads(capsys.readouterr().out)["images"] == 4
+
+def test_results_are_printed_when_the_query_cache_cannot_be_saved(photos, capsys, tmp_path, monkeypatch):
+    cli.run(["index", photos, "--quiet", "--workers", "1", "--no-isolate"])
+    blocker = tmp_path / "file"
+    blocker.write_text("")
+    monkeypatch.setattr(main.text_cache, "path", str(blocker / "text_cache.npz"))
+    cli.run(["search", photos, "green", "-k", "1"])
+    out = capsys.readouterr().out
+    assert "green.png" in out
+    assert "Could not save the query cache" in out
+
+def test_search_without_an_index(photos):
+    with pytest.raises(SystemExit, match="No saved index"):
+        cli.run(["search", photos, "red"])
@@ -0,0 +1,34 @@
+import io
+import numpy as np
+import pytest
+from PIL import Image
+
+import main
+from decoder import DecodePool
+
+def image_bytes(size, image_format):
+    # A gradient, so a different reduction would show in the pixels
+    x = np.linspace(0, 255, size[0], dtype=np.float32)
+    y = np.linspace(0, 255, size[1], dtype=np.float32)
+    pixels = np.stack(np.broadcast_arrays(x[None, :], y[:, None], (x[None, :] + y[:, None]) / 2), axis=-1)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels.astype(np.uint8)).save(buffer, image_format)
+    return buffer.getvalue()
+
+def test_large_images_are_reduced_like_jpeg_drafts():
+    image, content, method = main._decode_image(image_bytes((1200, 900), "PNG"), min_side=224)
+    assert method == "full"
+    assert image.size == (300, 225)
+    assert content["phash"]
+    full, _, _ = main._decode_image(image_bytes((1200, 900), "PNG"), min_side=None)
+    assert full.size == (1200, 900)
+
+@pytest.mark.parametrize("image_format", ["PNG", "JPEG"])
+def test_workers_decode_like_threads(image_format):
+    data = image_bytes((1600, 1000), image_format)
+    threaded, threaded_content, threaded_method = main._decode_image(data, min_side=224)
+    with DecodePool(1) as pool:
+        isolated, isolated_content, isolated_method = pool.decode(data, min_side=224)
+    assert (isolated_method, isolated_content) == (threaded_method, threaded_content)
+    assert isolated.size == threaded.size
+    np.testing.assert_array_equal(np.asarray(isolated), np.asarray(threaded))
@@ -0,0 +1,103 @@
+import os
+from datetime import datetime
+import pytest
+
+import filters
+import store
+from conftest import random_embeddings, file_columns
+
+def timestamp(*date):
+    return datetime(*date).timestamp()
+
+@pytest.fixture
+def photos():
+    folder = os.path.abspath("photos")
+    paths = [os.path.join(folder, "trips", "beach.jpg"),
+             os.path.join(folder, "trips", "dunes.PNG"),
+             os.path.join(folder, "home", "cat.jpg"),
+             os.path.join(folder, "home", "dog.gif")]
+    columns = file_columns(
+        4,
+        size=[3 * 1024 ** 2, 200 * 1024, 800 * 1024, 50 * 1024],
+        mtime=[timestamp(2024, 1, 1)] * 4,
+        # The cat has no EXIF date, so it goes by its modification time
+        taken=[timestamp(2023, 7, 14), timestamp(2023, 8, 2), 0, timestamp(2022, 12, 24)],
+        camera=[b"canon eos 5d", b"canon eos 5d", b"", b"apple iphone 12"],
+    )
+    return folder, store.EmbeddingStore(paths, random_embeddings(4), columns=columns)
+
+def matching(where, embedding_store):
+    mask = where.mask(embedding_store)
+    return [os.path.basename(path) for path, kept in zip(embedding_store.paths, mask) if kept]
+
+def test_split_query_takes_out_filter_terms():
+    query, where = filters.split_query('beach at sunset after:2023-06-01 camera:"EOS 5D" type:jpg,png larger:1MB')
+    assert query == "beach at sunset"
+    assert where.after == timestamp(2023, 6, 1)
+    assert where.camera == "eos 5d"
+    assert where.extensions == [".jpg", ".png"]
+    assert where.min_size == 1024 ** 2
+    assert where.before is None and where.max_size is None
+
+def test_split_query_without_terms():
+    query, where = filters.split_query("a boy wearing a hat")
+    assert query == "a boy wearing a hat"
+    assert not where
+    assert where.mask(store.EmbeddingStore()) is None
+
+def test_split_query_rejects_invalid_values():
+    with pytest.raises(ValueError):
+        filters.split_query("after:yesterday")
+    with pytest.raises(ValueError):
+        filters.split_query("smaller:huge")
+
+def test_parse_only_accepts_filter_terms():
+    assert filters.Filter.parse("type:gif").extensions == [".gif"]
+    with pytest.raises(ValueError):
+        filters.Filter.parse("cats type:gif")
+
+@pytest.mark.parametrize("text, size", [("500KB", 500 * 1024), ("2mb", 2 * 1024 ** 2), ("1024", 1024), ("1.5 GB", int(1.5 * 1024 ** 3))])
+def test_parse_size(text, size):
+    assert filters.parse_size(text) == size
+
+def test_mask_by_date_camera_type_and_size(photos):
+    _, embedding_store = photos
+    assert matching(filters.Filter.parse("after:2023-06-01 before:2023-08-01"), embedding_store) == ["beach.jpg"]
+    # The cat has no EXIF date, so it goes by its modification time
+    assert matching(filters.Filter.parse("after:2023-12-01"), embedding_store) == ["cat.jpg"]
+    assert matching(filters.Filter.parse("camera:canon"), embedding_store) == ["beach.jpg", "dunes.PNG"]
+    assert matching(filters.Filter.parse("type:png,gif"), embedding_store) == ["dunes.PNG", "dog.gif"]
+    assert matching(filters.Filter.parse("larger:500KB smaller:1MB"), embedding_store) == ["cat.jpg"]
+
+def test_mask_by_folder(photos):
+    folder, embedding_store = photos
+    where = filters.Filter(folders=[os.path.join(folder, "trips")])
+    assert matching(where, embedding_store) == ["beach.jpg", "dunes.PNG"]
+    assert where.covers_folder(folder)
+    assert not where.covers_folder(os.path.abspath("elsewhere"))
+    # A folder that only shares a name prefix is not inside it
+    assert matching(filters.Filter(folders=[os.path.join(folder, "trip")]), embedding_store) == []
+
+def test_mask_excludes_paths(photos):
+    folder, embedding_store = photos
+    where = filters.Filter.parse("type:jpg").excluding([os.path.join(folder, "home", "cat.jpg")])
+    assert matching(where, embedding_store) == ["beach.jpg"]
+
+@pytest.mark.parametrize("terms", ["smaller:1MB", "larger:1KB", "before:2030-01-01", "after:2000-01-01", "camera:canon"])
+def test_conditions_on_missing_columns_match_nothing(photos, terms):
+    _, embedding_store = photos
+    bare = store.EmbeddingStore(embedding_store.paths, embedding_store.vectors)
+    assert matching(filters.Filter.parse(terms), bare) == []
+    assert matching(filters.Filter.parse("type:jpg"), bare) == ["beach.jpg", "cat.jpg"]
+
+def test_dates_fall_back_to_the_modification_time(photos):
+    _, embedding_store = photos
+    mtimes = store.EmbeddingStore(embedding_store.paths, embedding_store.vectors,
+                                  columns={"mtime": embedding_store.column("mtime")})
+    assert len(matching(filters.Filter.parse("after:2023-12-01"), mtimes)) == 4
+
+def test_top_k_only_returns_matching_rows(photos):
+    _, embedding_store = photos
+    where = filters.Filter.parse("camera:iphone")
+    results = embedding_store.top_k(embedding_store.vectors[0], 4, where=where)
+    assert [os.path.basename(path) for path, _ in results] == ["dog.gif"]
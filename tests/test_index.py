@@ -0,0 +1,81 @@
+import os
+import shutil
+import numpy as np
+import pytest
+
+import main
+import store
+from conftest import write_image, file_columns
+
+@pytest.fixture
+def photos(tmp_path):
+    folder = str(tmp_path / "photos")
+    for colour in ("red", "green", "blue"):
+        write_image(os.path.join(folder, f"{colour}.png"), colour)
+    os.makedirs(os.path.join(folder, "backup"))
+    shutil.copy(os.path.join(folder, "red.png"), os.path.join(folder, "backup", "red.png"))
+    return folder
+
+def best(query, embeddings, folder):
+    """The best result of a search, relative to the folder."""
+    (path, _), = main.search_images(query, embeddings, top_k=1)
+    return os.path.relpath(path, folder)
+
+def test_index_encodes_each_content_once(photos, fake_encoder):
+    embeddings = main.index_images(photos, batch_size=2, num_workers=2)
+    assert len(embeddings) == 4
+    assert fake_encoder.encoded == 3
+    np.testing.assert_array_equal(embeddings[os.path.join(photos, "red.png")],
+                                  embeddings[os.path.join(photos, "backup", "red.png")])
+    assert best("green", embeddings, photos) == "green.png"
+
+    # A second run reuses the saved rows and searches the saved index in place
+    again = main.index_images(photos, num_workers=2)
+    assert fake_encoder.encoded == 3
+    assert again.mapped
+    assert sorted(again.paths) == sorted(embeddings.paths)
+
+@pytest.mark.parametrize("mapped", [True, False])
+def test_update_adds_drops_and_moves_files(photos, fake_encoder, mapped):
+    main.index_images(photos, num_workers=1)
+    embeddings = store.open_index(photos)
+    if not mapped:
+        embeddings = store.EmbeddingStore(list(embeddings.paths), np.array(embeddings.matrix),
+                                          columns={name: np.array(values) for name, values in embeddings.columns.items()},
+                                          encoder=embeddings.encoder)
+    encoded = fake_encoder.encoded
+    yellow = write_image(os.path.join(photos, "yellow.png"), "yellow")
+    os.remove(os.path.join(photos, "blue.png"))
+    moved = os.path.join(photos, "greens", "green.png")
+    os.makedirs(os.path.dirname(moved))
+    os.replace(os.path.join(photos, "green.png"), moved)
+    changed = [yellow, os.path.join(photos, "blue.png"), os.path.join(photos, "green.png"), moved]
+
+    updated = main.update_index(photos, embeddings, changed, num_workers=1)
+    # Only the new file is encoded; the moved one keeps its embedding
+    assert fake_encoder.encoded == encoded + 1
+    assert updated.mapped == mapped
+    expected = ["backup/red.png", "greens/green.png", "red.png", "yellow.png"]
+    assert sorted(os.path.relpath(path, photos).replace(os.sep, "/") for path in updated.paths) == expected
+    assert best("yellow", updated, photos) == "yellow.png"
+    assert best("green", updated, photos) == os.path.join("greens", "green.png")
+
+    saved = store.open_index(photos)
+    assert sorted(saved.paths) == sorted(updated.paths)
+    np.testing.assert_array_equal(saved[moved], updated[moved])
+    assert main.update_index(photos, updated, [yellow]) is updated
+
+def test_interrupted_run_resumes_from_its_checkpoint(photos, fake_encoder):
+    red = os.path.join(photos, "red.png")
+    stat = os.stat(red)
+    with open(red, "rb") as f:
+        digest = store.content_hash(f.read())
+    # A run that died after encoding red.png (with a vector the fake encoder would not give)
+    vector = np.array([[0.0, 0.0, 1.0]], dtype=np.float32)
+    store.save_checkpoint(photos, [red], file_columns(1, size=[stat.st_size], mtime=[stat.st_mtime], hash=[digest]),
+                          vector, encoder=dict(fake_encoder.info(), dim=3))
+
+    embeddings = main.index_images(photos, num_workers=1)
+    assert fake_encoder.encoded == 2
+    np.testing.assert_array_equal(embeddings[red], vector)
+    assert store.load_checkpoint(photos) is None
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+import store
+import quantize
+from conftest import random_embeddings
+
+def test_int8_codes_round_trip():
+    x = random_embeddings(100, dim=64)
+    codes, scales = quantize.quantize_int8(x)
+    assert codes.dtype == np.int8 and scales.dtype == np.float32
+    assert np.abs(codes).max(axis=1).tolist() == [quantize.INT8_MAX] * 100
+    np.testing.assert_allclose(quantize.dequantize_int8(codes, scales), x, atol=scales.max() / 2 + 1e-7)
+    zero_codes, zero_scales = quantize.quantize_int8(np.zeros((1, 8)))
+    assert not zero_codes.any() and zero_scales[0] == 0
+
+def test_hamming_scores_are_sign_cosines():
+    x = np.array([[1, -1, 1, -1, 1, -1, 1, -1], [1, 1, 1, 1, 1, 1, 1, 1], [-1] * 8], dtype=np.float32)
+    bits = quantize.pack_signs(x)
+    np.testing.assert_allclose(quantize.hamming_scores(bits, bits[1]), [0.0, 1.0, -1.0])
+
+def test_format_names():
+    assert quantize.format_name(np.float16) == "float16"
+    assert quantize.format_name("binary") == "binary"
+    with pytest.raises(ValueError):
+        quantize.format_name(np.float64)
+    assert quantize.bytes_per_vector("int8", 512) == 516
+
+@pytest.mark.parametrize("dtype", [np.float16, "int8"])
+def test_compact_scores_stay_close(dtype):
+    x = random_embeddings(2000, dim=64)
+    paths = [f"/photos/{i}.jpg" for i in range(len(x))]
+    exact = store.EmbeddingStore(paths, x)
+    compact = store.EmbeddingStore(paths, x, dtype=dtype)
+    for query in x[:10]:
+        np.testing.assert_allclose(compact.scores(query), exact.scores(query), atol=0.02)
+        expected = {path for path, _ in exact.top_k(query, 10)}
+        assert len(expected & {path for path, _ in compact.top_k(query, 10)}) >= 8
+
+def test_binary_rescores_its_candidates():
+    x = random_embeddings(2000, dim=64)
+    paths = [f"/photos/{i}.jpg" for i in range(len(x))]
+    binary = store.EmbeddingStore(paths, x, dtype="binary")
+    int8 = store.EmbeddingStore(paths, x, dtype="int8")
+    for i in range(10):
+        results = binary.top_k(x[i], 5)
+        assert results[0][0] == paths[i]
+        # The returned scores are the int8 ones, not the Hamming estimates
+        np.testing.assert_allclose([score for _, score in results],
+                                   int8.scores(x[i])[[int(path[8:-4]) for path, _ in results]], atol=1e-6)
@@ -0,0 +1,24 @@
+import os
+import shutil
+
+import main
+from conftest import write_image
+
+def names(results):
+    return [os.path.basename(result[0]) for result in results]
+
+def test_search_similar_leaves_out_copies_of_the_example(tmp_path, fake_encoder):
+    folder = str(tmp_path / "photos")
+    example = write_image(os.path.join(folder, "red.png"), "red")
+    shutil.copy(example, os.path.join(folder, "red copy.png"))
+    write_image(os.path.join(folder, "dark red.png"), (180, 40, 30))
+    write_image(os.path.join(folder, "blue.png"), "blue")
+    embeddings = main.index_images(folder, num_workers=1)
+
+    results = main.search_similar(example, embeddings, top_k=2, threshold=-1.0)
+    assert names(results) == ["dark red.png", "blue.png"]
+    grouped = main.search_similar(example, embeddings, top_k=2, threshold=-1.0, collapse=True)
+    assert [(os.path.basename(path), alternates) for path, _, alternates in grouped] == \
+        [("dark red.png", []), ("blue.png", [])]
+    assert names(main.search_similar(example, embeddings, top_k=2, include_examples=True))[1] in \
+        ("red.png", "red copy.png")
@@ -0,0 +1,63 @@
+import os
+import json
+import threading
+import urllib.error
+import urllib.request
+from urllib.parse import urlencode
+import pytest
+
+import main
+from server import SearchServer
+from conftest import write_image
+
+@pytest.fixture
+def server(tmp_path, fake_encoder):
+    folder = str(tmp_path / "photos")
+    for colour in ("red", "green", "blue", "yellow"):
+        write_image(os.path.join(folder, f"{colour}.png"), colour)
+    search_server = SearchServer(folder, main.index_images(folder, num_workers=1), port=0)
+    thread = threading.Thread(target=search_server.serve_forever, daemon=True)
+    thread.start()
+    yield search_server
+    search_server.shutdown()
+    search_server.server_close()
+
+def get(server, endpoint, **params):
+    url = f"http://127.0.0.1:{server.server_address[1]}{endpoint}?{urlencode(params)}"
+    try:
+        with urllib.request.urlopen(url, timeout=10) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        with e:
+            return e.code, json.loads(e.read())
+
+def basenames(payload):
+    return [os.path.basename(result["path"]) for result in payload["results"]]
+
+def test_search_and_similar(server):
+    status, payload = get(server, "/search", q="yellow", k=1)
+    assert status == 200
+    assert payload["query"] == "yellow"
+    assert basenames(payload) == ["yellow.png"]
+    _, payload = get(server, "/search", q="green type:gif", k=1)
+    assert payload["results"] == []
+    _, payload = get(server, "/similar", path=os.path.join(server.folder, "red.png"), k=3, threshold=-1)
+    assert "red.png" not in basenames(payload) and len(payload["results"]) == 3
+    assert get(server, "/stats") == (200, {"folder": server.folder, "images": 4})
+
+def test_concurrent_queries_share_batches(server):
+    results = {}
+    def search(colour):
+        results[colour] = basenames(get(server, "/search", q=colour, k=1)[1])
+    threads = [threading.Thread(target=search, args=(colour,)) for colour in ("red", "green", "blue", "yellow")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == {colour: [f"{colour}.png"] for colour in ("red", "green", "blue", "yellow")}
+
+def test_invalid_requests(server):
+    assert get(server, "/search")[0] == 400
+    assert get(server, "/search", q="red", offset=-1)[0] == 400
+    assert get(server, "/search", q="red after:yesterday")[0] == 400
+    assert get(server, "/nowhere")[0] == 404
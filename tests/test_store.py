@@ -0,0 +1,120 @@
+import os
+import numpy as np
+import pytest
+
+import store
+from conftest import random_embeddings, file_columns
+
+def saved_files(index_root, folder):
+    return sorted(os.listdir(store.index_dir(folder, index_root)))
+
+def test_select_top_k_orders_and_thresholds():
+    scores = np.array([0.1, 0.9, 0.5, 0.7, 0.5, 0.2], dtype=np.float32)
+    assert store.select_top_k(scores, 3).tolist() == [1, 3, 2]
+    assert store.select_top_k(scores, 10, threshold=0.4).tolist() == [1, 3, 2, 4]
+    assert store.select_top_k(scores, 0).tolist() == []
+    assert store.select_top_k(scores, 3, threshold=1.0).tolist() == []
+
+def test_group_duplicates_by_hash_and_phash():
+    results = [
+        (0.90, "a", 0b1111),
+        (0.89, "b", 0b1110),   # near duplicate of the first by perceptual hash
+        (0.85, "a", 0),        # same content as the first
+        (0.80, "c", 0),        # unknown perceptual hash never matches
+        (0.20, "d", 0b1111),   # same perceptual hash, but scores far lower
+        (0.19, "", 0),
+    ]
+    assert store.group_duplicates(results) == [[0, 1, 2], [3], [4], [5]]
+    assert store.group_duplicates(results, max_distance=0) == [[0, 2], [1], [3], [4], [5]]
+
+@pytest.mark.parametrize("mmap", [True, False])
+def test_save_load_round_trip(index_root, mmap):
+    paths = ["/photos/a.jpg", "/photos/b/ü.png", "/photos/c.jpeg"]
+    embeddings = random_embeddings(3)
+    columns = file_columns(3, size=[1, 2, 3], mtime=[4.5, 5.5, 6.5], hash=[b"x", b"y", b"z"], camera=[b"", b"Canon", b""])
+    store.save_index("/photos", paths, columns, embeddings, root=index_root, encoder={"name": "test"})
+
+    loaded_paths, loaded_columns, loaded_embeddings, ann = store.load_index("/photos", root=index_root, mmap=mmap)
+    assert list(loaded_paths) == paths
+    assert isinstance(loaded_embeddings, np.memmap) == mmap
+    np.testing.assert_array_equal(loaded_embeddings, embeddings)
+    for name in store.FILE_COLUMNS:
+        np.testing.assert_array_equal(loaded_columns[name], columns[name])
+    assert ann is None
+    assert store.index_info("/photos", root=index_root)["images"] == 3
+    assert store.load_index("/elsewhere", root=index_root) is None
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float16, "int8", "binary"])
+def test_open_index_keeps_the_format(index_root, dtype):
+    embeddings = random_embeddings(50)
+    original = store.EmbeddingStore([f"/photos/{i}.jpg" for i in range(50)], embeddings, dtype=dtype,
+                                    columns=file_columns(50))
+    columns = dict(original.columns)
+    store.save_index("/photos", original.paths, columns, original.matrix, root=index_root)
+
+    opened = store.open_index("/photos", root=index_root)
+    assert opened.mapped
+    assert opened.format == original.format
+    assert list(opened.paths) == original.paths
+    np.testing.assert_array_equal(np.asarray(opened.vectors), np.asarray(original.vectors))
+    query = embeddings[7]
+    assert opened.top_k(query, 5) == original.top_k(query, 5)
+
+def test_save_replaces_the_previous_generation(index_root):
+    store.save_index("/photos", ["/photos/a.jpg"], file_columns(1), random_embeddings(1), root=index_root)
+    first = saved_files(index_root, "/photos")
+    # A reader of the first generation keeps its mapping while the index is saved again
+    reader = store.open_index("/photos", root=index_root)
+    store.save_index("/photos", ["/photos/a.jpg", "/photos/b.jpg"], file_columns(2), random_embeddings(2, seed=1),
+                     root=index_root)
+
+    assert store.index_info("/photos", root=index_root)["generation"] == 2
+    assert not set(first) & set(saved_files(index_root, "/photos")) - {"manifest.json"}
+    assert list(store.open_index("/photos", root=index_root).paths) == ["/photos/a.jpg", "/photos/b.jpg"]
+    assert list(reader.paths) == ["/photos/a.jpg"]
+
+def test_concatenated_rows_are_saved_as_one_matrix(index_root):
+    first, second = random_embeddings(3), random_embeddings(5, seed=1)
+    keep = np.array([True, False, True, True, False])
+    rows = store.ConcatenatedRows([(first, None), (second, keep), (second[:0], None)])
+    assert rows.shape == (6, 32)
+    store.save_index("/photos", [f"/photos/{i}.jpg" for i in range(6)], file_columns(6), rows, root=index_root)
+    _, _, embeddings, _ = store.load_index("/photos", root=index_root)
+    np.testing.assert_array_equal(embeddings, np.concatenate([first, second[keep]]))
+
+def test_unusable_manifest_means_no_index(index_root):
+    store.save_index("/photos", ["/photos/a.jpg"], file_columns(1), random_embeddings(1), root=index_root)
+    with open(os.path.join(store.index_dir("/photos", index_root), "manifest.json"), "w") as f:
+        f.write("{")
+    assert store.load_index("/photos", root=index_root) is None
+    assert store.open_index("/photos", root=index_root) is None
+
+def test_checkpoints_are_recovered_latest_row_first(index_root):
+    assert store.load_checkpoint("/photos", root=index_root) is None
+    first = random_embeddings(2)
+    second = random_embeddings(2, seed=1)
+    store.save_checkpoint("/photos", ["/photos/a.jpg", "/photos/b.jpg"], file_columns(2, size=[1, 2]), first,
+                          root=index_root, encoder={"name": "test"})
+    store.save_checkpoint("/photos", ["/photos/b.jpg", "/photos/c.jpg"], file_columns(2, size=[3, 4]), second,
+                          root=index_root, encoder={"name": "test"})
+
+    recovered = store.load_checkpoint("/photos", root=index_root)
+    assert recovered.encoder == {"name": "test"}
+    assert sorted(recovered.paths) == ["/photos/a.jpg", "/photos/b.jpg", "/photos/c.jpg"]
+    np.testing.assert_array_equal(recovered.vector("/photos/b.jpg").ravel(), second[0])
+    assert recovered.column("size")[recovered.row("/photos/b.jpg")] == 3
+
+def test_checkpoints_of_another_encoder_are_ignored(index_root):
+    store.save_checkpoint("/photos", ["/photos/a.jpg"], file_columns(1), random_embeddings(1),
+                          root=index_root, encoder={"name": "old"})
+    store.save_checkpoint("/photos", ["/photos/b.jpg"], file_columns(1), random_embeddings(1),
+                          root=index_root, encoder={"name": "new"})
+    with open(os.path.join(store.index_dir("/photos", index_root), "checkpoint.3.npz"), "wb") as f:
+        f.write(b"truncated")
+    assert list(store.load_checkpoint("/photos", root=index_root).paths) == ["/photos/b.jpg"]
+
+def test_save_index_supersedes_checkpoints(index_root):
+    store.save_checkpoint("/photos", ["/photos/a.jpg"], file_columns(1), random_embeddings(1), root=index_root)
+    store.save_index("/photos", ["/photos/a.jpg"], file_columns(1), random_embeddings(1), root=index_root)
+    assert store.load_checkpoint("/photos", root=index_root) is None
+    assert not [name for name in saved_files(index_root, "/photos") if name.startswith("checkpoint.")]
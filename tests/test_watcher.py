@@ -0,0 +1,38 @@
+import os
+import time
+import pytest
+
+import main
+from watcher import FolderWatcher
+from conftest import write_image
+
+@pytest.mark.parametrize("use_inotify", [True, False])
+def test_watcher_applies_changes_to_the_index(tmp_path, fake_encoder, use_inotify):
+    folder = str(tmp_path / "photos")
+    write_image(os.path.join(folder, "red.png"), "red")
+    write_image(os.path.join(folder, "blue.png"), "blue")
+    embeddings = main.index_images(folder, num_workers=1)
+
+    updates = []
+    def names():
+        return sorted(os.path.basename(path) for path in updates[-1][0].paths) if updates else None
+    watcher = FolderWatcher(folder, embeddings, on_update=lambda store, paths: updates.append((store, paths)),
+                            debounce=0.2, poll_interval=0.1,
+                            use_inotify=use_inotify, num_workers=1).start()
+    try:
+        deadline = time.monotonic() + 5
+        while watcher.backend is None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        yellow = write_image(os.path.join(folder, "yellow.png"), "yellow")
+        os.remove(os.path.join(folder, "blue.png"))
+        # The two changes may come as one update or as two
+        deadline = time.monotonic() + 10
+        while names() != ["red.png", "yellow.png"] and time.monotonic() < deadline:
+            time.sleep(0.05)
+    finally:
+        watcher.stop()
+
+    store, _ = updates[-1]
+    assert names() == ["red.png", "yellow.png"]
+    assert watcher.embeddings is store
+    assert main.search_images("yellow", store, top_k=1)[0][0] == yellow
@@ -0,0 +1,102 @@
+"""
+Disk-backed thumbnail cache for SnapSeek's result view.
+
+Decoding a full-size camera photo just to show a small preview is the slowest part
+of displaying results. ThumbnailCache keeps small JPEG copies under
+~/.snapseek/thumbnails, keyed by the image path, its mtime and its size, so an
+edited image gets a fresh thumbnail. Once the cache grows past `max_bytes`, the
+least recently used thumbnails are deleted.
+"""
+import os
+import hashlib
+import threading
+from PIL import Image
+
+# Where thumbnails are kept, and their longest side in pixels
+THUMBNAIL_DIR = os.path.join(os.path.expanduser("~"), ".snapseek", "thumbnails")
+THUMBNAIL_SIZE = 400
+
+# Default size bound of the cache (bytes)
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+# Evicting means listing the whole cache directory, so only check every so many writes
+EVICT_CHECK_INTERVAL = 200
+
+class ThumbnailCache:
+    """Thread-safe cache of image thumbnails on disk with least-recently-used eviction."""
+
+    def __init__(self, directory=THUMBNAIL_DIR, size=THUMBNAIL_SIZE, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.size = size
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    def _cache_path(self, path, stat):
+        key = f"{os.path.abspath(path)}|{stat.st_mtime_ns}|{stat.st_size}|{self.size}"
+        return os.path.join(self.directory, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".jpg")
+
+    def get(self, path):
+        """
+        Returns an RGB thumbnail (PIL image) of the file, no larger than `size`.
+        Raises OSError if the image cannot be read.
+        """
+        stat = os.stat(path)
+        cache_path = self._cache_path(path, stat)
+        try:
+            # A copy of the pixels, so the file is closed before it is returned
+            with Image.open(cache_path) as cached:
+                thumbnail = cached.convert("RGB")
+            # The mtime of a cache entry records when it was last used (for eviction)
+            os.utime(cache_path)
+            return thumbnail
+        except OSError:
+            pass
+
+        with Image.open(path) as image:
+            # Let the JPEG decoder scale down while decoding instead of decoding full size
+            image.draft("RGB", (self.size, self.size))
+            image.thumbnail((self.size, self.size))
+            thumbnail = image.convert("RGB")
+        self._store(cache_path, thumbnail)
+        return thumbnail
+
+    def _store(self, cache_path, thumbnail):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_path = f"{cache_path}.{threading.get_ident()}.tmp"
+            thumbnail.save(tmp_path, "JPEG", quality=85)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            # The cache is an optimisation only; the thumbnail is still returned
+            print(f"Could not cache thumbnail {cache_path}: {e}")
+            return
+        with self._lock:
+            self._writes += 1
+            check = self._writes % EVICT_CHECK_INTERVAL == 1
+        if check:
+            self.evict()
+
+    def evict(self):
+        """Deletes the least recently used thumbnails until the cache is below 90% of max_bytes."""
+        try:
+            entries = []
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    if entry.name.endswith(".jpg"):
+                        stat = entry.stat()
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+        except OSError:
+            return
+        total = sum(size for _, size, _ in entries)
+        if total <= self.max_bytes:
+            return
+        target = 0.9 * self.max_bytes
+        for _, size, cache_path in sorted(entries):
+            try:
+                os.remove(cache_path)
+            except OSError:
+                continue
+            total -= size
+            if total <= target:
+                break
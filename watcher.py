@@ -0,0 +1,286 @@
+"""
+Live index updates for SnapSeek.
+
+FolderWatcher follows an indexed folder in a background thread and keeps its
+EmbeddingStore current: photos that are added, changed, moved or deleted are
+encoded or dropped with main.update_index, and the new store is handed to an
+`on_update` callback (the GUI swaps it into its library, the server into the
+store it searches). Nothing is re-encoded that did not change.
+
+Changes are picked up with inotify on Linux (through ctypes, no extra package).
+Elsewhere, or when inotify is unavailable (e.g. the watch limit is reached), the
+folder is polled: re-scanned every few seconds, comparing sizes and mtimes.
+
+Events are debounced: a copy of a hundred photos is applied as one update once the
+folder has been quiet for DEBOUNCE_SECONDS (or at the latest MAX_DELAY_SECONDS after
+the first event), not as a hundred updates of one photo each.
+"""
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import threading
+
+import main
+from scanner import scan_images, path_filter, DEFAULT_EXCLUDE
+
+# An update is applied once no event arrived for this long (seconds)...
+DEBOUNCE_SECONDS = 1.0
+
+# ...or this long after the first pending event, for folders that never go quiet
+MAX_DELAY_SECONDS = 10.0
+
+# Seconds between two scans of the polling backend
+POLL_INTERVAL_SECONDS = 5.0
+
+# inotify event bits (see inotify(7))
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+_WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+_EVENT_HEADER = struct.Struct("iIII")
+
+def _scan_state(folder, recursive, include, exclude):
+    """{path: (size, mtime)} of every image a scan of the folder finds."""
+    return {path: (stat.st_size, stat.st_mtime)
+            for path, stat in scan_images(folder, recursive=recursive, include=include, exclude=exclude)}
+
+def _store_state(embeddings):
+    """{path: (size, mtime)} of the rows of a store (files it has no columns for never match)."""
+    columns = embeddings.columns
+    if "size" not in columns:
+        return {path: None for path in embeddings.paths}
+    return dict(zip(embeddings.paths, zip(columns["size"].tolist(), columns["mtime"].tolist())))
+
+def _changed_paths(before, after):
+    """Paths that were added, removed or modified between two {path: (size, mtime)} states."""
+    changed = {path for path, state in after.items() if before.get(path) != state}
+    changed.update(path for path in before if path not in after)
+    return changed
+
+class PollingBackend:
+    """Finds changes by scanning the folder every `interval` seconds and comparing with the last scan."""
+
+    name = "polling"
+
+    def __init__(self, watcher, interval=POLL_INTERVAL_SECONDS):
+        self.watcher = watcher
+        self.interval = interval
+        self.state = _store_state(watcher.embeddings)
+        self.next_poll = time.monotonic()
+
+    def wait(self, timeout):
+        """Returns the set of changed paths, waiting at most `timeout` seconds for the next scan."""
+        delay = self.next_poll - time.monotonic()
+        if delay > 0:
+            self.watcher._stop.wait(min(timeout, delay))
+            return set()
+        self.next_poll = time.monotonic() + self.interval
+        state = _scan_state(self.watcher.folder, self.watcher.recursive, self.watcher.include, self.watcher.exclude)
+        changed = _changed_paths(self.state, state)
+        self.state = state
+        return changed
+
+    def close(self):
+        pass
+
+class InotifyBackend:
+    """
+    Receives change events from the Linux kernel; every directory of the tree gets
+    a watch. Raises OSError if inotify cannot be used, so the caller can poll instead.
+    """
+
+    name = "inotify"
+
+    def __init__(self, watcher):
+        if not sys.platform.startswith("linux"):
+            raise OSError(errno.ENOSYS, "inotify is only available on Linux")
+        self.watcher = watcher
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.directories = {}
+        try:
+            self.add_tree(watcher.folder)
+        except OSError:
+            self.close()
+            raise
+        # Changes made before the watches were in place (e.g. while SnapSeek was closed)
+        self.pending = _changed_paths(_store_state(watcher.embeddings), self.scan(watcher.folder))
+
+    def scan(self, folder):
+        return _scan_state(folder, self.watcher.recursive, self.watcher.include, self.watcher.exclude)
+
+    def add_watch(self, directory):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), _WATCH_MASK | IN_ONLYDIR)
+        if wd < 0:
+            code = ctypes.get_errno()
+            if code == errno.ENOENT:
+                # Gone again before it could be watched
+                return
+            # ENOSPC: fs.inotify.max_user_watches is exhausted
+            raise OSError(code, f"Cannot watch {directory}: {os.strerror(code)}")
+        self.directories[wd] = directory
+
+    def add_tree(self, folder):
+        """Watches `folder` and, for a recursive watcher, every directory below it that a scan would enter."""
+        self.add_watch(folder)
+        if not self.watcher.recursive:
+            return
+        for directory, subdirs, _ in os.walk(folder):
+            subdirs[:] = [name for name in subdirs if self.watcher.accepts(os.path.join(directory, name), True)]
+            for name in subdirs:
+                self.add_watch(os.path.join(directory, name))
+
+    def wait(self, timeout):
+        if self.pending:
+            changed, self.pending = self.pending, set()
+            return changed
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return set()
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return set()
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+            name = data[offset + _EVENT_HEADER.size:offset + _EVENT_HEADER.size + length].rstrip(b"\0")
+            offset += _EVENT_HEADER.size + length
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost: compare the whole folder with the store instead
+                changed.update(_changed_paths(_store_state(self.watcher.embeddings), self.scan(self.watcher.folder)))
+                continue
+            if mask & IN_IGNORED:
+                self.directories.pop(wd, None)
+                continue
+            directory = self.directories.get(wd)
+            if directory is None or not name:
+                continue
+            path = os.path.join(directory, os.fsdecode(name))
+            if mask & IN_ISDIR:
+                if not (self.watcher.recursive and self.watcher.accepts(path, True)):
+                    continue
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    # A new or moved-in directory: watch it, and index what it already holds
+                    self.add_tree(path)
+                    changed.update(self.scan(path))
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    changed.add(path + os.sep)
+            elif self.watcher.accepts(path):
+                changed.add(path)
+        return changed
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+class FolderWatcher:
+    """
+    Keeps the EmbeddingStore of an indexed folder in step with the folder.
+
+    `embeddings` is the store the folder was indexed into; after every applied update
+    on_update(store, changed paths) is called from the watcher thread with the new
+    store, which replaces the old one (stores are swapped whole, never changed in
+    place, so searches that are running keep the store they started with).
+
+    `recursive`, `include` and `exclude` should match the scan the folder was indexed
+    with; further keyword arguments go to main.update_index.
+    """
+
+    def __init__(self, folder, embeddings, on_update=None, recursive=True, include=None, exclude=DEFAULT_EXCLUDE,
+                 debounce=DEBOUNCE_SECONDS, max_delay=MAX_DELAY_SECONDS, poll_interval=POLL_INTERVAL_SECONDS,
+                 use_inotify=True, **update_kwargs):
+        self.folder = os.path.abspath(folder)
+        self.embeddings = embeddings
+        self.on_update = on_update
+        self.recursive = recursive
+        self.include = include
+        self.exclude = exclude
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.poll_interval = poll_interval
+        self.use_inotify = use_inotify
+        self.update_kwargs = update_kwargs
+        self.accepts = path_filter(self.folder, include, exclude)
+        self.backend = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=f"watch {self.folder}", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, wait=True):
+        """Stops watching; an update that is being applied is finished (and saved) first."""
+        self._stop.set()
+        if wait and self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def _open_backend(self):
+        if self.use_inotify:
+            try:
+                return InotifyBackend(self)
+            except (OSError, AttributeError) as e:
+                # AttributeError: a C library without the inotify functions
+                if sys.platform.startswith("linux"):
+                    print(f"Error starting inotify for {self.folder}: {e}; polling instead")
+        return PollingBackend(self, self.poll_interval)
+
+    def _run(self):
+        self.backend = self._open_backend()
+        pending = set()
+        first_event = last_event = None
+        try:
+            while not self._stop.is_set():
+                timeout = self.debounce if pending else self.poll_interval
+                changed = self.backend.wait(timeout)
+                now = time.monotonic()
+                if changed:
+                    pending.update(changed)
+                    last_event = now
+                    if first_event is None:
+                        first_event = now
+                if pending and (now - last_event >= self.debounce or now - first_event >= self.max_delay):
+                    self._apply(pending)
+                    pending = set()
+                    first_event = last_event = None
+        finally:
+            self.backend.close()
+
+    def _apply(self, paths):
+        # Directory events stand for every indexed file below that directory
+        directories = tuple(path for path in paths if path.endswith(os.sep))
+        paths = {path for path in paths if not path.endswith(os.sep)}
+        if directories:
+            paths.update(path for path in self.embeddings.paths if path.startswith(directories))
+        try:
+            with main.metrics.stage("live_update", items=len(paths)):
+                updated = main.update_index(self.folder, self.embeddings, paths, **self.update_kwargs)
+        except Exception as e:
+            print(f"Error updating the index of {self.folder}: {e}")
+            return
+        if updated is self.embeddings:
+            return
+        self.embeddings = updated
+        if self.on_update is not None:
+            self.on_update(updated, sorted(paths))